@@ -1,20 +1,220 @@
-from typing import List, Dict
+import asyncio
+import time
+from collections import deque
+from typing import List, Dict, AsyncIterator
 
-from openai import OpenAI
-
-from src.conf.settings import OPENAI_API_KEY
+from src.client_api.pool import EndpointPool, Endpoint, CircuitBreaker
+from src.client_api.providers import LLMProvider, OpenAIProvider, FakeProvider
+from src.conf.settings import OPENAI_MAX_CONNECTIONS, OPENAI_TIMEOUT, LLM_RATE_LIMITS, WORKERS, LLM_ENDPOINTS, \
+    LLM_HEDGE_ENABLED, LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, \
+    LLM_PROVIDER, FAKE_LLM_TTFT_MS, FAKE_LLM_TOKENS_PER_SEC, FAKE_LLM_JITTER, FAKE_LLM_ERROR_RATE, \
+    FAKE_LLM_REPLY_TOKENS, FAKE_LLM_SEED
 from src.utils.gpt_model import gpt_dmodel, gpt_dtemp, gpt_max_token
 
-gpt_client = OpenAI(
-    api_key=OPENAI_API_KEY,
+# Shared pool of upstream endpoints, one connection pool per endpoint and worker for every chat turn
+gpt_pool = EndpointPool(
+    [
+        Endpoint(
+            name=cfg.get("name") or cfg.get("base_url") or "openai",
+            base_url=cfg.get("base_url"),
+            api_key=cfg.get("api_key"),
+            weight=float(cfg.get("weight", 1)),
+            breaker=CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+            timeout=OPENAI_TIMEOUT,
+            max_connections=OPENAI_MAX_CONNECTIONS,
+        )
+        for cfg in LLM_ENDPOINTS
+    ],
+    hedge_enabled=LLM_HEDGE_ENABLED,
+    hedge_percentile=LLM_HEDGE_PERCENTILE,
+    hedge_min_samples=LLM_HEDGE_MIN_SAMPLES,
 )
 
+# Providers by name, a topic model "fake:gpt-4o-mini" goes to the fake provider
+providers: dict[str, LLMProvider] = {
+    "openai": OpenAIProvider(gpt_pool),
+    "fake": FakeProvider(
+        ttft=FAKE_LLM_TTFT_MS / 1000,
+        tokens_per_sec=FAKE_LLM_TOKENS_PER_SEC,
+        jitter=FAKE_LLM_JITTER,
+        error_rate=FAKE_LLM_ERROR_RATE,
+        reply_tokens=FAKE_LLM_REPLY_TOKENS,
+        seed=FAKE_LLM_SEED,
+    ),
+}
+
+
+def get_provider(model: str) -> tuple[LLMProvider, str]:
+    """ Get provider of model and model name without provider prefix, LLM_PROVIDER is the default """
+    name, sep, model_name = model.partition(":")
+    if sep and name in providers:
+        return providers[name], model_name
+    return providers[LLM_PROVIDER], model
+
+
+def provider_stats() -> dict:
+    """ Counters of every provider of this worker """
+    return {name: provider.stats() for name, provider in providers.items()}
+
+
+class Priority:
+    """ Scheduler lanes, interactive turns are always served before background work """
+    interactive = "interactive"
+    background = "background"
+
+
+priority_lanes = [Priority.interactive, Priority.background]
+
+# Upper bounds (seconds) of queue wait time histogram buckets
+wait_buckets = [0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, float("inf")]
+
+
+class TokenBucket:
+    """ Bucket refilled at rate per second up to capacity """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        """ Seconds until amount is available, amounts above capacity only need a full bucket """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class ModelScheduler:
+    """ Requests and tokens per minute buckets of one model with priority lanes of waiting calls """
+
+    def __init__(self, model: str, rpm: float | None, tpm: float | None):
+        self.model = model
+        self.requests = TokenBucket(rpm / 60, rpm) if rpm else None
+        self.tokens = TokenBucket(tpm / 60, tpm) if tpm else None
+        self.lanes: dict[str, deque] = {lane: deque() for lane in priority_lanes}
+        self._timer: asyncio.TimerHandle | None = None
+        self.calls = {lane: 0 for lane in priority_lanes}
+        self.wait_total = {lane: 0.0 for lane in priority_lanes}
+        self.wait_max = {lane: 0.0 for lane in priority_lanes}
+        self.wait_histogram = {lane: [0] * len(wait_buckets) for lane in priority_lanes}
+
+    def _wait_time(self, cost: int) -> float:
+        waits = [0.0]
+        if self.requests is not None:
+            waits.append(self.requests.wait_time(1))
+        if self.tokens is not None:
+            waits.append(self.tokens.wait_time(cost))
+        return max(waits)
+
+    def _take(self, cost: int) -> None:
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(cost)
+
+    async def acquire(self, cost: int, lane: str = Priority.interactive) -> None:
+        """ Wait until the call fits in the buckets, calls of higher lanes go first """
+        start = time.monotonic()
+        if not any(self.lanes.values()) and self._wait_time(cost) == 0:
+            self._take(cost)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.lanes[lane].append((cost, future))
+            self._dispatch()
+            try:
+                await future
+            finally:
+                # Leave lane when caller was cancelled while waiting
+                if not future.done():
+                    future.cancel()
+        self._record(lane, time.monotonic() - start)
+
+    def _dispatch(self) -> None:
+        """ Release waiting calls in lane order, schedule next run when buckets are empty """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for lane in priority_lanes:
+            queue = self.lanes[lane]
+            while queue:
+                cost, future = queue[0]
+                if future.done():
+                    queue.popleft()
+                    continue
+                wait = self._wait_time(cost)
+                if wait > 0:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                    return
+                queue.popleft()
+                self._take(cost)
+                future.set_result(None)
+
+    def _record(self, lane: str, wait: float) -> None:
+        self.calls[lane] += 1
+        self.wait_total[lane] += wait
+        self.wait_max[lane] = max(self.wait_max[lane], wait)
+        for i, bound in enumerate(wait_buckets):
+            if wait <= bound:
+                self.wait_histogram[lane][i] += 1
+                break
+
+    def stats(self) -> dict:
+        return {
+            lane: {
+                "queued": len(self.lanes[lane]),
+                "calls": self.calls[lane],
+                "wait_avg": self.wait_total[lane] / self.calls[lane] if self.calls[lane] else 0.0,
+                "wait_max": self.wait_max[lane],
+                "wait_histogram": dict(zip(map(str, wait_buckets), self.wait_histogram[lane])),
+            }
+            for lane in priority_lanes
+        }
+
+
+# Schedulers by model, account limits are shared by all workers
+_schedulers: dict[str, ModelScheduler] = {}
+
+
+def get_scheduler(model: str) -> ModelScheduler:
+    """ Get scheduler of model, limits come from LLM_RATE_LIMITS of config with "default" fallback """
+    scheduler = _schedulers.get(model)
+    if scheduler is None:
+        limits = LLM_RATE_LIMITS.get(model) or LLM_RATE_LIMITS.get("default") or {}
+        rpm = limits.get("rpm")
+        tpm = limits.get("tpm")
+        scheduler = ModelScheduler(
+            model,
+            rpm / WORKERS if rpm else None,
+            tpm / WORKERS if tpm else None,
+        )
+        _schedulers[model] = scheduler
+    return scheduler
+
+
+def scheduler_stats() -> dict:
+    """ Queue wait time of upstream calls by model """
+    return {model: scheduler.stats() for model, scheduler in _schedulers.items()}
+
+
+def estimate_tokens(messages: list[dict], max_tokens: int | None) -> int:
+    """ Cheap estimate of prompt tokens plus reply tokens, about 4 characters per token """
+    prompt = sum(len(m.get("content") or "") // 4 + 4 for m in messages)
+    return prompt + (max_tokens or 0)
+
 
 async def chat_completion(
         messages: List[Dict[str, str]],
-        model: str = "gpt-4o-mini",
-        temperature: float = 0.7,
-        max_tokens: int = 1024,
+        model: str = gpt_dmodel,
+        temperature: float = gpt_dtemp,
+        max_tokens: int = gpt_max_token,
         **kwargs
 ) -> str:
     """
@@ -26,36 +226,46 @@ async def chat_completion(
     :param max_tokens: số token tối đa trả về
     :param kwargs: thêm các param OpenAI (nếu cần)
     """
-    resp = await gpt_client.chat.completions.create(
-        model=model,
+    provider, model = get_provider(model)
+    return await provider.complete(
         messages=messages,
+        model=model,
         temperature=temperature,
         max_tokens=max_tokens,
         **kwargs
     )
-    return resp.choices[0].message["content"]
 
 
-def message_to_gpt(messages: list[dict], model: str, temperature: float, max_tokens: int) -> str:
+async def message_to_gpt(messages: list[dict], model: str, temperature: float, max_tokens: int,
+                         priority: str = Priority.interactive) -> str:
     """
     Call api and get full response (non-streaming).
     """
-    resp = gpt_client.chat.completions.create(
-        model=model,
+    await get_scheduler(model).acquire(estimate_tokens(messages, max_tokens), priority)
+    return await chat_completion(
         messages=messages,
+        model=model,
         temperature=temperature,
         max_tokens=max_tokens
     )
-    return resp.choices[0].message.content
 
 
-def message_to_gpt_stream(messages: list[dict], model: str = gpt_dmodel, temperature: float = gpt_dtemp,
-                          max_tokens: int = gpt_max_token):
-    """ Call api and get response in streaming mode (response by chunk). """
-    return gpt_client.chat.completions.create(
+async def message_to_gpt_stream(messages: list[dict], model: str = gpt_dmodel, temperature: float = gpt_dtemp,
+                                max_tokens: int = gpt_max_token,
+                                priority: str = Priority.interactive) -> AsyncIterator[str]:
+    """ Call api and get response in streaming mode, yield text delta of each chunk. """
+    await get_scheduler(model).acquire(estimate_tokens(messages, max_tokens), priority)
+    provider, model = get_provider(model)
+    async for delta in provider.stream(
         model=model,
         messages=messages,
         temperature=temperature,
-        max_tokens=max_tokens,
-        stream=True
-    )
+        max_tokens=max_tokens
+    ):
+        yield delta
+
+
+async def close_gpt_client() -> None:
+    """ Close the http connection pools of upstream providers on shutdown. """
+    for provider in providers.values():
+        await provider.close()
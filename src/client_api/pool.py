@@ -0,0 +1,336 @@
+"""
+Pool of OpenAI-compatible upstream endpoints.
+Calls go to the endpoint with least outstanding requests per weight, endpoints that keep failing
+are skipped by their circuit breaker, and a hedged second request can be sent when the first one
+is slower than a percentile of recent time to first token.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+T = TypeVar("T")
+
+# Errors worth trying on another endpoint
+retryable_errors = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class NoEndpointAvailable(Exception):
+    """ Every endpoint was tried or has an open circuit """
+
+
+class CircuitBreaker:
+    """ Open after failure_threshold consecutive failures, let one probe through after reset_timeout """
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.closed
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def available(self) -> bool:
+        if self.state == self.closed:
+            return True
+        if self.state == self.open and time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        return not self._probing
+
+    def on_pick(self) -> None:
+        if self.state != self.closed:
+            self.state = self.half_open
+            self._probing = True
+
+    def on_success(self) -> None:
+        self.state = self.closed
+        self.failures = 0
+        self._probing = False
+
+    def on_cancel(self) -> None:
+        """ Probe was cancelled, e.g. lost a hedge, let the next one through """
+        self._probing = False
+
+    def on_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == self.half_open or self.failures >= self.failure_threshold:
+            self.state = self.open
+            self.opened_at = time.monotonic()
+
+
+class Endpoint:
+    """ One upstream base url and api key """
+
+    def __init__(self, name: str, base_url: str | None, api_key: str | None, weight: float,
+                 breaker: CircuitBreaker, timeout: float, max_connections: int):
+        self.name = name
+        self.weight = weight if weight > 0 else 1
+        self.breaker = breaker
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.client = AsyncOpenAI(
+            api_key=api_key or "none",
+            base_url=base_url,
+            timeout=timeout,
+            # Retries go to other endpoints of the pool
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=timeout,
+            ),
+        )
+
+    def load(self) -> float:
+        return (self.outstanding + 1) / self.weight
+
+    def stats(self) -> dict:
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "weight": self.weight,
+            "circuit": self.breaker.state,
+        }
+
+
+class LatencySamples:
+    """ Recent latencies used to compute the hedging delay """
+
+    def __init__(self, size: int = 500):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, p: float, min_samples: int) -> float | None:
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class EndpointPool:
+    """ Weighted least outstanding requests balancing with failover and optional hedging """
+
+    def __init__(self, endpoints: list[Endpoint], hedge_enabled: bool, hedge_percentile: float,
+                 hedge_min_samples: int):
+        self.endpoints = endpoints
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.ttft = LatencySamples()
+        self.latency = LatencySamples()
+        self.embed_latency = LatencySamples()
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def pick(self, exclude: set[str]) -> Endpoint | None:
+        """ Endpoint with least outstanding requests per weight among those with a closed circuit """
+        candidates = [e for e in self.endpoints if e.name not in exclude and e.breaker.available()]
+        if not candidates:
+            return None
+        endpoint = min(candidates, key=Endpoint.load)
+        endpoint.breaker.on_pick()
+        return endpoint
+
+    async def complete(self, **params) -> str:
+        """ Non-streaming chat completion, return content of the reply """
+
+        async def attempt(endpoint: Endpoint) -> str:
+            start = time.monotonic()
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            try:
+                resp = await endpoint.client.chat.completions.create(**params)
+            except Exception as e:
+                self._on_error(endpoint, e)
+                raise
+            except asyncio.CancelledError:
+                endpoint.breaker.on_cancel()
+                raise
+            finally:
+                endpoint.outstanding -= 1
+            endpoint.breaker.on_success()
+            self.latency.add(time.monotonic() - start)
+            return resp.choices[0].message.content or ""
+
+        content, _ = await self._run(attempt, None, self.latency)
+        return content
+
+    async def embed(self, **params) -> list[list[float]]:
+        """ Embeddings of input texts """
+
+        async def attempt(endpoint: Endpoint) -> list[list[float]]:
+            start = time.monotonic()
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            try:
+                resp = await endpoint.client.embeddings.create(**params)
+            except Exception as e:
+                self._on_error(endpoint, e)
+                raise
+            except asyncio.CancelledError:
+                endpoint.breaker.on_cancel()
+                raise
+            finally:
+                endpoint.outstanding -= 1
+            endpoint.breaker.on_success()
+            self.embed_latency.add(time.monotonic() - start)
+            return [item.embedding for item in resp.data]
+
+        embeddings, _ = await self._run(attempt, None, self.embed_latency)
+        return embeddings
+
+    async def stream(self, **params) -> AsyncIterator[str]:
+        """ Streaming chat completion, yield text delta of each chunk """
+
+        async def attempt(endpoint: Endpoint):
+            start = time.monotonic()
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            try:
+                stream = await endpoint.client.chat.completions.create(stream=True, **params)
+                iterator = stream.__aiter__()
+                # Wait for first content delta, role header chunks carry no text
+                first = None
+                async for chunk in iterator:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        first = chunk.choices[0].delta.content
+                        break
+            except BaseException as e:
+                endpoint.outstanding -= 1
+                if isinstance(e, Exception):
+                    self._on_error(endpoint, e)
+                else:
+                    endpoint.breaker.on_cancel()
+                raise
+            self.ttft.add(time.monotonic() - start)
+            return stream, iterator, first
+
+        async def discard(endpoint: Endpoint, result) -> None:
+            endpoint.outstanding -= 1
+            await result[0].close()
+
+        (stream, iterator, first), endpoint = await self._run(attempt, discard, self.ttft)
+        try:
+            if first:
+                yield first
+            async for chunk in iterator:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+            endpoint.breaker.on_success()
+        except Exception as e:
+            self._on_error(endpoint, e)
+            raise
+        except BaseException:
+            # Consumer closed the generator or was cancelled, a half open probe must not stay taken
+            endpoint.breaker.on_cancel()
+            raise
+        finally:
+            endpoint.outstanding -= 1
+            await stream.close()
+
+    def _on_error(self, endpoint: Endpoint, error: Exception) -> None:
+        endpoint.errors += 1
+        # Client errors like a bad request are not the endpoint's fault
+        if isinstance(error, retryable_errors):
+            endpoint.breaker.on_failure()
+        else:
+            endpoint.breaker.on_success()
+
+    async def _run(self, attempt: Callable[[Endpoint], Awaitable[T]],
+                   discard: Callable[[Endpoint, T], Awaitable[None]] | None,
+                   samples: LatencySamples) -> tuple[T, Endpoint]:
+        """ Try endpoints until one succeeds, retryable errors move on to the next endpoint """
+        tried: set[str] = set()
+        last_error: Exception | None = None
+        while True:
+            try:
+                return await self._hedged(attempt, discard, samples, tried)
+            except NoEndpointAvailable:
+                if last_error is not None:
+                    raise last_error
+                raise
+            except retryable_errors as e:
+                last_error = e
+
+    async def _hedged(self, attempt: Callable[[Endpoint], Awaitable[T]],
+                      discard: Callable[[Endpoint, T], Awaitable[None]] | None,
+                      samples: LatencySamples, tried: set[str]) -> tuple[T, Endpoint]:
+        """ Run attempt on one endpoint, start a second one when the first is slower than the hedge delay """
+        first = self.pick(tried)
+        if first is None:
+            raise NoEndpointAvailable("no upstream endpoint available")
+        tried.add(first.name)
+        tasks = {asyncio.create_task(attempt(first)): first}
+
+        delay = samples.percentile(self.hedge_percentile, self.hedge_min_samples) if self.hedge_enabled else None
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                second = self.pick(tried)
+                if second is not None:
+                    tried.add(second.name)
+                    self.hedges += 1
+                    tasks[asyncio.create_task(attempt(second))] = second
+
+        # First successful attempt wins, the other one is cancelled or discarded
+        pending = set(tasks)
+        winner_task = None
+        error: BaseException | None = None
+        try:
+            while pending and winner_task is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner_task is None:
+                        winner_task = task
+            if winner_task is None:
+                raise error
+            winner = tasks[winner_task]
+            if winner is not first:
+                self.hedges_won += 1
+            return winner_task.result(), winner
+        finally:
+            for task in tasks:
+                if task is not winner_task and not task.done():
+                    task.cancel()
+            for task in tasks:
+                if task is winner_task:
+                    continue
+                try:
+                    result = await task
+                except BaseException:
+                    continue
+                if discard is not None:
+                    await discard(tasks[task], result)
+
+    async def close(self) -> None:
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    def stats(self) -> dict:
+        return {
+            "endpoints": {e.name: e.stats() for e in self.endpoints},
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "hedge_delay": self.ttft.percentile(self.hedge_percentile, self.hedge_min_samples),
+        }
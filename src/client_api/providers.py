@@ -0,0 +1,132 @@
+"""
+LLM providers behind message_to_gpt and message_to_gpt_stream.
+A provider turns chat messages into a full reply or a stream of text deltas.
+"""
+import asyncio
+import hashlib
+import json
+import random
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+from src.client_api.pool import EndpointPool
+
+
+class ProviderError(Exception):
+    """ Upstream provider failed to answer """
+
+
+class LLMProvider(ABC):
+    """ Interface of a chat completion provider """
+    name: str = ""
+
+    @abstractmethod
+    async def complete(self, messages: list[dict], model: str, temperature: float | None,
+                       max_tokens: int | None, **kwargs) -> str:
+        ...
+
+    @abstractmethod
+    def stream(self, messages: list[dict], model: str, temperature: float | None,
+               max_tokens: int | None) -> AsyncIterator[str]:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class OpenAIProvider(LLMProvider):
+    """ OpenAI and OpenAI-compatible servers through the endpoint pool """
+    name = "openai"
+
+    def __init__(self, pool: EndpointPool):
+        self.pool = pool
+
+    async def complete(self, messages, model, temperature, max_tokens, **kwargs) -> str:
+        return await self.pool.complete(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **kwargs
+        )
+
+    async def stream(self, messages, model, temperature, max_tokens) -> AsyncIterator[str]:
+        async for delta in self.pool.stream(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        ):
+            yield delta
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    def stats(self) -> dict:
+        return self.pool.stats()
+
+
+# Words of fake replies
+fake_vocabulary = (
+    "the a chat reply token model stream test load fast slow answer question topic user assistant "
+    "message context budget cache worker socket event data value result simple deterministic local"
+).split()
+
+
+class FakeProvider(LLMProvider):
+    """
+    Offline provider for benchmarks and CI.
+    The reply only depends on model and messages, timing and failures follow the configured profile.
+    """
+    name = "fake"
+
+    def __init__(self, ttft: float, tokens_per_sec: float, jitter: float, error_rate: float,
+                 reply_tokens: int, seed: int | None = None):
+        self.ttft = ttft
+        self.tokens_per_sec = tokens_per_sec
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reply_tokens = reply_tokens
+        self._rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    def _tokens(self, messages: list[dict], model: str, max_tokens: int | None) -> list[str]:
+        """ Deterministic reply tokens seeded by the request """
+        seed = hashlib.sha256(json.dumps([model, messages], sort_keys=True).encode("utf-8")).digest()
+        rng = random.Random(seed)
+        count = min(self.reply_tokens, max_tokens or self.reply_tokens)
+        return [("" if i == 0 else " ") + rng.choice(fake_vocabulary) for i in range(count)]
+
+    def _delay(self, seconds: float) -> float:
+        """ Apply jitter as a fraction of the delay """
+        if self.jitter:
+            seconds *= 1 + self._rng.uniform(-self.jitter, self.jitter)
+        return max(seconds, 0.0)
+
+    def _maybe_fail(self) -> None:
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors += 1
+            raise ProviderError("fake provider error")
+
+    async def complete(self, messages, model, temperature, max_tokens, **kwargs) -> str:
+        self.calls += 1
+        tokens = self._tokens(messages, model, max_tokens)
+        await asyncio.sleep(self._delay(self.ttft + len(tokens) / self.tokens_per_sec))
+        self._maybe_fail()
+        return "".join(tokens)
+
+    async def stream(self, messages, model, temperature, max_tokens) -> AsyncIterator[str]:
+        self.calls += 1
+        tokens = self._tokens(messages, model, max_tokens)
+        await asyncio.sleep(self._delay(self.ttft))
+        self._maybe_fail()
+        for token in tokens:
+            yield token
+            await asyncio.sleep(self._delay(1 / self.tokens_per_sec))
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "errors": self.errors}
@@ -23,6 +23,23 @@ RELOAD_ENABLED = os.getenv("UVICORN_RELOAD", "false").lower() == "true"
 MIDDLEWARE = os.getenv("MIDDLEWARE", "false").lower() == "true"
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///")
+# Read replica URLs separated by comma, reads of GET requests go to them
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Seconds reads of a user stay on primary after their own write
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+
+# Connection pool of each engine in each worker, at most pool size + overflow connections.
+# A database gets up to WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections, keep it below its max_connections
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 5))
+# Seconds a checkout waits for a free connection, and age in seconds after which a connection is replaced
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Prepared statements cached per asyncpg connection
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+# PgBouncer pool mode in front of the database, transaction disables prepared statement caches
+DB_PGBOUNCER_MODE = os.getenv("DB_PGBOUNCER_MODE", "").lower()
 
 # Password hashing context
 PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -47,8 +64,112 @@ ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
 
 # OpenAI Secret Key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 500))
+
+# Text search configuration of PostgreSQL full-text index, changing it needs the index to be rebuilt
+FULLTEXT_LANGUAGE = os.getenv("FULLTEXT_LANGUAGE", "simple")
+
+# History export settings, rows fetched per cursor batch and messages per fine-tuning example
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+EXPORT_FINETUNE_MAX_MESSAGES = int(os.getenv("EXPORT_FINETUNE_MAX_MESSAGES", 20))
+
+# Seconds a count of the cached strategy is reused for the same list query
+COUNT_CACHE_TTL = int(os.getenv("COUNT_CACHE_TTL", 30))
+# Validate serialized responses against their schema, costs a pydantic pass per response
+RESPONSE_VALIDATION = os.getenv("RESPONSE_VALIDATION", "false").lower() == "true"
+# Statements of list request shapes kept by each worker
+QUERY_PLAN_CACHE_SIZE = int(os.getenv("QUERY_PLAN_CACHE_SIZE", 512))
+
+# Chat context settings
+CONTEXT_FETCH_BATCH = int(os.getenv("CONTEXT_FETCH_BATCH", 50))
+
+# Chat compaction settings, used by topics with compaction enabled
+COMPACTION_THRESHOLD_TOKENS = int(os.getenv("COMPACTION_THRESHOLD_TOKENS", 6000))
+COMPACTION_KEEP_TOKENS = int(os.getenv("COMPACTION_KEEP_TOKENS", 2000))
+COMPACTION_BATCH = int(os.getenv("COMPACTION_BATCH", 40))
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL")
+COMPACTION_SUMMARY_MAX_TOKENS = int(os.getenv("COMPACTION_SUMMARY_MAX_TOKENS", 512))
+
+# Response cache settings, used by topics with cache enabled
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 10000))
+RESPONSE_CACHE_CHUNK_SIZE = int(os.getenv("RESPONSE_CACHE_CHUNK_SIZE", 32))
+
+# Single-flight settings, used by topics with single-flight enabled (seconds)
+SINGLE_FLIGHT_LOCK_TTL = int(os.getenv("SINGLE_FLIGHT_LOCK_TTL", 120))
+SINGLE_FLIGHT_WAIT = int(os.getenv("SINGLE_FLIGHT_WAIT", 30))
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv("SINGLE_FLIGHT_RESULT_TTL", 30))
+
+# Semantic response cache settings, used by topics with semantic cache enabled
+# Embedder is "local" or an embedding model of the upstream endpoints, e.g. "text-embedding-3-small"
+SEMANTIC_CACHE_EMBEDDER = os.getenv("SEMANTIC_CACHE_EMBEDDER", "local")
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", 256))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 2000))
+SEMANTIC_CACHE_TOPICS = int(os.getenv("SEMANTIC_CACHE_TOPICS", 256))
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", str(PROJECT_DIR / "semantic_cache"))
+# Share of hits also answered upstream to measure false positives, and reply similarity below which a hit is false
+SEMANTIC_CACHE_SAMPLE_RATE = float(os.getenv("SEMANTIC_CACHE_SAMPLE_RATE", 0.01))
+SEMANTIC_CACHE_FP_SIMILARITY = float(os.getenv("SEMANTIC_CACHE_FP_SIMILARITY", 0.8))
 
-with open(os.path.join(PROJECT_DIR, 'config.json')) as config_file:
-    config = json.load(config_file)
+# In-process conversation window cache settings, 0 topics disables it
+WINDOW_CACHE_TOPICS = int(os.getenv("WINDOW_CACHE_TOPICS", 1024))
+WINDOW_CACHE_MESSAGES = int(os.getenv("WINDOW_CACHE_MESSAGES", 64))
+WINDOW_CACHE_TTL = float(os.getenv("WINDOW_CACHE_TTL", 60))
+
+# WebSocket streaming, deltas are sent per WS_COALESCE_BYTES bytes or WS_COALESCE_MS milliseconds
+WS_COALESCE_BYTES = int(os.getenv("WS_COALESCE_BYTES", 256))
+WS_COALESCE_MS = int(os.getenv("WS_COALESCE_MS", 50))
+WS_SEND_BUFFER_BYTES = int(os.getenv("WS_SEND_BUFFER_BYTES", 65536))
+
+# Resumable generations (seconds), stream of a running generation and of a finished one are kept for
+GENERATION_STREAM_TTL = int(os.getenv("GENERATION_STREAM_TTL", 600))
+GENERATION_RESULT_TTL = int(os.getenv("GENERATION_RESULT_TTL", 60))
+GENERATION_WAIT = int(os.getenv("GENERATION_WAIT", 30))
+
+# Topic fan-out, events of a topic reach its sockets on every worker, slow sockets drop events over queue size
+TOPIC_FANOUT_ENABLED = os.getenv("TOPIC_FANOUT_ENABLED", "true").lower() == "true"
+TOPIC_FANOUT_QUEUE_SIZE = int(os.getenv("TOPIC_FANOUT_QUEUE_SIZE", 1000))
+
+# Write-behind persistence of chat messages, PostgreSQL or SQLite with a single worker
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 200))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 0.05))
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", 10000))
+WRITE_BEHIND_SPILL_PATH = os.getenv("WRITE_BEHIND_SPILL_PATH", str(PROJECT_DIR / "chat_messages.spill.jsonl"))
+# Message ids reserved per round trip to the sequence, unused ids of a block are lost on restart
+WRITE_BEHIND_ID_BLOCK = int(os.getenv("WRITE_BEHIND_ID_BLOCK", 50))
+
+# Defaults below apply without config.json, e.g. in tests
+config_path = os.path.join(PROJECT_DIR, 'config.json')
+config = {}
+if os.path.exists(config_path):
+    with open(config_path) as config_file:
+        config = json.load(config_file)
 
 ALLOW_ORIGIN = config.get("ALLOW_CORS", ["http://localhost:3000", "http://127.0.0.1:3000", ])
+
+# Upstream account limits by model, e.g. {"gpt-4o-mini": {"rpm": 500, "tpm": 200000}, "default": {...}}
+LLM_RATE_LIMITS = config.get("LLM_RATE_LIMITS", {})
+
+# Count strategy of list endpoints by table when the request does not choose one, big tables skip exact counts
+LIST_COUNT_STRATEGIES = config.get("LIST_COUNT_STRATEGIES") or {"chat_messages": "estimated", "default": "exact"}
+
+# Upstream OpenAI-compatible endpoints, e.g. [{"name": "local", "base_url": "http://localhost:8001/v1",
+# "api_key": "...", "weight": 2}], defaults to OpenAI with OPENAI_API_KEY
+LLM_ENDPOINTS = config.get("LLM_ENDPOINTS") or [{"name": "openai", "api_key": OPENAI_API_KEY, "weight": 1}]
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 95))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 50))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+
+# Provider of topics without a "provider:" model prefix, "openai" or "fake"
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
+FAKE_LLM_TTFT_MS = int(os.getenv("FAKE_LLM_TTFT_MS", 200))
+FAKE_LLM_TOKENS_PER_SEC = float(os.getenv("FAKE_LLM_TOKENS_PER_SEC", 50))
+FAKE_LLM_JITTER = float(os.getenv("FAKE_LLM_JITTER", 0.1))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", 0))
+FAKE_LLM_REPLY_TOKENS = int(os.getenv("FAKE_LLM_REPLY_TOKENS", 64))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED")) if os.getenv("FAKE_LLM_SEED") else None
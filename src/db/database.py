@@ -1,27 +1,178 @@
+import asyncio
+import itertools
+import uuid
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from starlette.requests import HTTPConnection
 
 from src.conf import settings
+from src.db.pool_metrics import MeteredQueuePool, instrument
+from src.db.redisdb import redis_client, recent_write
+from src.handlers.jwt_token import decode_token
+from src.utils.logs import debug_log
 
 SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
 
-engine = create_async_engine(SQLALCHEMY_DATABASE_URL, echo=settings.DEBUG)
+
+def engine_options(url: str) -> dict:
+    """ Pool and driver options of an engine from settings """
+    options = {"echo": settings.DEBUG, "pool_pre_ping": settings.DB_POOL_PRE_PING}
+    # SQLite keeps the pool chosen by its dialect
+    if url.startswith("sqlite"):
+        return options
+    options.update(
+        poolclass=MeteredQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+    if "+asyncpg" in url:
+        if settings.DB_PGBOUNCER_MODE == "transaction":
+            # Each transaction may run on another server connection, prepared statements cannot be reused
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+            }
+        else:
+            options["connect_args"] = {
+                "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+                "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+            }
+    return options
+
+
+engine = create_async_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL))
+# Read replicas, reads of GET requests go to one of them while writes stay on primary
+replica_engines = [create_async_engine(url, **engine_options(url)) for url in settings.DATABASE_REPLICA_URLS]
+instrument(engine, "primary")
+for i, replica_engine in enumerate(replica_engines):
+    instrument(replica_engine, f"replica-{i}")
+_next_replica = itertools.cycle(replica_engines)
+
+# Request methods that are served from a replica
+READ_METHODS = ("GET", "HEAD")
+
+# Requests by routing decision of this worker
+route_stats = {"primary": 0, "replica": 0, "sticky": 0}
+
+# Keep references of running stickiness marks, so they are not garbage collected
+_running_tasks: set[asyncio.Task] = set()
+
+
+class RoutingSession(Session):
+    """ Session reading from the replica of its info, flushes and everything after a write use primary """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get("replica")
+        if replica is None or self._flushing or self.info.get("wrote") or getattr(clause, "is_dml", False):
+            return engine.sync_engine
+        return replica.sync_engine
+
+
 AsyncSessionLocal = sessionmaker(
     bind=engine,
     class_=AsyncSession,
+    sync_session_class=RoutingSession,
     expire_on_commit=False,
 )
 
 Base = declarative_base()
 
 
-async def get_db():
+@event.listens_for(RoutingSession, "after_flush")
+def _flushed(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _executed(orm_execute_state):
+    state = orm_execute_state
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _committed(session):
+    if not replica_engines or not session.info.get("wrote"):
+        return
+    user_id = session_user(session.info)
+    if user_id is not None:
+        task = asyncio.get_running_loop().create_task(mark_write(user_id))
+        _running_tasks.add(task)
+        task.add_done_callback(_running_tasks.discard)
+
+
+async def mark_write(user_id: int) -> None:
+    """ Keep reads of user on primary for REPLICA_STICKY_SECONDS, until replicas caught up with the write """
+    try:
+        await redis_client.set(f"{recent_write}:{user_id}", 1, ex=settings.REPLICA_STICKY_SECONDS)
+    except Exception as e:
+        debug_log(f"Error when marking write of user {user_id}: \n{e}")
+
+
+def connection_user(conn: HTTPConnection) -> int | None:
+    """
+    User id of the access token of a connection, None when it has none or it is invalid.
+    Requests send a bearer token, WebSocket routes take it from the token query param.
+    """
+    if conn.scope["type"] == "websocket":
+        token = conn.query_params.get("token")
+    else:
+        auth_header = conn.headers.get("Authorization")
+        token = auth_header.split(" ", 1)[1] if auth_header and auth_header.startswith("Bearer ") else None
+    if not token:
+        return None
+    payload = decode_token(token)
+    return payload.user_id if payload is not None else None
+
+
+def session_user(info: dict) -> int | None:
+    """ User id of a session, read from the token of its connection on first use """
+    if "user_id" not in info and "conn" in info:
+        info["user_id"] = connection_user(info["conn"])
+    return info.get("user_id")
+
+
+async def route_session(conn: HTTPConnection, db: AsyncSession) -> str:
+    """ Bind reads of a request session to a replica when it is safe, return the decision """
+    route = "primary"
+    if not replica_engines:
+        route_stats[route] += 1
+        return route
+    # Token is decoded for the stickiness check of reads, writes decode it when they commit
+    db.info["conn"] = conn
+    if conn.scope["type"] == "http" and conn.scope["method"] in READ_METHODS:
+        route = "replica"
+        user_id = session_user(db.info)
+        if user_id is not None:
+            try:
+                if await redis_client.exists(f"{recent_write}:{user_id}"):
+                    route = "sticky"
+            except Exception as e:
+                debug_log(f"Error when reading recent write of user {user_id}: \n{e}")
+                route = "primary"
+        if route == "replica":
+            db.info["replica"] = next(_next_replica)
+    route_stats[route] += 1
+    return route
+
+
+async def get_db(conn: HTTPConnection):
     db: AsyncSession = AsyncSessionLocal()
+    # Routing decision is sent back in X-DB-Route header
+    conn.state.db_route = await route_session(conn, db)
     try:
         yield db
     finally:
         await db.close()
-        
-async def get_db_instance() -> AsyncSession:
+
+
+async def get_db_instance(user_id: int | None = None) -> AsyncSession:
+    """ Session on primary, user_id keeps reads of that user on primary after it commits a write """
     db = AsyncSessionLocal()
+    db.info["user_id"] = user_id
     return db
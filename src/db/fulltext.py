@@ -0,0 +1,126 @@
+"""
+Full-text search indexes of chat tables.
+PostgreSQL uses a generated tsvector column with a GIN index, SQLite an FTS5 table kept in sync by triggers.
+"""
+import re
+from typing import Any, Type
+
+from sqlalchemy import Column, Float, Integer, MetaData, Table, Text, and_, func, literal_column, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.sql import Select
+
+from src.conf.settings import FULLTEXT_LANGUAGE
+
+# Columns indexed for full-text search by table
+fulltext_columns: dict[str, list[str]] = {
+    "chat_messages": ["content"],
+    "chat_topics": ["name", "description", "notes"],
+}
+
+# Dialects with a full-text backend
+fulltext_dialects = ("postgresql", "sqlite")
+
+# Name of generated tsvector column on PostgreSQL
+search_vector = "search_vector"
+
+word_pattern = re.compile(r"\w+")
+
+# FTS5 tables are created by create_fulltext_indexes, not by create_all
+_fts_metadata = MetaData()
+
+
+def fts_table(table_name: str) -> Table:
+    """ SQLite FTS5 table of table_name, rank is its bm25 score """
+    name = f"{table_name}_fts"
+    table = _fts_metadata.tables.get(name)
+    if table is None:
+        table = Table(
+            name, _fts_metadata,
+            Column("rowid", Integer),
+            # Column named like the table matches all indexed columns
+            Column(name, Text),
+            Column("rank", Float),
+        )
+    return table
+
+
+def supports_fulltext(model: Type[Any], dialect: str | None) -> bool:
+    return dialect in fulltext_dialects and model.__tablename__ in fulltext_columns
+
+
+def fulltext_terms(tokens: list[str], dialect: str) -> list[str]:
+    """ Match expressions of search tokens, every word of every token is required as prefix """
+    token_words = [word_pattern.findall(token.lower()) for token in tokens]
+    token_words = [words for words in token_words if words]
+    if not token_words:
+        return []
+    if dialect == "postgresql":
+        return [" & ".join(f"{word}:*" for words in token_words for word in words)]
+    return [" ".join('"' + word.replace('"', '""') + '"*' for word in words) for words in token_words]
+
+
+def apply_fulltext_search(stmt: Select, model: Type[Any], terms: list, dialect: str, rank: bool) -> Select:
+    """ Match every term of fulltext_terms, as values or bind parameters, order by relevance when rank """
+    if not terms:
+        return stmt
+    table_name = model.__tablename__
+
+    if dialect == "postgresql":
+        vector = literal_column(f"{table_name}.{search_vector}")
+        query = func.to_tsquery(literal_column(f"'{FULLTEXT_LANGUAGE}'::regconfig"), terms[0])
+        stmt = stmt.where(vector.op("@@")(query))
+        if rank:
+            stmt = stmt.order_by(func.ts_rank(vector, query).desc(), model.id.desc())
+        return stmt
+
+    table = fts_table(table_name)
+    conds = [table.c[table.name].match(term) for term in terms]
+    stmt = stmt.join(table, table.c.rowid == model.id).where(and_(*conds))
+    if rank:
+        # bm25 rank of FTS5 is lower for better matches
+        stmt = stmt.order_by(table.c.rank, model.id.desc())
+    return stmt
+
+
+async def create_fulltext_indexes(conn: AsyncConnection) -> None:
+    """ Create full-text indexes of fulltext_columns when missing """
+    dialect = conn.dialect.name
+    for table_name, columns in fulltext_columns.items():
+        if dialect == "postgresql":
+            document = " || ' ' || ".join(f"coalesce({c}, '')" for c in columns)
+            await conn.execute(text(
+                f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {search_vector} tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('{FULLTEXT_LANGUAGE}'::regconfig, {document})) STORED"
+            ))
+            await conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table_name}_{search_vector} "
+                f"ON {table_name} USING GIN ({search_vector})"
+            ))
+        elif dialect == "sqlite":
+            fts = f"{table_name}_fts"
+            exists = (await conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": fts}
+            )).first()
+            if exists:
+                continue
+            names = ", ".join(columns)
+            new_values = ", ".join(f"new.{c}" for c in columns)
+            old_values = ", ".join(f"old.{c}" for c in columns)
+            await conn.execute(text(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5({names}, content='{table_name}', content_rowid='id')"
+            ))
+            await conn.execute(text(
+                f"CREATE TRIGGER {fts}_ai AFTER INSERT ON {table_name} BEGIN "
+                f"INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {new_values}); END"
+            ))
+            await conn.execute(text(
+                f"CREATE TRIGGER {fts}_ad AFTER DELETE ON {table_name} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.id, {old_values}); END"
+            ))
+            await conn.execute(text(
+                f"CREATE TRIGGER {fts}_au AFTER UPDATE ON {table_name} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.id, {old_values}); "
+                f"INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {new_values}); END"
+            ))
+            # Index rows stored before the index existed
+            await conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
@@ -0,0 +1,142 @@
+"""
+Connection pool metrics of this worker.
+Checkouts, checkins, new and invalidated connections are counted from SQLAlchemy pool events,
+the queue of idle connections times how long each checkout waited for one.
+"""
+import bisect
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util.queue import AsyncAdaptedQueue
+
+# Upper bounds in milliseconds of checkout wait histogram buckets
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class PoolMetrics:
+    """ Counters of the pool of one engine """
+
+    def __init__(self, name: str, engine: AsyncEngine):
+        self.name = name
+        self.engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidated = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def observe_wait(self, seconds: float) -> None:
+        ms = seconds * 1000
+        self.waits += 1
+        self.wait_total += ms
+        self.wait_max = max(self.wait_max, ms)
+        self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS_MS, ms)] += 1
+
+    def stats(self) -> dict:
+        pool = self.engine.sync_engine.pool
+        buckets = {f"<={bound}": count for bound, count in zip(WAIT_BUCKETS_MS, self.wait_buckets)}
+        buckets["+Inf"] = self.wait_buckets[-1]
+        return {
+            "name": self.name,
+            "pool": type(pool).__name__,
+            "size": pool.size() if hasattr(pool, "size") else None,
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+            "connects": self.connects,
+            "checkouts": self.checkouts,
+            "checkins": self.checkins,
+            "invalidated": self.invalidated,
+            "overflow_checkouts": self.overflow_checkouts,
+            "timeouts": self.timeouts,
+            "wait_ms": {
+                "count": self.waits,
+                "avg": self.wait_total / self.waits if self.waits else 0.0,
+                "max": self.wait_max,
+                "buckets": buckets,
+            },
+        }
+
+
+class MeteredQueue(AsyncAdaptedQueue):
+    """ Idle connections of a pool, timing how long a checkout waits for one """
+    metrics: PoolMetrics | None = None
+
+    def get(self, block: bool = True, timeout: float | None = None):
+        # Only the wait is timed, a checkout that opens a new connection does it after an empty get
+        start = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_wait(time.perf_counter() - start)
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """ Queue pool reporting checkout wait time and timeouts to its metrics """
+    _queue_class = MeteredQueue
+
+    @property
+    def metrics(self) -> PoolMetrics | None:
+        return self._pool.metrics
+
+    @metrics.setter
+    def metrics(self, metrics: PoolMetrics | None) -> None:
+        self._pool.metrics = metrics
+
+    def _do_get(self):
+        try:
+            return super()._do_get()
+        except PoolTimeout as e:
+            # A retried checkout raises the same error through each call
+            if self.metrics is not None and not getattr(e, "counted", False):
+                e.counted = True
+                self.metrics.timeouts += 1
+            raise
+
+    def recreate(self):
+        # Pool made by engine dispose keeps the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+# Metrics by engine name
+pool_metrics: dict[str, PoolMetrics] = {}
+
+
+def instrument(engine: AsyncEngine, name: str) -> PoolMetrics:
+    """ Count pool events of engine under name """
+    metrics = pool_metrics[name] = PoolMetrics(name, engine)
+    sync_engine = engine.sync_engine
+    if isinstance(sync_engine.pool, MeteredQueuePool):
+        sync_engine.pool.metrics = metrics
+
+    # Listeners on the engine stay on the pool recreated by dispose
+    @event.listens_for(sync_engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        metrics.connects += 1
+
+    @event.listens_for(sync_engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.checkouts += 1
+        pool = sync_engine.pool
+        if hasattr(pool, "size") and pool.checkedout() > pool.size():
+            metrics.overflow_checkouts += 1
+
+    @event.listens_for(sync_engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        metrics.checkins += 1
+
+    @event.listens_for(sync_engine, "invalidate")
+    def _invalidate(dbapi_connection, connection_record, exception):
+        metrics.invalidated += 1
+
+    return metrics
@@ -9,4 +9,27 @@ redis_client = aioredis.from_url(
 )
 
 # Key for storing redis data
-store_token = "access_token"
\ No newline at end of file
+store_token = "access_token"
+# Key prefix of lock held by the worker compacting a topic
+compaction_lock = "compaction_lock"
+# Key prefix of cached chat completions and sorted set index used for eviction
+response_cache = "response_cache"
+response_cache_index = "response_cache_index"
+# Key prefixes of single-flight lock and shared stream, and counter of saved upstream calls
+single_flight_lock = "single_flight_lock"
+single_flight_stream = "single_flight_stream"
+single_flight_saved = "single_flight_saved"
+# Key prefix of lock held by the worker appending to the semantic cache index of a topic
+semantic_cache_lock = "semantic_cache_lock"
+# Key prefix of memoized totals of list queries
+list_count = "list_count"
+# Key prefix of streams of in-flight assistant generations
+generation_stream = "generation_stream"
+# Channel prefix of topic events fanned out to sockets of every worker
+topic_channel = "topic_channel"
+# Channel of ids of topics changed by a worker, other workers drop their cached copy
+topic_invalidation = "topic_invalidation"
+# Channel of "topic_id:message_id" of messages added by a worker, other workers know their window misses it
+topic_last_message = "topic_last_message"
+# Key prefix marking users whose reads stay on primary after their own write
+recent_write = "recent_write"
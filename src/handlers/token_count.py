@@ -0,0 +1,67 @@
+import asyncio
+import math
+from functools import lru_cache
+
+import tiktoken
+from tiktoken.model import encoding_name_for_model
+
+from src.utils.gpt_model import gpt_context_window, gpt_default_context, gpt_default_encoding
+from src.utils.logs import debug_log
+
+# Tokens added by chat format for each message and for priming the assistant reply
+tokens_per_message: int = 3
+tokens_reply_priming: int = 3
+
+# Average characters of a token, estimates counts while no tokenizer is loaded
+chars_per_token: int = 4
+
+# Tokenizers by encoding name, loaded at startup by load_encodings
+encodings: dict[str, tiktoken.Encoding] = {}
+
+
+@lru_cache(maxsize=None)
+def encoding_name(model: str) -> str:
+    """ Get encoding name of model, default encoding for unknown models. """
+    try:
+        return encoding_name_for_model(model)
+    except KeyError:
+        return gpt_default_encoding
+
+
+async def load_encodings(models=None) -> None:
+    """
+    Load tokenizers of models in a thread, the first load downloads the BPE file unless it is in TIKTOKEN_CACHE_DIR.
+    Counts stay estimated when it fails, e.g. offline.
+    """
+    names = {encoding_name(model) for model in (models or gpt_context_window)} | {gpt_default_encoding}
+    for name in names - encodings.keys():
+        try:
+            encodings[name] = await asyncio.to_thread(tiktoken.get_encoding, name)
+        except Exception as e:
+            debug_log(f"Tokenizer {name} is not available, token counts are estimated: \n{e}")
+
+
+def get_encoding(model: str) -> tiktoken.Encoding | None:
+    """ Get loaded tokenizer of model, None when it is not loaded. It is never downloaded here. """
+    return encodings.get(encoding_name(model)) or encodings.get(gpt_default_encoding)
+
+
+def count_tokens(text: str | None, model: str) -> int:
+    """ Count tokens of a text with the local tokenizer of model, estimate by length without one. """
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / chars_per_token)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(role: str, content: str | None, model: str) -> int:
+    """ Count tokens of one chat message including the chat format overhead. """
+    return tokens_per_message + count_tokens(role, model) + count_tokens(content, model)
+
+
+def context_budget(model: str, max_tokens: int | None) -> int:
+    """ Get prompt token budget of model, context window minus tokens reserved for the reply. """
+    window = gpt_context_window.get(model, gpt_default_context)
+    return window - (max_tokens or 0) - tokens_reply_priming
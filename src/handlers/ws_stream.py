@@ -0,0 +1,112 @@
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable
+
+
+async def coalesce(deltas: AsyncIterator[str], max_bytes: int, max_delay: float) -> AsyncIterator[str]:
+    """ Merge small text deltas, yield buffered text when max_bytes accumulate or max_delay seconds pass """
+    loop = asyncio.get_running_loop()
+    iterator = deltas.__aiter__()
+    buffer: list[str] = []
+    size = 0
+    deadline = None
+    next_delta = None
+    try:
+        while True:
+            if next_delta is None:
+                next_delta = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_delta}, timeout=timeout)
+
+            # Flush buffer when upstream is slower than max delay
+            if not done:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+                continue
+
+            task, next_delta = next_delta, None
+            try:
+                delta = task.result()
+            except StopAsyncIteration:
+                break
+            if not delta:
+                continue
+            buffer.append(delta)
+            size += len(delta.encode("utf-8"))
+            if deadline is None:
+                deadline = loop.time() + max_delay
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+
+        # Send the rest when upstream is done
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if next_delta is not None and not next_delta.done():
+            next_delta.cancel()
+
+
+class BoundedSender:
+    """ Send frames in background with a bounded buffer, producers wait while the client is slow """
+
+    def __init__(self, send: Callable[[str], Awaitable[None]], max_bytes: int):
+        self._send = send
+        self.max_bytes = max_bytes
+        self._frames: deque[str] = deque()
+        self._size = 0
+        self._closed = False
+        self._error: Exception | None = None
+        self._cond = asyncio.Condition()
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def buffered(self) -> int:
+        """ Bytes waiting to be sent """
+        return self._size
+
+    async def put(self, frame: str) -> None:
+        """ Queue a frame, wait until buffer has room for it """
+        size = len(frame.encode("utf-8"))
+        async with self._cond:
+            # A frame larger than the whole buffer is accepted once buffer is empty
+            await self._cond.wait_for(
+                lambda: self._error is not None or self._size == 0 or self._size + size <= self.max_bytes
+            )
+            if self._error is not None:
+                raise self._error
+            self._frames.append(frame)
+            self._size += size
+            self._cond.notify_all()
+
+    async def _run(self) -> None:
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._frames or self._closed)
+                if not self._frames:
+                    return
+                frame = self._frames[0]
+            try:
+                await self._send(frame)
+            except Exception as e:
+                async with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            async with self._cond:
+                self._frames.popleft()
+                self._size -= len(frame.encode("utf-8"))
+                self._cond.notify_all()
+
+    async def close(self) -> None:
+        """ Send frames still buffered then stop """
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        await self._task
+        if self._error is not None:
+            raise self._error
+
+    def cancel(self) -> None:
+        """ Stop without sending buffered frames """
+        self._task.cancel()
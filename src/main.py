@@ -7,9 +7,11 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import JSONResponse
 
 from src.conf import settings
-from src.conf.settings import ALLOW_ORIGIN, HOST, PORT, WORKERS, LOG_LEVEL, RELOAD_ENABLED, MIDDLEWARE
+from src.conf.settings import ALLOW_ORIGIN, HOST, PORT, WORKERS, LOG_LEVEL, RELOAD_ENABLED, MIDDLEWARE, \
+    WRITE_BEHIND_ENABLED, DATABASE_REPLICA_URLS
 from src.dependencies.middlewares import PermissionMiddleware
 from src.routers import routes
+from src.services.generic_services import InvalidQuery
 from src.utils.api_path import RoutePaths
 
 
@@ -17,7 +19,27 @@ from src.utils.api_path import RoutePaths
 async def lifespan(app: FastAPI):
     from src.scripts.migrate_tables import create_tables
     await create_tables()
+    # Tokenizers are loaded off the event loop, requests never wait for a download
+    from src.handlers.token_count import load_encodings
+    await load_encodings()
+    if WRITE_BEHIND_ENABLED:
+        from src.services.chat_writer import chat_writer
+        await chat_writer.start()
+    # Topics updated on any worker are dropped from window cache of this one
+    from src.services.chat import window_cache
+    from src.services.topic_broadcast import topic_broadcast
+    await topic_broadcast.watch_invalidations(window_cache.invalidate)
+    # Windows missing a message added by another worker are reloaded before use
+    await topic_broadcast.watch_messages(window_cache.note_message)
     yield
+    if WRITE_BEHIND_ENABLED:
+        await chat_writer.stop()
+    await topic_broadcast.close()
+    from src.client_api.gpt import close_gpt_client
+    await close_gpt_client()
+    from src.db.database import replica_engines
+    for replica in replica_engines:
+        await replica.dispose()
 
 
 app = FastAPI(
@@ -38,6 +60,16 @@ app.add_middleware(
 if MIDDLEWARE:
     app.add_middleware(PermissionMiddleware)
 
+if DATABASE_REPLICA_URLS:
+    @app.middleware("http")
+    async def db_route_header(request: Request, call_next):
+        """ Send database routing decision of request session in X-DB-Route header """
+        response = await call_next(request)
+        route = getattr(request.state, "db_route", None)
+        if route is not None:
+            response.headers["X-DB-Route"] = route
+        return response
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
@@ -48,6 +80,11 @@ def test_error():
     raise ValueError("-- This is the test error --")
 
 
+@app.exception_handler(InvalidQuery)
+async def invalid_query_handler(request: Request, exc: InvalidQuery):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logging.exception(f"Unhandled error: {exc}")
@@ -22,6 +22,20 @@ class ChatTopic(Base):
     temperature: Mapped[Optional[float]] = mapped_column(Float, default=gpt_dtemp)
     max_token: Mapped[Optional[int]] = mapped_column(Integer, default=gpt_max_token)
     max_msg_retrieve: Mapped[Optional[int]] = mapped_column(Integer, default=gpt_max_retrieve)
+
+    # Rolling summary of older messages, maintained when compaction is enabled
+    compaction_enabled: Mapped[bool] = mapped_column(Boolean, default=False)
+    compaction_threshold: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    summary: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    summary_until_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    summary_token_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # Reuse stored completions for identical requests
+    cache_enabled: Mapped[bool] = mapped_column(Boolean, default=False)
+    # Share one upstream call between identical concurrent requests
+    single_flight_enabled: Mapped[bool] = mapped_column(Boolean, default=False)
+    # Reuse stored replies for near-duplicate questions of the topic
+    semantic_cache_enabled: Mapped[bool] = mapped_column(Boolean, default=False)
     
     notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
@@ -43,6 +57,8 @@ class ChatMessage(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     role: Mapped[str] = mapped_column(String(50), nullable=False)
     content: Mapped[str] = mapped_column(Text, nullable=False)
+    # Token count of message computed at insert time, used by the context builder
+    token_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=now_vn)
 
     topic_id: Mapped[int] = mapped_column(
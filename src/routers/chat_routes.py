@@ -1,20 +1,32 @@
 # chat_routes.py
 
+import asyncio
+import json
+import uuid
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, WebSocket
+from fastapi import APIRouter, Depends, WebSocket, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import Select
+from starlette.responses import StreamingResponse
 
-from src.client_api.gpt import message_to_gpt_stream
+from src.conf.settings import WS_SEND_BUFFER_BYTES
 from src.db.database import get_db
 from src.handlers.jwt_token import decode_token
-from src.models import ChatTopic
+from src.handlers.ws_stream import BoundedSender
+from src.models import ChatTopic, ChatMessage
 from src.routers.auth_routes import oauth2_scheme
 from src.schema.chat_schema import TopicOutput, TopicCreate, MessageCreate, ConversationData
-from src.schema.queries_params_schema import QueryParams, DataResponseModel
+from src.schema.queries_params_schema import QueryParams, DataResponseModel, ProjectionParams
+from src.schema.serializers import page_response
 from src.services.chat import get_topics, create_topic, create_message, get_topic_messages, get_user_topics, \
-    get_messages, get_recent_msg, create_message_socket
+    get_messages, get_recent_msg, create_message_socket, get_chat_topic, create_message_stream
+from src.services.chat_export import ExportFormat, export_query, export_messages, export_filename, \
+    export_media_types
+from src.services.chat_generation import start_generation, follow_generation
+from src.services.topic_broadcast import topic_broadcast, message_event, forward_events
 from src.utils.api_path import RoutePaths
+from src.utils.err_msg import err_msg
 
 chat_router = APIRouter(prefix=RoutePaths.ChatTopic.init)
 
@@ -23,7 +35,7 @@ chat_router = APIRouter(prefix=RoutePaths.ChatTopic.init)
 
 @chat_router.get(RoutePaths.ChatTopic.list, response_model=DataResponseModel[TopicOutput])
 async def list_topic(db: AsyncSession = Depends(get_db), queries: QueryParams = Depends()):
-    return await get_topics(db, queries)
+    return page_response(await get_topics(db, queries), ChatTopic)
 
 
 @chat_router.post(RoutePaths.ChatTopic.add, response_model=TopicOutput)
@@ -34,15 +46,23 @@ async def add_topic(topic_data: TopicCreate, db: AsyncSession = Depends(get_db))
 
 @chat_router.get(RoutePaths.ChatTopic.list_by_user, response_model=DataResponseModel[TopicOutput])
 async def list_topic_by_user(user_id: str, db: AsyncSession = Depends(get_db), queries: QueryParams = Depends()):
-    return await get_user_topics(db, queries, user_id)
+    return page_response(await get_user_topics(db, queries, user_id), ChatTopic)
+
+
+@chat_router.get(RoutePaths.ChatTopic.export_by_user)
+async def export_topics_by_user(user_id: int, fmt: Annotated[ExportFormat, Query(alias="format")] = "ndjson",
+                                gzip: bool = False):
+    """ Route stream messages of all topics created by user as a file """
+    return export_response(export_query(fmt, origin_user=user_id), fmt, gzip, f"user-{user_id}-topics")
 
 
 """ --- Message router handler """
 
 
 @chat_router.get(path=RoutePaths.ChatMessage.list)
-async def list_message(db: AsyncSession = Depends(get_db), queries: QueryParams = Depends()):
-    return await get_messages(db, queries)
+async def list_message(db: AsyncSession = Depends(get_db), queries: QueryParams = Depends(),
+                       projection: ProjectionParams = Depends()):
+    return page_response(await get_messages(db, queries, projection), ChatMessage)
 
 
 @chat_router.post(path=RoutePaths.ChatMessage.add)
@@ -61,14 +81,33 @@ async def add_message(token: Annotated[str, Depends(oauth2_scheme)], topic_id: i
     }
 
 
+@chat_router.post(path=RoutePaths.ChatMessage.add_stream)
+async def add_message_stream(token: Annotated[str, Depends(oauth2_scheme)], topic_id: int,
+                             message_data: MessageCreate, db: AsyncSession = Depends(get_db)):
+    """ Route to create a new message in a specific topic, stream reply as Server-Sent Events """
+    payload = decode_token(token)
+    if payload is None or not payload.user_id:
+        raise HTTPException(status_code=401, detail=f"access token {err_msg.invalid}")
+    topic = await get_chat_topic(db, topic_id)
+    if topic is None:
+        raise HTTPException(status_code=404, detail=f"topic {err_msg.not_found}")
+    return StreamingResponse(
+        create_message_stream(topic, payload.user_id, message_data.content),
+        media_type="text/event-stream",
+        # Disable proxy buffering so deltas reach the client as they arrive
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @chat_router.get(path=RoutePaths.ChatMessage.list_by_topic)
 async def list_specific_messages(
         topic_id: int,
         db: AsyncSession = Depends(get_db),
-        queries: QueryParams = Depends()
+        queries: QueryParams = Depends(),
+        projection: ProjectionParams = Depends()
 ):
     """ Route get all messages of a specific topic """
-    return await get_topic_messages(db, queries, topic_id)
+    return page_response(await get_topic_messages(db, queries, topic_id, projection=projection), ChatMessage)
 
 
 @chat_router.get(path=RoutePaths.ChatMessage.list_by_topic_user)
@@ -76,10 +115,29 @@ async def list_specific_messages(
         topic_id: int,
         user_id: int,
         db: AsyncSession = Depends(get_db),
-        queries: QueryParams = Depends()
+        queries: QueryParams = Depends(),
+        projection: ProjectionParams = Depends()
 ):
     """ Route get all messages of a specific topic by user id """
-    return await get_topic_messages(db, queries, topic_id, user_id)
+    return page_response(await get_topic_messages(db, queries, topic_id, user_id, projection), ChatMessage)
+
+
+@chat_router.get(path=RoutePaths.ChatMessage.export_by_topic)
+async def export_topic_messages(topic_id: int, fmt: Annotated[ExportFormat, Query(alias="format")] = "ndjson",
+                                gzip: bool = False, db: AsyncSession = Depends(get_db)):
+    """ Route stream all messages of a specific topic as a file """
+    if await get_chat_topic(db, topic_id) is None:
+        raise HTTPException(status_code=404, detail=f"topic {err_msg.not_found}")
+    return export_response(export_query(fmt, topic_id=topic_id), fmt, gzip, f"topic-{topic_id}")
+
+
+def export_response(stmt: Select, fmt: ExportFormat, compress: bool, name: str) -> StreamingResponse:
+    filename = export_filename(name, fmt, compress)
+    return StreamingResponse(
+        export_messages(stmt, fmt, compress),
+        media_type="application/gzip" if compress else export_media_types[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 @chat_router.websocket(path=RoutePaths.ChatMessage.socket)
@@ -87,17 +145,23 @@ async def test_socket_messages(
         websocket: WebSocket,
         topic_id: int,
         token: str,
+        resumable: bool = False,
         db: AsyncSession = Depends(get_db)
 ):
-    """ Route WebSocket allow get response real-time """
+    """
+    Route WebSocket allow get response real-time.
+    With resumable, frames are JSON with generation id and offsets, and a client that reconnects
+    sends {"resume": generation_id, "offset": offset} to get the rest of an answer.
+    Such connections also receive messages and replies of the topic made by other connections.
+    """
     print("WebSocket connection attempt")
 
+    sender = None
+    watch_queue = None
+    forward_task = None
     try:
         # Get topic by ID
-        topic = await db.get(ChatTopic, topic_id)
-        
-        # Get recent messages of topic
-        messages = await get_recent_msg(db, topic)
+        topic = await get_chat_topic(db, topic_id)
         
         # Decode payload token
         payload = decode_token(token)
@@ -106,42 +170,62 @@ async def test_socket_messages(
         
         # Start WebSocket connection
         await websocket.accept()
+        # Bounded send buffer of connection, slow client pauses reading of upstream stream
+        sender = BoundedSender(websocket.send_text, WS_SEND_BUFFER_BYTES)
+        connection_id = uuid.uuid4().hex
+        own_generations: set[str] = set()
+        if resumable:
+            # Watch topic, events of other connections on any worker are forwarded to this one
+            watch_queue = await topic_broadcast.subscribe(topic_id)
+            forward_task = asyncio.create_task(
+                forward_events(watch_queue, sender.put, connection_id, own_generations)
+            )
         
         # Stream messages in a loop
         while True:
             # Receive message from WebSocket
             data = await websocket.receive_json()
-            content = data.get("content")
-            
-            # Check content were provided
-            if content:
-                # Append user message to messages
-                messages.append({"role": "user", "content": content})
-                # Create a message in the database
-                await create_message_socket(db, topic_id, payload.user_id, content, "user")
-            
-            # Call OpenAI API to get assistant response
-            resp = message_to_gpt_stream(
-                messages,
-                topic.model,
-                topic.temperature,
-                topic.max_token,
-            )
-            # Init full assistant message
-            assistant_message = ""
-            # Loop through the response chunks
-            for chunk in resp:
-                assistant_response = chunk.choices[0].delta.content
-                # Concat message when response is not None
-                if assistant_response:
-                    assistant_message += assistant_response
-                # Send the response chunk to WebSocket
-                await websocket.send_text(f"{assistant_response}")
-            # Create assistant message in the database
-            await create_message_socket(db, topic_id, payload.user_id, assistant_message, "assistant")
+            generation_id = data.get("resume")
+            offset = int(data.get("offset") or 0)
+
+            if not generation_id:
+                content = data.get("content")
+
+                # Check content were provided
+                if content:
+                    # Create a message in the database
+                    msg = await create_message_socket(db, topic_id, payload.user_id, content, "user",
+                                                      topic.model)
+                    await topic_broadcast.publish(topic_id, message_event(msg, connection_id))
+
+                # Build token budgeted context of topic including the new user message
+                messages = await get_recent_msg(db, topic)
+
+                # Generate assistant response in background, it is stored even if connection drops
+                generation_id = await start_generation(topic, payload.user_id, messages)
+                own_generations.add(generation_id)
+                if resumable:
+                    await sender.put(json.dumps({"type": "start", "generation_id": generation_id}))
+            else:
+                own_generations.add(generation_id)
+
+            # Loop through generation deltas from its stream
+            async for frame in follow_generation(topic_id, generation_id, offset):
+                if resumable:
+                    await sender.put(json.dumps(frame, ensure_ascii=False))
+                elif frame["type"] == "delta":
+                    # Queue the response chunk to WebSocket
+                    await sender.put(frame["content"])
     except Exception as e:
         # Return None, close WebSocket connection and rollback the database transaction
         print(e)
+        if sender is not None:
+            sender.cancel()
         await db.rollback()
         await websocket.close()
         return
+    finally:
+        if forward_task is not None:
+            forward_task.cancel()
+        if watch_queue is not None:
+            await topic_broadcast.unsubscribe(topic_id, watch_queue)
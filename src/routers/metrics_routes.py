@@ -0,0 +1,80 @@
+from fastapi import APIRouter
+
+from src.client_api.gpt import scheduler_stats, gpt_pool, provider_stats
+from src.db.database import route_stats, replica_engines
+from src.db.pool_metrics import pool_metrics
+from src.services.chat import window_cache
+from src.services.chat_writer import chat_writer
+from src.services.generic_services import query_plans
+from src.services.semantic_cache import semantic_cache
+from src.services.single_flight import single_flight_stats
+from src.services.topic_broadcast import topic_broadcast
+from src.utils.api_path import RoutePaths
+
+metrics_router = APIRouter(prefix=RoutePaths.Metrics.init, tags=["Metrics"])
+
+
+@metrics_router.get(path=RoutePaths.Metrics.chat_window)
+async def chat_window_metrics():
+    """ Hit and miss counters of the conversation window cache of this worker """
+    return window_cache.stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.chat_writer)
+async def chat_writer_metrics():
+    """ Queue and flush counters of write-behind persistence of this worker """
+    return chat_writer.stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.single_flight)
+async def single_flight_metrics():
+    """ Upstream calls saved by single-flight, for this worker and all workers """
+    return await single_flight_stats.snapshot()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.llm_scheduler)
+async def llm_scheduler_metrics():
+    """ Queue wait time of upstream calls by model and priority lane of this worker """
+    return scheduler_stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.llm_endpoints)
+async def llm_endpoints_metrics():
+    """ Load, errors and circuit state of upstream endpoints, and hedged requests of this worker """
+    return gpt_pool.stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.llm_providers)
+async def llm_providers_metrics():
+    """ Calls and errors by LLM provider of this worker """
+    return provider_stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.topic_fanout)
+async def topic_fanout_metrics():
+    """ Watched topics and fanned out events of this worker """
+    return topic_broadcast.stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.semantic_cache)
+async def semantic_cache_metrics():
+    """ Hit rate, sampled false positives and index memory of the semantic cache of this worker """
+    return semantic_cache.stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.query_plans)
+async def query_plans_metrics():
+    """ Reused statements of list requests of this worker """
+    return query_plans.stats()
+
+
+@metrics_router.get(path=RoutePaths.Metrics.db_routing)
+async def db_routing_metrics():
+    """ Requests served by primary, replica, or primary after a recent write of the user on this worker """
+    return {"replicas": len(replica_engines), **route_stats}
+
+
+@metrics_router.get(path=RoutePaths.Metrics.db_pool)
+async def db_pool_metrics():
+    """ Checked out connections, overflow and checkout wait time of each database pool of this worker """
+    return [metrics.stats() for metrics in pool_metrics.values()]
@@ -2,7 +2,9 @@ from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.db.database import get_db
+from src.models import Permission
 from src.schema.queries_params_schema import QueryParams, DataResponseModel
+from src.schema.serializers import page_response
 from src.services.perm_services import get_perms
 from src.utils.api_path import RoutePaths
 
@@ -13,4 +15,4 @@ perm_router = APIRouter(prefix=RoutePaths.Permission.init, tags=["Permissions"])
 async def list_perms(db: AsyncSession = Depends(get_db), params: QueryParams = Depends(QueryParams)):
     perms = await get_perms(db, params)
     # Placeholder for the actual implementation
-    return perms
+    return page_response(perms, Permission)
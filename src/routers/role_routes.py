@@ -5,6 +5,7 @@ from src.db.database import get_db
 from src.models import Role
 from src.schema.queries_params_schema import QueryParams, DataResponseModel
 from src.schema.role_schema import RoleOutput, RoleCreate
+from src.schema.serializers import page_response
 from src.services.generic_services import get_all
 from src.services.role_services import create_role
 from src.utils.api_path import RoutePaths
@@ -15,7 +16,7 @@ role_router = APIRouter(prefix=RoutePaths.Role.init, tags=["Roles"])
 @role_router.get(path=RoutePaths.Role.list, response_model=DataResponseModel[RoleOutput])
 async def list_roles(db: AsyncSession = Depends(get_db), params: QueryParams = Depends()):
     roles = await get_all(db, Role, params)
-    return roles
+    return page_response(roles, Role)
 
 @role_router.post(path=RoutePaths.Role.add, response_model=RoleOutput)
 async def add_role(role: RoleCreate, db: AsyncSession = Depends(get_db)):
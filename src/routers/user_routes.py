@@ -2,7 +2,9 @@ from fastapi import APIRouter, Depends, status, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.db.database import get_db
+from src.models import Users
 from src.schema.queries_params_schema import QueryParams, DataResponseModel
+from src.schema.serializers import page_response, item_response
 from src.schema.user_schema import UserCreate, UserOutput, UserSelfUpdate, ChangePassword
 from src.services.user_services import get_users, create_user, get_user, update_user, delete_user, change_password
 from src.utils.api_path import RoutePaths
@@ -14,7 +16,7 @@ user_router = APIRouter(prefix=RoutePaths.Users.init, tags=["Users"])
 @user_router.get(path=RoutePaths.Users.list, response_model=DataResponseModel[UserOutput])
 async def list_user(params: QueryParams = Depends(), db: AsyncSession = Depends(get_db)):
     users = await get_users(db, params)
-    return users
+    return page_response(users, Users)
 
 
 @user_router.post(path=RoutePaths.Users.add, response_model=UserOutput, status_code=status.HTTP_201_CREATED)
@@ -27,7 +29,7 @@ async def retrieve_user(user_id: int, db: AsyncSession = Depends(get_db)):
     user = await get_user(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return item_response(user, Users)
 
 
 @user_router.put(path=RoutePaths.Users.edit, response_model=UserOutput)
@@ -12,6 +12,11 @@ class TopicCreate(BaseModel):
     temperature: float
     max_token: int
     max_msg_retrieve: Optional[int]
+    compaction_enabled: bool = False
+    compaction_threshold: Optional[int] = None
+    cache_enabled: bool = False
+    single_flight_enabled: bool = False
+    semantic_cache_enabled: bool = False
     
     notes: Optional[str]
     origin_user: int
@@ -40,6 +45,11 @@ class TopicOutput(BaseModel):
     temperature: float
     max_token: int
     max_msg_retrieve: int
+    compaction_enabled: bool = False
+    compaction_threshold: Optional[int] = None
+    cache_enabled: bool = False
+    single_flight_enabled: bool = False
+    semantic_cache_enabled: bool = False
     notes: Optional[str]
     origin_user: Optional[int]
 
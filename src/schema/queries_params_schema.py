@@ -1,4 +1,4 @@
-from typing import Optional, Generic, TypeVar, List
+from typing import Optional, Generic, TypeVar, List, Literal
 
 from pydantic import BaseModel, Field
 from pydantic.generics import GenericModel
@@ -12,6 +12,13 @@ class QueryParams(BaseModel):
     order_by: Optional[str] = Field(None, description="Field to sort by")
     filter: Optional[str] = Field(None, description="Filter criteria in JSON format")
     strict: bool = Field(default=False, description="Whether to apply strict filtering")
+    substring: bool = Field(default=False, description="Search by substring instead of full-text index")
+    paginate: Literal["offset", "keyset"] = Field(default="offset", description="Pagination by page or by cursor")
+    cursor: Optional[str] = Field(None, description="next_cursor or prev_cursor of a previous keyset page")
+    count: Optional[Literal["exact", "estimated", "cached", "none"]] = Field(
+        None, description="How total is counted, default depends on the table"
+    )
+    expand: Optional[str] = Field(None, description="Comma separated relations to include, e.g. roles,roles.permissions")
 
     class Config:
         schema_extra = {
@@ -22,14 +29,25 @@ class QueryParams(BaseModel):
         }
 
 
+# Schema for column projection of list endpoints whose items have no fixed response model
+class ProjectionParams(BaseModel):
+    fields: Optional[str] = Field(None, description="Comma separated columns to return, id is always included")
+    preview: Optional[int] = Field(None, ge=1, description="Cut long text columns to this many characters")
+
+
 T = TypeVar("T")
 
 
 class DataResponseModel(GenericModel, Generic[T]):
     data: List[T]
-    total: int
+    total: Optional[int]
+    # Total is a planner estimate, e.g. default count of big tables
+    total_estimated: bool = False
     page: int
     limit: int
+    has_more: bool = False
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -0,0 +1,145 @@
+"""
+Serializers of models, built once from MODEL_REGISTRY.
+A serializer reads the fields of the response schema of its model with one attrgetter, the dicts it makes
+are encoded as they are by ORJSONResponse, so routes skip the second validation of response_model.
+"""
+import operator
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Type
+
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, TypeAdapter
+
+from src.conf.settings import RESPONSE_VALIDATION
+from src.models import MODEL_REGISTRY
+from src.schema.chat_schema import TopicOutput
+from src.schema.role_schema import RoleOutput
+from src.schema.user_schema import UserOutput
+
+# Response schema by model name, models without one return all columns
+output_schemas: Dict[str, Type[BaseModel]] = {
+    "Users": UserOutput,
+    "Role": RoleOutput,
+    "ChatTopic": TopicOutput,
+}
+
+# Relations that expand= may load by model name, with the fields returned for each relation path
+expand_fields: Dict[str, Dict[str, List[str]]] = {
+    "Users": {
+        "roles": ["id", "name", "group", "is_active"],
+        "roles.permissions": ["id", "name", "model_name", "object_pk"],
+    },
+    "Role": {
+        "permissions": ["id", "name", "description", "model_name", "object_pk"],
+        "users": ["id", "username"],
+    },
+    "Permission": {
+        "roles": ["id", "name"],
+    },
+    "ChatMessage": {
+        "topic": ["id", "name", "model"],
+        "user": ["id", "username"],
+    },
+}
+
+
+def expand_tree(paths: Iterable[str]) -> Dict[str, dict]:
+    """ Nest relation paths, roles and roles.permissions become {"roles": {"permissions": {}}} """
+    tree: Dict[str, dict] = {}
+    for path in paths:
+        node = tree
+        for rel in path.split('.'):
+            node = node.setdefault(rel, {})
+    return tree
+
+
+@lru_cache(maxsize=None)
+def relation_getter(model_name: str, path: str) -> tuple[List[str], operator.attrgetter]:
+    fields = expand_fields[model_name][path]
+    return fields, operator.attrgetter(*fields)
+
+
+def expanded(obj, model_name: str, tree: Dict[str, dict], prefix: str = "") -> Dict[str, Any]:
+    """ Whitelisted fields of relations of obj loaded by expand, nested like tree """
+    data = {}
+    for rel, children in tree.items():
+        path = prefix + rel
+        fields, get = relation_getter(model_name, path)
+
+        def to_dict(item) -> Dict[str, Any]:
+            values = get(item)
+            item_data = dict(zip(fields, (values,) if len(fields) == 1 else values))
+            if children:
+                item_data.update(expanded(item, model_name, children, path + "."))
+            return item_data
+
+        value = getattr(obj, rel)
+        if isinstance(value, list):
+            data[rel] = [to_dict(item) for item in value]
+        else:
+            data[rel] = to_dict(value) if value is not None else None
+    return data
+
+
+class ModelSerializer:
+    """ Cached getter of response fields of a model, and adapter validating them when enabled """
+
+    def __init__(self, model, schema: Optional[Type[BaseModel]] = None):
+        self.name = model.__name__
+        columns = model.__table__.columns.keys()
+        if schema is None:
+            self.fields = list(columns)
+            self.defaults = {}
+        else:
+            self.fields = [name for name in schema.model_fields if name in columns]
+            # Schema fields that are not columns keep their default
+            self.defaults = {name: field.default for name, field in schema.model_fields.items()
+                             if name not in columns and not field.is_required()}
+        self._get = operator.attrgetter(*self.fields)
+        self._single = len(self.fields) == 1
+        self.adapter = TypeAdapter(List[schema]) if schema is not None else None
+
+    def one(self, obj) -> Dict[str, Any]:
+        values = self._get(obj)
+        data = dict(zip(self.fields, (values,) if self._single else values))
+        if self.defaults:
+            data.update(self.defaults)
+        return data
+
+    def many(self, objs: Iterable, expand: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        if expand:
+            tree = expand_tree(expand)
+            return [{**self.one(obj), **expanded(obj, self.name, tree)} for obj in objs]
+        if self._single or self.defaults:
+            return [self.one(obj) for obj in objs]
+        fields, get = self.fields, self._get
+        return [dict(zip(fields, get(obj))) for obj in objs]
+
+    def check(self, items: List[Dict[str, Any]]) -> None:
+        """ Validate items against the response schema, only when RESPONSE_VALIDATION is on """
+        if RESPONSE_VALIDATION and self.adapter is not None:
+            self.adapter.validate_python(items)
+
+
+serializers = {model: ModelSerializer(model, output_schemas.get(name)) for name, model in MODEL_REGISTRY.items()}
+
+
+def serializer_of(model) -> ModelSerializer:
+    """ Serializer of model, made on first use for models out of MODEL_REGISTRY """
+    serializer = serializers.get(model)
+    if serializer is None:
+        serializer = serializers[model] = ModelSerializer(model)
+    return serializer
+
+
+def page_response(page: Dict[str, Any], model) -> ORJSONResponse:
+    """ Response of a get_all page, its items are already serialized """
+    serializer_of(model).check(page["data"])
+    return ORJSONResponse(page)
+
+
+def item_response(obj, model, status_code: int = 200) -> ORJSONResponse:
+    """ Response of one model object """
+    data = serializer_of(model).one(obj)
+    serializer_of(model).check([data])
+    return ORJSONResponse(data, status_code=status_code)
@@ -0,0 +1,66 @@
+"""
+Benchmark serialization of a 100 row list page.
+Compare the response_model path (dict per row, DataResponseModel validation, jsonable_encoder and json)
+with the serializer registry and ORJSONResponse.
+Run: python -m src.scripts.bench_serializers
+"""
+import timeit
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from src.models import ChatTopic, ChatMessage, Users
+from src.schema.chat_schema import TopicOutput
+from src.schema.queries_params_schema import DataResponseModel
+from src.schema.serializers import serializer_of, page_response
+from src.schema.user_schema import UserOutput
+
+ROWS = 100
+NUMBER = 200
+
+
+def make_rows(model):
+    now = datetime.now()
+    if model is ChatTopic:
+        return [ChatTopic(id=i, name=f"topic {i}", description="description " * 10, model="gpt-4o-mini",
+                          system_prompt="You are a helpful assistant.", temperature=0.7, max_token=1024,
+                          max_msg_retrieve=20, compaction_enabled=False, cache_enabled=True,
+                          single_flight_enabled=False, semantic_cache_enabled=False, notes=None, origin_user=1)
+                for i in range(ROWS)]
+    if model is ChatMessage:
+        return [ChatMessage(id=i, topic_id=1, user_id=1, role="user" if i % 2 else "assistant",
+                            content="Lorem ipsum dolor sit amet. " * 40, token_count=280, created_at=now)
+                for i in range(ROWS)]
+    return [Users(id=i, username=f"user{i}", email=f"user{i}@example.com", password="x" * 60, is_active=True,
+                  created_at=now) for i in range(ROWS)]
+
+
+def page_of(data) -> dict:
+    return {"data": data, "total": 1000, "total_estimated": False, "page": 1, "limit": ROWS,
+            "has_more": True, "next_cursor": None, "prev_cursor": None}
+
+
+def before(model, schema, rows) -> bytes:
+    """ Previous path of a list route with response_model """
+    data = [{c.key: getattr(obj, c.key) for c in model.__table__.columns} for obj in rows]
+    response_model = DataResponseModel[schema] if schema is not None else DataResponseModel
+    validated = response_model.model_validate(page_of(data))
+    return JSONResponse(jsonable_encoder(validated)).body
+
+
+def after(model, rows) -> bytes:
+    return page_response(page_of(serializer_of(model).many(rows)), model).body
+
+
+def main():
+    for model, schema in ((ChatTopic, TopicOutput), (ChatMessage, None), (Users, UserOutput)):
+        rows = make_rows(model)
+        old = min(timeit.repeat(lambda: before(model, schema, rows), number=NUMBER, repeat=5)) / NUMBER
+        new = min(timeit.repeat(lambda: after(model, rows), number=NUMBER, repeat=5)) / NUMBER
+        print(f"{model.__name__:<12} before {old * 1e6:9.1f} us  after {new * 1e6:9.1f} us  "
+              f"speedup {old / new:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
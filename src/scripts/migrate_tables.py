@@ -1,15 +1,50 @@
+"""
+Create tables of models and bring tables of an older version up to date.
+create_all skips tables that exist, columns added to models later are added by add_missing_columns.
+Run: python -m src.scripts.migrate_tables
+"""
 import asyncio
 
+from sqlalchemy import Column, Table, inspect, literal, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
 from src.db.database import Base, engine
+from src.db.fulltext import create_fulltext_indexes
+
+
+def missing_columns(sync_conn) -> list[tuple[Table, Column]]:
+    """ Model columns that existing tables do not have yet """
+    inspector = inspect(sync_conn)
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend((table, column) for column in table.columns if column.name not in existing)
+    return missing
+
+
+async def add_missing_columns(conn: AsyncConnection) -> None:
+    """ Add missing columns as nullable, rows already stored get the scalar default of the model """
+    for table, column in await conn.run_sync(missing_columns):
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+        default = column.default
+        if default is not None and default.is_scalar:
+            value = literal(default.arg, column.type).compile(dialect=conn.dialect,
+                                                              compile_kwargs={"literal_binds": True})
+            ddl += f" DEFAULT {value}"
+        await conn.execute(text(ddl))
 
 
 async def create_tables():
     from src.models.chat import ChatTopic, ChatMessage
     from src.models.users import Users
     from src.models.auth import RefreshToken
-    
+
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await add_missing_columns(conn)
+        await create_fulltext_indexes(conn)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,41 @@
-from typing import Literal
+import json
+import uuid
+from typing import Literal, AsyncIterator
 
 from sqlalchemy import select, desc
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from starlette.responses import JSONResponse
 
-from src.client_api.gpt import message_to_gpt
-from src.conf.settings import DEBUG
+from src.client_api.gpt import message_to_gpt, message_to_gpt_stream
+from src.conf.settings import DEBUG, CONTEXT_FETCH_BATCH, WINDOW_CACHE_TOPICS, WINDOW_CACHE_MESSAGES, \
+    WINDOW_CACHE_TTL, WS_COALESCE_BYTES, WS_COALESCE_MS
+from src.db.database import get_db_instance
 from src.handlers.jwt_token import decode_token
 from src.handlers.perm import generate_perm
+from src.handlers.token_count import count_message_tokens, count_tokens, context_budget, tokens_reply_priming
+from src.handlers.ws_stream import coalesce
 from src.models import ChatTopic, ChatMessage, Permission, Role, Users
 from src.schema.auth_schema import TokenPayload
 from src.schema.chat_schema import TopicCreate, TopicUpdate, ConversationData
-from src.schema.queries_params_schema import QueryParams
+from src.schema.queries_params_schema import QueryParams, ProjectionParams
+from src.services.chat_compaction import schedule_compaction, summary_message
+from src.services.chat_window_cache import ConversationWindowCache, WindowMessage, within_budget
+from src.services.chat_writer import chat_writer
 from src.services.generic_services import get_all
 from src.services.perm_services import create_main_perms
+from src.services.response_cache import prompt_hash, get_cached_response, set_cached_response, replay_stream
+from src.services.semantic_cache import semantic_cache, SemanticMatch, last_user_prompt
+from src.services.single_flight import single_flight
+from src.services.topic_broadcast import topic_broadcast, message_event
 from src.utils.err_msg import err_msg
+from src.utils.gpt_model import gpt_dmodel
+from src.utils.logs import debug_log
 from src.utils.perm_actions import actions
 
+# Recent topics and messages of this worker, saves a query per chat turn on hot topics
+window_cache = ConversationWindowCache(WINDOW_CACHE_TOPICS, WINDOW_CACHE_MESSAGES, WINDOW_CACHE_TTL)
+
 
 async def get_topics(db: AsyncSession, queries: QueryParams):
     """
@@ -30,8 +48,7 @@ async def get_user_topics(db: AsyncSession, queries: QueryParams, user_id: str):
     """
         Function to fetching chat topics of specific user and searching by queries from the database.
     """
-    return await get_all(db, ChatTopic, queries,
-                         external_query=select(ChatTopic).filter(ChatTopic.origin_user == user_id))
+    return await get_all(db, ChatTopic, queries, where={"origin_user": user_id})
 
 
 async def create_topic(db: AsyncSession, topic_data: TopicCreate):
@@ -100,7 +117,7 @@ async def get_topic(db: AsyncSession, topic_id: int):
 async def update_topic(db: AsyncSession, topic_data: TopicUpdate, topic_id: int):
     """ Function update topic except system_prompt and first meet greeting """
     # Get topic by id
-    topic = db.get(ChatTopic, topic_id)
+    topic = await db.get(ChatTopic, topic_id)
     # Return error if not found
     if topic is None:
         return err_msg.not_found
@@ -115,24 +132,26 @@ async def update_topic(db: AsyncSession, topic_data: TopicUpdate, topic_id: int)
     # Commit change to db
     await db.commit()
     await db.refresh(topic)
+    # Drop stale copy of topic kept for chat turns, on this worker and the others
+    window_cache.invalidate(topic_id)
+    await topic_broadcast.invalidate(topic_id)
     return topic
 
 
 """ --- Conversation Service --- """
 
 
-async def get_messages(db: AsyncSession, queries: QueryParams):
+async def get_messages(db: AsyncSession, queries: QueryParams, projection: ProjectionParams | None = None):
     """
         Function to fetching chat conversations and searching by queries from the database.
     """
-    return await get_all(db, ChatMessage, queries)
+    return await get_all(db, ChatMessage, queries, projection=projection)
 
 
-async def get_topic_messages(db: AsyncSession, queries: QueryParams, topic_id: int, user_id: int = 0):
-    stmt = select(ChatMessage)
-    query = (stmt.filter(ChatMessage.topic_id == topic_id) if user_id == 0
-             else stmt.filter(ChatMessage.topic_id == topic_id, ChatMessage.user_id == user_id))
-    result = await get_all(db, ChatMessage, queries, external_query=query)
+async def get_topic_messages(db: AsyncSession, queries: QueryParams, topic_id: int, user_id: int = 0,
+                             projection: ProjectionParams | None = None):
+    where = {"topic_id": topic_id} if user_id == 0 else {"topic_id": topic_id, "user_id": user_id}
+    result = await get_all(db, ChatMessage, queries, where=where, projection=projection)
     return result
 
 
@@ -142,57 +161,304 @@ async def create_message(db: AsyncSession, conversation_data: ConversationData):
     payload: TokenPayload = decode_token(conversation_data.token)
 
     # Get topic
-    topic: ChatTopic | None = await db.get(ChatTopic, conversation_data.topic_id)
+    topic: ChatTopic | None = await get_chat_topic(db, conversation_data.topic_id)
     if topic is None:
         return "topic " + err_msg.not_found
 
     # Create message by user
-    msg = await create_message_socket(db, topic.id, payload.user_id, conversation_data.content, "user")
-    await db.refresh(msg)
+    user_msg = await create_message_socket(db, topic.id, payload.user_id, conversation_data.content, "user",
+                                           topic.model)
+    await topic_broadcast.publish(topic.id, message_event(user_msg))
 
     messages = await get_recent_msg(db, topic)
 
-    assistant_content = message_to_gpt(
+    assistant_content = await generate_reply(topic, messages)
+
+    assistant_msg = await create_message_socket(db, topic.id, payload.user_id, assistant_content, "assistant",
+                                                topic.model)
+    await topic_broadcast.publish(topic.id, message_event(assistant_msg))
+    # Fold old messages into topic summary in background
+    schedule_compaction(topic)
+
+    return assistant_content
+
+
+def sse_event(event: str, data: dict) -> str:
+    """ Format one Server-Sent Event """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def create_message_stream(topic: ChatTopic, user_id: int, content: str) -> AsyncIterator[str]:
+    """ Function to conversation with AI, stream reply deltas as Server-Sent Events """
+    # Own session, the request session is closed before a streaming response is sent
+    db = await get_db_instance(user_id)
+    try:
+        # Create message by user
+        user_msg = await create_message_socket(db, topic.id, user_id, content, "user", topic.model)
+        await topic_broadcast.publish(topic.id, message_event(user_msg))
+
+        messages, prompt_tokens = await build_context(db, topic)
+
+        # Watchers of topic on other connections get the deltas too
+        generation_id = uuid.uuid4().hex
+        assistant_content = ""
+        deltas = generate_reply_stream(topic, messages)
+        async for delta in coalesce(deltas, WS_COALESCE_BYTES, WS_COALESCE_MS / 1000):
+            assistant_content += delta
+            yield sse_event("delta", {"content": delta})
+            await topic_broadcast.publish(topic.id, {
+                "type": "delta", "generation_id": generation_id, "content": delta, "offset": len(assistant_content)
+            })
+
+        assistant_msg = await create_message_socket(db, topic.id, user_id, assistant_content, "assistant",
+                                                    topic.model)
+        await topic_broadcast.publish(topic.id, {
+            "type": "done", "generation_id": generation_id, "message_id": assistant_msg.id,
+            "offset": len(assistant_content)
+        })
+        # Fold old messages into topic summary in background
+        schedule_compaction(topic)
+
+        # Token count of stored message includes the chat format overhead, the reply is its content only
+        completion_tokens = count_tokens(assistant_content, topic.model)
+        yield sse_event("done", {
+            "user_message_id": user_msg.id,
+            "assistant_message_id": assistant_msg.id,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+    except Exception as e:
+        await db.rollback()
+        debug_log(f"Error when streaming message of topic {topic.id}: \n{e}")
+        yield sse_event("error", {"detail": err_msg.unexpected})
+    finally:
+        await db.close()
+
+
+def reply_key(topic: ChatTopic, messages: list[dict]) -> str:
+    """ Key of response cache and single-flight, the newest user prompt asked with the same model and system prompt """
+    return prompt_hash(last_user_prompt(messages), topic.system_prompt, topic.model, topic.temperature,
+                       topic.max_token)
+
+
+async def generate_reply(topic: ChatTopic, messages: list[dict]) -> str:
+    """ Function get full assistant reply, identical concurrent requests share it when enabled on topic """
+    key = reply_key(topic, messages)
+
+    async def produce():
+        yield await reply_of(topic, messages, key)
+
+    # Followers of a flight skip the cache lookups too
+    deltas = single_flight(key, produce) if topic.single_flight_enabled else produce()
+    return "".join([delta async for delta in deltas])
+
+
+async def reply_of(topic: ChatTopic, messages: list[dict], key: str) -> str:
+    """ Function get full assistant reply, served from response cache when enabled on topic """
+    if topic.cache_enabled:
+        cached = await get_cached_response(key)
+        if cached is not None:
+            return cached
+
+    # Reply of a near-duplicate question of topic
+    match = await semantic_lookup(topic, messages)
+    if match is not None and match.reply is not None:
+        semantic_cache.sample(topic, messages, match.reply)
+        return match.reply
+
+    content = await message_to_gpt(
         messages=messages,
         model=topic.model,
         temperature=topic.temperature,
         max_tokens=topic.max_token
     )
 
-    await create_message_socket(db, topic.id, payload.user_id, assistant_content, "assistant")
-
-    return assistant_content
+    if topic.cache_enabled:
+        await set_cached_response(key, content)
+    if match is not None:
+        await semantic_cache.add(topic.id, match.vector, content)
+    return content
+
+
+async def generate_reply_stream(topic: ChatTopic, messages: list[dict]) -> AsyncIterator[str]:
+    """ Function stream assistant reply by deltas, identical concurrent requests share it when enabled on topic """
+    key = reply_key(topic, messages)
+
+    def produce():
+        return reply_stream_of(topic, messages, key)
+
+    # Followers of a flight skip the cache lookups too
+    deltas = single_flight(key, produce) if topic.single_flight_enabled else produce()
+    async for delta in deltas:
+        yield delta
+
+
+async def reply_stream_of(topic: ChatTopic, messages: list[dict], key: str) -> AsyncIterator[str]:
+    """ Function stream assistant reply by deltas, cached reply is replayed chunk by chunk """
+    if topic.cache_enabled:
+        cached = await get_cached_response(key)
+        if cached is not None:
+            async for chunk in replay_stream(cached):
+                yield chunk
+            return
+
+    # Reply of a near-duplicate question of topic
+    match = await semantic_lookup(topic, messages)
+    if match is not None and match.reply is not None:
+        semantic_cache.sample(topic, messages, match.reply)
+        async for chunk in replay_stream(match.reply):
+            yield chunk
+        return
+
+    content = ""
+    async for delta in message_to_gpt_stream(messages, topic.model, topic.temperature, topic.max_token):
+        content += delta
+        yield delta
+
+    # Only complete replies are cached
+    if topic.cache_enabled:
+        await set_cached_response(key, content)
+    if match is not None:
+        await semantic_cache.add(topic.id, match.vector, content)
+
+
+async def semantic_lookup(topic: ChatTopic, messages: list[dict]) -> SemanticMatch | None:
+    """ Search semantic cache of topic by newest user prompt, None when disabled on topic or on error """
+    if not topic.semantic_cache_enabled:
+        return None
+    prompt = last_user_prompt(messages)
+    if not prompt:
+        return None
+    try:
+        return await semantic_cache.lookup(topic.id, prompt)
+    except Exception as e:
+        # Broken index or embedding call counts as a miss, the reply comes from upstream
+        debug_log(f"Error when searching semantic cache of topic {topic.id}: \n{e}")
+        return None
 
 
 async def get_recent_msg(db: AsyncSession, topic: ChatTopic):
     """ Function get recent message of topic """
+    messages, _ = await build_context(db, topic)
+    return messages
+
+
+async def build_context(db: AsyncSession, topic: ChatTopic) -> tuple[list[dict], int]:
+    """ Function build context of topic, fill model token budget with newest messages first, return prompt tokens """
     messages = []
+    total = context_budget(topic.model, topic.max_token)
+    budget = total
+    # Always keep system prompt
     if topic.system_prompt:
         messages.append({"role": "system", "content": topic.system_prompt})
-    # Query recent messages with limit
-    result = await db.execute(
-        select(ChatMessage)
-        .where(ChatMessage.topic_id == topic.id)
-        .order_by(desc(ChatMessage.created_at))
-        .limit(topic.max_msg_retrieve * 2)
-    )
-    last_msgs = result.scalars().all()
-    # Reverse response of database
-    last_msgs.reverse()
-    for m in last_msgs:
-        messages.append({"role": m.role, "content": m.content})
-    return messages
+        budget -= count_message_tokens("system", topic.system_prompt, topic.model)
+
+    # Prepend running summary, only messages after it are retrieved
+    summary_until_id = 0
+    if topic.compaction_enabled:
+        summary = (await db.execute(
+            select(ChatTopic.summary, ChatTopic.summary_until_id, ChatTopic.summary_token_count)
+            .where(ChatTopic.id == topic.id)
+        )).one()
+        if summary.summary:
+            messages.append(summary_message(summary.summary))
+            budget -= summary.summary_token_count or 0
+            summary_until_id = summary.summary_until_id or 0
+
+    # Use recent messages kept in memory, fall back to database
+    window_cache.check(topic.id)
+    history = window_cache.recent(topic.id, summary_until_id, budget)
+    if history is None:
+        history = await fetch_recent_msg(db, topic, summary_until_id, budget)
+
+    # Reverse newest first history to chronological order
+    history.reverse()
+    messages.extend({"role": m.role, "content": m.content} for m in history)
+    prompt_tokens = total - budget + sum(m.token_count for m in history) + tokens_reply_priming
+    return messages, prompt_tokens
+
+
+async def fetch_recent_msg(db: AsyncSession, topic: ChatTopic, after_id: int, budget: int) -> list[WindowMessage]:
+    """ Function query newest messages of topic within token budget and keep them in window cache """
+    window_cache.reserve(topic.id)
+    rows: list[WindowMessage] = []
+    used = 0
+    exhausted = False
+    while used <= budget:
+        # Query only needed columns of next batch of older messages
+        stmt = (
+            select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.token_count)
+            .where(ChatMessage.topic_id == topic.id, ChatMessage.id > after_id)
+            .order_by(desc(ChatMessage.id))
+            .limit(CONTEXT_FETCH_BATCH)
+        )
+        if rows:
+            stmt = stmt.where(ChatMessage.id < rows[-1].id)
+        batch = (await db.execute(stmt)).all()
+
+        for row in batch:
+            # Messages stored before token counting were added are counted on the fly
+            tokens = row.token_count
+            if tokens is None:
+                tokens = count_message_tokens(row.role, row.content, topic.model)
+            rows.append(WindowMessage(row.id, row.role, row.content, tokens))
+            used += tokens
+
+        # Stop when history is exhausted
+        if len(batch) < CONTEXT_FETCH_BATCH:
+            exhausted = True
+            break
+
+    # Add messages of topic still waiting in write-behind queue
+    pending = chat_writer.pending(topic.id)
+    if pending:
+        known = {m.id for m in rows}
+        rows.extend(m for m in pending if m.id > after_id and m.id not in known)
+        rows.sort(key=lambda m: m.id, reverse=True)
+
+    if exhausted:
+        window_cache.fill(topic.id, rows, after_id)
+    elif rows:
+        window_cache.fill(topic.id, rows, rows[-1].id - 1)
+    return within_budget(rows, budget)
+
+
+async def get_chat_topic(db: AsyncSession, topic_id: int) -> ChatTopic | None:
+    """ Function get topic for a chat turn, served from window cache when possible """
+    topic = window_cache.get_topic(topic_id)
+    if topic is None:
+        topic = await db.get(ChatTopic, topic_id)
+        if topic is None:
+            return None
+        # Detach topic so it can be shared by later requests
+        db.expunge(topic)
+        window_cache.set_topic(topic)
+    return topic
 
 
 async def create_message_socket(db: AsyncSession, topic_id: int, user_id: int, content: str,
-                                role: Literal["user", "assistant"]):
+                                role: Literal["user", "assistant"], model: str = gpt_dmodel):
     """ Function to create message by socket """
-    msg = ChatMessage(
-        user_id=user_id,
-        topic_id=topic_id,
-        role=role,
-        content=content
-    )
-    db.add(msg)
-    await db.commit()
+    token_count = count_message_tokens(role, content, model)
+    if chat_writer.running:
+        # Queue message for batched insert, the caller does not wait for the flush.
+        # Its id must follow the newest message of topic, which may come from a block of another worker
+        msg = ChatMessage(**await chat_writer.add(user_id, topic_id, role, content, token_count,
+                                                  window_cache.newest_id(topic_id)))
+    else:
+        msg = ChatMessage(
+            user_id=user_id,
+            topic_id=topic_id,
+            role=role,
+            content=content,
+            token_count=token_count
+        )
+        db.add(msg)
+        await db.commit()
+    # Keep new message in window of topic, windows of other workers are dropped on its announcement
+    window_cache.append(topic_id, WindowMessage(msg.id, role, content, msg.token_count))
+    await topic_broadcast.announce_message(topic_id, msg.id)
     return msg
@@ -0,0 +1,160 @@
+"""
+Rolling summarization of long chat topics.
+Older messages are folded into a running summary stored on the topic, off the request path.
+"""
+import asyncio
+
+from sqlalchemy import select, desc, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.client_api.gpt import message_to_gpt, Priority
+from src.conf.settings import (COMPACTION_THRESHOLD_TOKENS, COMPACTION_KEEP_TOKENS, COMPACTION_BATCH,
+                               COMPACTION_MODEL, COMPACTION_SUMMARY_MAX_TOKENS, CONTEXT_FETCH_BATCH)
+from src.db.database import get_db_instance
+from src.db.redisdb import redis_client, compaction_lock
+from src.handlers.token_count import count_message_tokens
+from src.models import ChatTopic, ChatMessage
+from src.utils.logs import debug_log
+
+# Seconds a worker holds the compaction lock of a topic
+LOCK_TIMEOUT = 300
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the existing summary with the new messages into one updated summary. "
+    "Keep facts, decisions, names, numbers and open questions; drop greetings and filler. "
+    "Answer with the summary only."
+)
+
+# Keep references of running tasks, so they are not garbage collected
+_running_tasks: dict[int, asyncio.Task] = {}
+
+
+def summary_message(summary: str) -> dict:
+    """ Build the chat message carrying the running summary of a topic """
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}
+
+
+def schedule_compaction(topic: ChatTopic) -> None:
+    """ Start compaction of topic in background if it is enabled and not already running """
+    if not topic.compaction_enabled:
+        return
+    task = _running_tasks.get(topic.id)
+    if task is not None and not task.done():
+        return
+    task = asyncio.create_task(compact_topic(topic.id))
+    _running_tasks[topic.id] = task
+    task.add_done_callback(lambda t, topic_id=topic.id: _running_tasks.pop(topic_id, None))
+
+
+def compaction_threshold(topic: ChatTopic) -> int:
+    """ Tokens of unsummarized history above which topic is compacted """
+    return topic.compaction_threshold or COMPACTION_THRESHOLD_TOKENS
+
+
+def keep_tokens(topic: ChatTopic) -> int:
+    """ Tokens of newest messages kept verbatim, at most half the threshold so compaction gets history under it """
+    return min(COMPACTION_KEEP_TOKENS, compaction_threshold(topic) // 2)
+
+
+async def compact_topic(topic_id: int) -> None:
+    """ Fold oldest messages into summary batch by batch until history is under threshold """
+    lock_key = f"{compaction_lock}:{topic_id}"
+    # Only one worker compacts a topic at a time
+    if not await redis_client.set(lock_key, 1, nx=True, ex=LOCK_TIMEOUT):
+        return
+    db = await get_db_instance()
+    try:
+        while await compact_step(db, topic_id):
+            await redis_client.expire(lock_key, LOCK_TIMEOUT)
+    except Exception as e:
+        await db.rollback()
+        debug_log(f"Error when compacting topic {topic_id}: \n{e}")
+    finally:
+        await db.close()
+        await redis_client.delete(lock_key)
+
+
+async def compact_step(db: AsyncSession, topic_id: int) -> bool:
+    """ Fold one batch of old messages into topic summary, return True if a batch was folded """
+    topic: ChatTopic | None = await db.get(ChatTopic, topic_id)
+    if topic is None or not topic.compaction_enabled:
+        return False
+    # Check size of history not yet in summary
+    if await unsummarized_tokens(db, topic) <= compaction_threshold(topic):
+        return False
+
+    # Newest messages within keep budget stay verbatim
+    cutoff_id = await keep_cutoff_id(db, topic)
+    if cutoff_id is None:
+        return False
+    stmt = (
+        select(ChatMessage.id, ChatMessage.role, ChatMessage.content)
+        .where(ChatMessage.topic_id == topic.id, ChatMessage.id < cutoff_id)
+        .order_by(ChatMessage.id)
+        .limit(COMPACTION_BATCH)
+    )
+    if topic.summary_until_id is not None:
+        stmt = stmt.where(ChatMessage.id > topic.summary_until_id)
+    rows = (await db.execute(stmt)).all()
+    if not rows:
+        return False
+
+    # Ask model to merge old summary with the batch
+    transcript = "\n".join(f"{row.role}: {row.content}" for row in rows)
+    prompt = [{"role": "system", "content": SUMMARY_PROMPT}]
+    if topic.summary:
+        prompt.append({"role": "user", "content": f"Existing summary:\n{topic.summary}"})
+    prompt.append({"role": "user", "content": f"New messages:\n{transcript}"})
+    model = COMPACTION_MODEL or topic.model
+    summary = await message_to_gpt(prompt, model, 0.0, COMPACTION_SUMMARY_MAX_TOKENS, Priority.background)
+
+    topic.summary = summary
+    topic.summary_until_id = rows[-1].id
+    topic.summary_token_count = count_message_tokens("system", summary_message(summary)["content"], topic.model)
+    await db.commit()
+    debug_log(f"Compacted {len(rows)} messages of topic {topic.id} until message {rows[-1].id}")
+    return True
+
+
+async def unsummarized_tokens(db: AsyncSession, topic: ChatTopic) -> int:
+    """ Sum token count of messages newer than the summary """
+    # Rows stored before token counting are estimated by length
+    tokens = func.coalesce(ChatMessage.token_count, func.length(ChatMessage.content) / 4)
+    stmt = select(func.coalesce(func.sum(tokens), 0)).where(ChatMessage.topic_id == topic.id)
+    if topic.summary_until_id is not None:
+        stmt = stmt.where(ChatMessage.id > topic.summary_until_id)
+    return int((await db.execute(stmt)).scalar_one())
+
+
+async def keep_cutoff_id(db: AsyncSession, topic: ChatTopic) -> int | None:
+    """ Get id of oldest message kept verbatim, messages before it can be folded """
+    keep = keep_tokens(topic)
+    cutoff_id = None
+    last_id = None
+    while keep > 0:
+        stmt = (
+            select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.token_count)
+            .where(ChatMessage.topic_id == topic.id)
+            .order_by(desc(ChatMessage.id))
+            .limit(CONTEXT_FETCH_BATCH)
+        )
+        if topic.summary_until_id is not None:
+            stmt = stmt.where(ChatMessage.id > topic.summary_until_id)
+        if last_id is not None:
+            stmt = stmt.where(ChatMessage.id < last_id)
+        rows = (await db.execute(stmt)).all()
+
+        for row in rows:
+            tokens = row.token_count
+            if tokens is None:
+                tokens = count_message_tokens(row.role, row.content, topic.model)
+            keep -= tokens
+            cutoff_id = row.id
+            if keep <= 0:
+                break
+
+        if len(rows) < CONTEXT_FETCH_BATCH:
+            break
+        last_id = rows[-1].id
+    return cutoff_id
@@ -0,0 +1,172 @@
+"""
+Streaming export of chat history.
+Messages are read through a server-side cursor batch by batch and encoded as NDJSON, CSV or
+OpenAI fine-tuning JSONL, optionally gzip-compressed, so memory stays constant whatever the size.
+"""
+import csv
+import io
+import json
+import zlib
+from typing import AsyncIterator, Literal
+
+from sqlalchemy import select
+from sqlalchemy.sql import Select
+
+from src.conf.settings import EXPORT_BATCH_SIZE, EXPORT_FINETUNE_MAX_MESSAGES
+from src.db.database import get_db_instance
+from src.models import ChatTopic, ChatMessage
+from src.utils.logs import debug_log
+
+ExportFormat = Literal["ndjson", "csv", "finetune"]
+
+export_media_types = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "finetune": "application/jsonl",
+}
+
+export_extensions = {
+    "ndjson": "ndjson",
+    "csv": "csv",
+    "finetune": "jsonl",
+}
+
+export_fields = ["id", "topic_id", "user_id", "role", "content", "token_count", "created_at"]
+
+
+def export_query(fmt: ExportFormat, topic_id: int | None = None, origin_user: int | None = None) -> Select:
+    """ Messages of a topic or of topics created by a user, in conversation order """
+    columns = [
+        ChatMessage.id, ChatMessage.topic_id, ChatMessage.user_id, ChatMessage.role, ChatMessage.content,
+        ChatMessage.token_count, ChatMessage.created_at
+    ]
+    # System prompt of topic starts every fine-tuning example
+    if fmt == "finetune":
+        columns.append(ChatTopic.system_prompt)
+    stmt = (
+        select(*columns)
+        .join(ChatTopic, ChatTopic.id == ChatMessage.topic_id)
+        .order_by(ChatMessage.topic_id, ChatMessage.id)
+    )
+    if topic_id is not None:
+        stmt = stmt.where(ChatMessage.topic_id == topic_id)
+    if origin_user is not None:
+        stmt = stmt.where(ChatTopic.origin_user == origin_user)
+    return stmt.execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+
+def export_filename(name: str, fmt: ExportFormat, compress: bool) -> str:
+    return f"{name}.{export_extensions[fmt]}" + (".gz" if compress else "")
+
+
+def row_dict(row) -> dict:
+    data = {field: getattr(row, field) for field in export_fields}
+    data["created_at"] = row.created_at.isoformat() if row.created_at else None
+    return data
+
+
+class FinetuneEncoder:
+    """ Split topics into chat examples that end with an assistant message, at most max_messages each """
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self.topic_id = None
+        self.system_prompt = None
+        self.messages: list[dict] = []
+
+    def _example(self) -> str:
+        """ Line of buffered messages up to the last assistant message, the rest starts the next example """
+        last = max((i for i, m in enumerate(self.messages) if m["role"] == "assistant"), default=-1)
+        if last < 0:
+            return ""
+        messages = self.messages[:last + 1]
+        self.messages = self.messages[last + 1:]
+        if self.system_prompt:
+            messages = [{"role": "system", "content": self.system_prompt}] + messages
+        return json.dumps({"messages": messages}, ensure_ascii=False) + "\n"
+
+    def encode(self, rows) -> str:
+        lines = []
+        for row in rows:
+            if row.topic_id != self.topic_id:
+                lines.append(self._example())
+                self.topic_id, self.system_prompt, self.messages = row.topic_id, row.system_prompt, []
+            if row.role not in ("user", "assistant"):
+                continue
+            self.messages.append({"role": row.role, "content": row.content})
+            if len(self.messages) >= self.max_messages:
+                lines.append(self._example())
+                # Unanswered tail of a full buffer cannot be completed
+                if len(self.messages) >= self.max_messages:
+                    self.messages = []
+        return "".join(lines)
+
+    def finish(self) -> str:
+        return self._example()
+
+
+class CsvEncoder:
+
+    def __init__(self):
+        self.header = True
+
+    def encode(self, rows) -> str:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if self.header:
+            writer.writerow(export_fields)
+            self.header = False
+        for row in rows:
+            data = row_dict(row)
+            writer.writerow([data[field] for field in export_fields])
+        return buffer.getvalue()
+
+    def finish(self) -> str:
+        # Header of an empty export
+        return self.encode([]) if self.header else ""
+
+
+class NdjsonEncoder:
+
+    @staticmethod
+    def encode(rows) -> str:
+        return "".join(json.dumps(row_dict(row), ensure_ascii=False) + "\n" for row in rows)
+
+    @staticmethod
+    def finish() -> str:
+        return ""
+
+
+def get_encoder(fmt: ExportFormat):
+    if fmt == "csv":
+        return CsvEncoder()
+    if fmt == "finetune":
+        return FinetuneEncoder(EXPORT_FINETUNE_MAX_MESSAGES)
+    return NdjsonEncoder()
+
+
+async def export_messages(stmt: Select, fmt: ExportFormat, compress: bool) -> AsyncIterator[bytes]:
+    """ Stream encoded messages of stmt batch by batch """
+    # Own session, the request session is closed before a streaming response is sent
+    db = await get_db_instance()
+    encoder = get_encoder(fmt)
+    # wbits 31 writes gzip header and trailer
+    gzip = zlib.compressobj(wbits=31) if compress else None
+    try:
+        result = await db.stream(stmt)
+        async for rows in result.partitions():
+            chunk = encoder.encode(rows).encode("utf-8")
+            if gzip is not None:
+                chunk = gzip.compress(chunk)
+            if chunk:
+                yield chunk
+        chunk = encoder.finish().encode("utf-8")
+        if gzip is not None:
+            chunk = gzip.compress(chunk) + gzip.flush()
+        if chunk:
+            yield chunk
+    except Exception as e:
+        debug_log(f"Error when exporting messages: \n{e}")
+        raise
+    finally:
+        await db.close()
@@ -0,0 +1,130 @@
+"""
+Resumable assistant generations.
+A generation runs in background and writes its deltas to a Redis Stream keyed by generation id,
+so a client that reconnects, on any worker, resumes from the last offset it received.
+"""
+import asyncio
+import uuid
+from typing import AsyncIterator
+
+from src.conf.settings import WS_COALESCE_BYTES, WS_COALESCE_MS, GENERATION_STREAM_TTL, GENERATION_RESULT_TTL, \
+    GENERATION_WAIT
+from src.db.database import get_db_instance
+from src.db.redisdb import redis_client, generation_stream
+from src.handlers.ws_stream import coalesce
+from src.models import ChatTopic
+from src.services.chat import generate_reply_stream, create_message_socket
+from src.services.chat_compaction import schedule_compaction
+from src.services.topic_broadcast import topic_broadcast
+from src.utils.err_msg import err_msg
+from src.utils.logs import debug_log
+
+# Keep references of running generations, so they are not garbage collected
+_running_tasks: set[asyncio.Task] = set()
+
+
+class GenerationNotFound(Exception):
+    """ Generation id is unknown or its stream expired """
+
+
+class GenerationFailed(Exception):
+    """ Generation stopped with an error """
+
+
+def generation_key(topic_id: int, generation_id: str) -> str:
+    return f"{generation_stream}:{topic_id}:{generation_id}"
+
+
+async def start_generation(topic: ChatTopic, user_id: int, messages: list[dict]) -> str:
+    """ Start assistant reply of topic in background, return its generation id """
+    generation_id = uuid.uuid4().hex
+    key = generation_key(topic.id, generation_id)
+    # Create stream before returning, readers can tell a starting generation from an unknown one
+    await redis_client.xadd(key, {"start": 1})
+    await redis_client.expire(key, GENERATION_STREAM_TTL)
+    task = asyncio.create_task(run_generation(generation_id, topic, user_id, messages))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return generation_id
+
+
+async def run_generation(generation_id: str, topic: ChatTopic, user_id: int, messages: list[dict]) -> None:
+    """
+    Write reply deltas to stream and to watchers of topic, store assistant message,
+    then trim stream to the final entry
+    """
+    key = generation_key(topic.id, generation_id)
+    # Own session, the generation outlives the connection that started it
+    db = await get_db_instance(user_id)
+    content = ""
+    try:
+        deltas = generate_reply_stream(topic, messages)
+        async for delta in coalesce(deltas, WS_COALESCE_BYTES, WS_COALESCE_MS / 1000):
+            content += delta
+            # Offset is count of characters sent including this delta, one round trip for stream and fan-out
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.xadd(key, {"d": delta, "o": len(content)})
+                topic_broadcast.publish_pipe(pipe, topic.id, {
+                    "type": "delta", "generation_id": generation_id, "content": delta, "offset": len(content)
+                })
+                await pipe.execute()
+
+        msg = await create_message_socket(db, topic.id, user_id, content, "assistant", topic.model)
+        # Fold old messages into topic summary in background
+        schedule_compaction(topic)
+
+        # Final entry carries the whole reply, readers that are behind take the rest from it
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"done": 1, "message_id": msg.id, "content": content, "o": len(content)})
+            pipe.xtrim(key, maxlen=1)
+            pipe.expire(key, GENERATION_RESULT_TTL)
+            topic_broadcast.publish_pipe(pipe, topic.id, {
+                "type": "done", "generation_id": generation_id, "message_id": msg.id, "offset": len(content)
+            })
+            await pipe.execute()
+    except Exception as e:
+        await db.rollback()
+        debug_log(f"Error when generating reply of topic {topic.id}: \n{e}")
+        await redis_client.xadd(key, {"error": err_msg.unexpected})
+        await redis_client.expire(key, GENERATION_RESULT_TTL)
+        await topic_broadcast.publish(topic.id, {
+            "type": "error", "generation_id": generation_id, "detail": err_msg.unexpected
+        })
+    finally:
+        await db.close()
+
+
+async def follow_generation(topic_id: int, generation_id: str, offset: int = 0) -> AsyncIterator[dict]:
+    """
+    Yield delta frames of generation after offset characters, then a done frame with the message id.
+    Frames are {"type": "delta", "content": str, "offset": int} and {"type": "done", "message_id": int, "offset": int}
+    """
+    key = generation_key(topic_id, generation_id)
+    if not await redis_client.exists(key):
+        raise GenerationNotFound(generation_id)
+    last_id = "0"
+    while True:
+        resp = await redis_client.xread({key: last_id}, block=GENERATION_WAIT * 1000, count=100)
+        if not resp:
+            # Stream expired while waiting
+            if not await redis_client.exists(key):
+                raise GenerationNotFound(generation_id)
+            continue
+        for entry_id, fields in resp[0][1]:
+            last_id = entry_id
+            if "d" in fields:
+                end = int(fields["o"])
+                if end <= offset:
+                    continue
+                # Send only the part of delta after offset
+                delta = fields["d"]
+                yield {"type": "delta", "content": delta[len(delta) - (end - offset):], "offset": end}
+                offset = end
+            elif "done" in fields:
+                content = fields["content"]
+                if len(content) > offset:
+                    yield {"type": "delta", "content": content[offset:], "offset": len(content)}
+                yield {"type": "done", "message_id": int(fields["message_id"]), "offset": len(content)}
+                return
+            elif "error" in fields:
+                raise GenerationFailed(fields["error"])
@@ -0,0 +1,196 @@
+"""
+In-process cache of chat topics and their most recent messages.
+Topics are kept in LRU order, each holding a ring buffer of its newest messages.
+"""
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple, Iterable
+
+
+class WindowMessage(NamedTuple):
+    id: int
+    role: str
+    content: str
+    token_count: int
+
+
+class TopicWindow:
+    """ Cached topic and ring buffer of its newest messages """
+    __slots__ = ("topic", "messages", "floor_id", "last_id", "loaded_at")
+
+    def __init__(self, max_messages: int):
+        self.topic = None
+        self.messages: deque[WindowMessage] = deque(maxlen=max_messages)
+        # Every message of topic with id greater than floor_id is in buffer, None while unknown
+        self.floor_id: int | None = None
+        # Newest message id of topic announced by any worker
+        self.last_id = 0
+        self.loaded_at = time.monotonic()
+
+
+def within_budget(messages: Iterable[WindowMessage], budget: int) -> list[WindowMessage]:
+    """ Take newest first messages until the next one does not fit in token budget """
+    selected = []
+    for msg in messages:
+        if msg.token_count > budget:
+            break
+        budget -= msg.token_count
+        selected.append(msg)
+    return selected
+
+
+class ConversationWindowCache:
+    """
+    LRU cache over topics.
+    Workers announce the id of each message they add, a buffer older than the announced id is dropped before use.
+    Topics are invalidated by every worker on update, entries still expire after ttl in case a message is lost.
+    """
+
+    def __init__(self, max_topics: int, max_messages: int, ttl: float):
+        self.max_topics = max_topics
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._entries: OrderedDict[int, TopicWindow] = OrderedDict()
+        self.topic_hits = 0
+        self.topic_misses = 0
+        self.window_hits = 0
+        self.window_misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    def _get(self, topic_id: int) -> TopicWindow | None:
+        """ Get live entry and mark it as recently used """
+        entry = self._entries.get(topic_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.loaded_at > self.ttl:
+            del self._entries[topic_id]
+            return None
+        self._entries.move_to_end(topic_id)
+        return entry
+
+    def _get_or_create(self, topic_id: int) -> TopicWindow | None:
+        """ Get entry of topic, create it and evict least recently used topics if needed """
+        if self.max_topics <= 0:
+            return None
+        entry = self._get(topic_id)
+        if entry is None:
+            entry = TopicWindow(self.max_messages)
+            self._entries[topic_id] = entry
+            while len(self._entries) > self.max_topics:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def get_topic(self, topic_id: int):
+        """ Get cached topic """
+        entry = self._get(topic_id)
+        if entry is None or entry.topic is None:
+            self.topic_misses += 1
+            return None
+        self.topic_hits += 1
+        return entry.topic
+
+    def set_topic(self, topic) -> None:
+        """ Cache topic detached from its session """
+        entry = self._get_or_create(topic.id)
+        if entry is not None:
+            entry.topic = topic
+
+    def recent(self, topic_id: int, after_id: int, budget: int) -> list[WindowMessage] | None:
+        """ Get newest first messages after after_id within budget, None if buffer can not answer """
+        entry = self._get(topic_id)
+        if entry is not None and entry.floor_id is not None:
+            candidates = [m for m in reversed(entry.messages) if m.id > after_id]
+            selected = within_budget(candidates, budget)
+            # Hit when budget is filled or buffer holds all messages after after_id
+            if len(selected) < len(candidates) or entry.floor_id <= after_id:
+                self.window_hits += 1
+                return selected
+        self.window_misses += 1
+        return None
+
+    def note_message(self, topic_id: int, message_id: int) -> None:
+        """ Remember id of a message added to topic by any worker """
+        entry = self._entries.get(topic_id)
+        if entry is not None and message_id > entry.last_id:
+            entry.last_id = message_id
+
+    def check(self, topic_id: int) -> None:
+        """ Drop buffered messages of topic when a newer message was announced, e.g. by another worker """
+        entry = self._entries.get(topic_id)
+        if entry is None or entry.floor_id is None:
+            return
+        newest = entry.messages[-1].id if entry.messages else entry.floor_id
+        if entry.last_id > newest:
+            self.drop_window(topic_id)
+
+    def newest_id(self, topic_id: int) -> int:
+        """ Id of newest message of topic known to this worker, 0 when none """
+        entry = self._entries.get(topic_id)
+        if entry is None:
+            return 0
+        return max(entry.last_id, entry.messages[-1].id if entry.messages else 0)
+
+    def drop_window(self, topic_id: int) -> None:
+        """ Forget buffered messages of topic but keep the topic, next turn reloads them """
+        entry = self._entries.get(topic_id)
+        if entry is not None and entry.floor_id is not None:
+            entry.messages.clear()
+            entry.floor_id = None
+            self.stale += 1
+
+    def reserve(self, topic_id: int) -> None:
+        """ Make sure topic has an entry before loading it, so concurrent appends are kept """
+        self._get_or_create(topic_id)
+
+    def fill(self, topic_id: int, rows: list[WindowMessage], floor_id: int) -> None:
+        """ Fill buffer with newest first rows loaded from database """
+        entry = self._get_or_create(topic_id)
+        if entry is None:
+            return
+        newest_id = rows[0].id if rows else floor_id
+        pending = [m for m in entry.messages if m.id > newest_id]
+        combined = list(reversed(rows)) + pending
+        dropped = combined[:-self.max_messages] if len(combined) > self.max_messages else []
+        entry.messages.clear()
+        entry.messages.extend(combined[-self.max_messages:])
+        entry.floor_id = dropped[-1].id if dropped else floor_id
+
+    def append(self, topic_id: int, msg: WindowMessage) -> None:
+        """ Append a new message of topic to its buffer if topic is cached """
+        entry = self._get(topic_id)
+        if entry is None:
+            return
+        if len(entry.messages) == entry.messages.maxlen:
+            oldest = entry.messages[0]
+            if entry.floor_id is not None:
+                entry.floor_id = max(entry.floor_id, oldest.id)
+        entry.messages.append(msg)
+        entry.last_id = max(entry.last_id, msg.id)
+
+    def invalidate(self, topic_id: int) -> None:
+        """ Drop topic and its messages from cache """
+        self._entries.pop(topic_id, None)
+
+    def clear(self) -> None:
+        """ Drop all cached topics """
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """ Counters of cache usage """
+        topic_total = self.topic_hits + self.topic_misses
+        window_total = self.window_hits + self.window_misses
+        return {
+            "topics": len(self._entries),
+            "max_topics": self.max_topics,
+            "max_messages": self.max_messages,
+            "topic_hits": self.topic_hits,
+            "topic_misses": self.topic_misses,
+            "topic_hit_ratio": self.topic_hits / topic_total if topic_total else 0.0,
+            "window_hits": self.window_hits,
+            "window_misses": self.window_misses,
+            "window_hit_ratio": self.window_hits / window_total if window_total else 0.0,
+            "evictions": self.evictions,
+            "stale": self.stale,
+        }
@@ -0,0 +1,236 @@
+"""
+Write-behind persistence of chat messages.
+Messages get their id up front from blocks reserved on the table sequence, are queued and flushed in multi-row inserts on size or time thresholds.
+Batches that can not be written are spilled to a local append-only file and replayed later.
+"""
+import asyncio
+import json
+import os
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from sqlalchemy import text, select, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from src.conf.settings import (WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_QUEUE_SIZE,
+                               WRITE_BEHIND_SPILL_PATH, WRITE_BEHIND_ID_BLOCK, WORKERS)
+from src.db.database import engine, AsyncSessionLocal
+from src.models import ChatMessage
+from src.services.chat_window_cache import WindowMessage
+from src.utils.logs import debug_log
+from src.utils.unow import now_vn
+
+
+class MessageIdAllocator:
+    """
+    Hand out chat message ids from blocks of block_size reserved in one round trip.
+    PostgreSQL reserves them on the table sequence, SQLite counts up in this process.
+    Blocks of workers interleave, so ids not above the newest id of a topic are skipped to keep its messages in order.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = max(1, block_size)
+        self._ids: deque[int] = deque()
+        self._next_local: int | None = None
+        self._lock = asyncio.Lock()
+        self.blocks = 0
+
+    async def next_id(self, after: int = 0) -> int:
+        """ Next reserved id greater than after """
+        async with self._lock:
+            while self._ids and self._ids[0] <= after:
+                self._ids.popleft()
+            if not self._ids:
+                self._ids.extend(await self._reserve(after))
+                self.blocks += 1
+            return self._ids.popleft()
+
+    async def _reserve(self, after: int) -> list[int]:
+        """ Reserve a block of ids, all greater than after """
+        if engine.dialect.name == "postgresql":
+            # The sequence only grows, a new block is above every id handed out before
+            async with engine.connect() as conn:
+                result = await conn.execute(
+                    text("SELECT nextval(pg_get_serial_sequence('chat_messages', 'id')) FROM generate_series(1, :n)"),
+                    {"n": self.block_size},
+                )
+                return sorted(result.scalars().all())
+        if self._next_local is None:
+            async with engine.connect() as conn:
+                max_id = await conn.execute(select(func.coalesce(func.max(ChatMessage.id), 0)))
+                self._next_local = max_id.scalar_one()
+        start = max(self._next_local, after)
+        self._next_local = start + self.block_size
+        return list(range(start + 1, self._next_local + 1))
+
+
+def check_writer_support(dialect: str, workers: int) -> None:
+    """ Ids of queued messages are unique only on PostgreSQL, or on SQLite with a single worker """
+    if dialect == "postgresql":
+        return
+    if dialect != "sqlite":
+        raise RuntimeError(f"Write-behind persistence is not supported on {dialect}, disable WRITE_BEHIND_ENABLED")
+    if workers > 1:
+        raise RuntimeError("Write-behind persistence on SQLite needs UVICORN_WORKERS=1, "
+                           "workers would hand out the same message ids")
+
+
+class ChatMessageWriter:
+    """ Queue of chat messages flushed to database in background by one task """
+
+    def __init__(self, batch_size: int, flush_interval: float, queue_size: int, spill_path: str, id_block: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.allocator = MessageIdAllocator(id_block)
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=queue_size)
+        # Queued rows by topic, so the context of a topic includes messages not yet written
+        self._pending: dict[int, OrderedDict[int, WindowMessage]] = {}
+        self._task: asyncio.Task | None = None
+        self.flushed = 0
+        self.spilled = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """ Replay spilled messages then start background flush loop """
+        check_writer_support(engine.dialect.name, WORKERS)
+        await self.replay_spill()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """ Stop flush loop and write everything still queued """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        rows = []
+        while not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        if rows:
+            await self._flush(rows)
+
+    async def add(self, user_id: int, topic_id: int, role: str, content: str, token_count: int,
+                  after_id: int = 0) -> dict:
+        """ Assign an id greater than after_id, the newest known id of topic, to a new message and queue it """
+        row = {
+            "id": await self.allocator.next_id(after_id),
+            "user_id": user_id,
+            "topic_id": topic_id,
+            "role": role,
+            "content": content,
+            "token_count": token_count,
+            "created_at": now_vn(),
+        }
+        self._pending.setdefault(topic_id, OrderedDict())[row["id"]] = WindowMessage(
+            row["id"], role, content, token_count
+        )
+        await self._queue.put(row)
+        return row
+
+    def pending(self, topic_id: int) -> list[WindowMessage]:
+        """ Messages of topic queued but not written yet """
+        return list(self._pending.get(topic_id, {}).values())
+
+    async def _run(self) -> None:
+        """ Collect rows until batch size or flush interval is reached, then write them """
+        loop = asyncio.get_running_loop()
+        while True:
+            rows = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(rows) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(rows)
+
+    async def _flush(self, rows: list[dict]) -> None:
+        """ Write rows in one multi-row insert, spill them to file when database is unavailable """
+        try:
+            await self._insert(rows)
+        except Exception as e:
+            debug_log(f"Error when writing chat messages, spill {len(rows)} rows: \n{e}")
+            await asyncio.to_thread(self._spill, rows)
+            self.spilled += len(rows)
+            # Spilled rows stay pending, so context keeps them until replay writes them
+            return
+        self.flushed += len(rows)
+        self._written(rows)
+        # Database is reachable again, write back spilled messages
+        if os.path.exists(self.spill_path) or os.path.exists(f"{self.spill_path}.replay"):
+            await self.replay_spill()
+
+    def _written(self, rows: list[dict]) -> None:
+        """ Drop rows stored in database from pending messages """
+        for row in rows:
+            topic_rows = self._pending.get(row["topic_id"])
+            if topic_rows is not None:
+                topic_rows.pop(row["id"], None)
+                if not topic_rows:
+                    del self._pending[row["topic_id"]]
+
+    async def _insert(self, rows: list[dict]) -> None:
+        """ Insert rows in id order, rows written by an earlier partial replay are skipped """
+        dialect = {"postgresql": postgresql, "sqlite": sqlite}[engine.dialect.name]
+        stmt = dialect.insert(ChatMessage).on_conflict_do_nothing(index_elements=["id"])
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt, sorted(rows, key=lambda r: r["id"]))
+            await db.commit()
+
+    def _spill(self, rows: list[dict]) -> None:
+        """ Append rows to spill file, one json per line """
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps({**row, "created_at": row["created_at"].isoformat()}, ensure_ascii=False))
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def replay_spill(self) -> None:
+        """ Write spilled rows back to database, keep file when database is still unavailable """
+        replay_path = f"{self.spill_path}.replay"
+        # Move file aside so new spills do not mix with the replayed ones
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.spill_path):
+                return
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            row["created_at"] = datetime.fromisoformat(row["created_at"])
+        try:
+            for i in range(0, len(rows), self.batch_size):
+                await self._insert(rows[i:i + self.batch_size])
+        except Exception as e:
+            debug_log(f"Error when replaying spilled chat messages: \n{e}")
+            return
+        os.remove(replay_path)
+        self._written(rows)
+        debug_log(f"Replayed {len(rows)} spilled chat messages")
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": self._queue.qsize(),
+            "flushed": self.flushed,
+            "spilled": self.spilled,
+            "id_blocks": self.allocator.blocks,
+        }
+
+
+chat_writer = ChatMessageWriter(
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+    WRITE_BEHIND_QUEUE_SIZE,
+    WRITE_BEHIND_SPILL_PATH,
+    WRITE_BEHIND_ID_BLOCK,
+)
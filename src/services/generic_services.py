@@ -3,79 +3,353 @@
 Generic service to fetch paginated, filtered, sorted data for any SQLAlchemy model.
 Supports optional joins with custom response fields.
 """
+import base64
+import hashlib
+import hmac
 import json
-from typing import Any, Dict, List, Optional, Type, Union
+import operator
+from collections import OrderedDict
+from datetime import datetime, date, time
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Type, Union
 
-from sqlalchemy import select, or_, and_, String, Text, func
-from sqlalchemy.exc import NoInspectionAvailable
+from sqlalchemy import select, or_, and_, String, Text, Integer, func, inspect, tuple_, bindparam
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql import Select
 
-from src.schema.queries_params_schema import QueryParams
+from src.conf.settings import LIST_COUNT_STRATEGIES, COUNT_CACHE_TTL, QUERY_PLAN_CACHE_SIZE, JWT_SECRET_KEY
+from src.db.fulltext import supports_fulltext, fulltext_terms, apply_fulltext_search
+from src.db.redisdb import redis_client, list_count
+from src.schema.queries_params_schema import QueryParams, ProjectionParams
+from src.schema.serializers import serializer_of, expand_fields
+from src.utils.logs import debug_log
+
+# Label of the sort value selected for keyset cursors when the sort column is not projected or cut by preview
+CURSOR_VALUE = "_cursor_value"
+
+
+class InvalidQuery(ValueError):
+    """ Query params of a list request that cannot be used, answered with 400 """
+
+
+class ModelMeta:
+    """ Columns and relationships of a model, read once instead of on every request """
+
+    def __init__(self, model: Type[Any]):
+        mapper = inspect(model)
+        self.fields = list(model.__table__.columns.keys())
+        # Columns out of the response schema, e.g. password, cannot be searched, sorted or projected
+        exposed = set(serializer_of(model).fields)
+        self.search_columns = [c for c in model.__table__.columns
+                               if isinstance(c.type, (String, Text)) and c.key in exposed]
+        self.sort_fields = {fld for fld in self.fields if fld in exposed}
+        # Unbounded text columns, cut by preview
+        self.preview_fields = {c.key for c in model.__table__.columns if isinstance(c.type, Text)}
+        self.relationships = {rel.key: rel.mapper.class_ for rel in mapper.relationships}
+        self.primary_key = mapper.primary_key[0]
+
+
+@lru_cache(maxsize=None)
+def model_meta(model: Type[Any]) -> ModelMeta:
+    return ModelMeta(model)
+
+
+class QueryShape(NamedTuple):
+    """ Parts of a list request that decide its SQL, requests of the same shape differ only by bound values """
+    filters: tuple[tuple[str, bool], ...]
+    search: Optional[str]
+    terms: int
+    order_field: Optional[str]
+    direction: str
+    rank: bool
+    fields: Optional[tuple[str, ...]] = None
+    preview: bool = False
+    expand: tuple[str, ...] = ()
+    cursor_value: bool = False
+
+
+class QueryPlan(NamedTuple):
+    base: Select
+    page: Select
+    page_with_total: Select
+    count: Select
+
+
+def parse_query(model, params: QueryParams, where: Optional[Dict[str, Any]] = None,
+                dialect: str | None = None,
+                projection: Optional[ProjectionParams] = None) -> tuple[QueryShape, Dict[str, Any]]:
+    """ Shape of request and values bound to its statement """
+    try:
+        flt = json.loads(params.filter) if params.filter else {}
+    except ValueError as e:
+        raise InvalidQuery(f"Invalid filter: {e}")
+    if not isinstance(flt, dict):
+        raise InvalidQuery("Invalid filter: expected a JSON object")
+    if where:
+        flt.update(where)
+    binds = {}
+    filters = []
+    for key in sorted(flt):
+        if filter_column(model, key) is None:
+            continue
+        # NULL is matched by IS NULL, it cannot be a bound value
+        is_null = flt[key] is None
+        if not is_null:
+            binds[f"filter_{len(filters)}"] = flt[key]
+        filters.append((key, is_null))
+
+    search, rank, terms = None, False, []
+    tokens = [t.strip() for t in params.query.split(',') if t.strip()] if params.query else []
+    if tokens:
+        # Strict and substring search keep scanning columns
+        if not params.strict and not params.substring and supports_fulltext(model, dialect):
+            search = "fulltext"
+            terms = fulltext_terms(tokens, dialect)
+            # Keyset pages follow order_by or primary key, not relevance
+            rank = bool(terms) and not params.order_by and not use_keyset(params)
+        elif params.strict:
+            search, terms = "strict", tokens
+        else:
+            search, terms = "substring", [f"%{token}%" for token in tokens]
+    for i, term in enumerate(terms):
+        binds[f"query_{i}"] = term
+
+    fld, direction = parse_order_by(model, params)
+    fields = None
+    cursor_value = False
+    preview = projection is not None and projection.preview is not None
+    if projection is not None and (projection.fields or preview):
+        fields = parse_fields(model, projection.fields, params.strict)
+        if preview:
+            binds["preview"] = projection.preview
+        # Keyset cursors are made of the sort value, selected on its own when it is not projected,
+        # or when preview cuts it since a cursor of the cut value would skip or repeat rows
+        cut = preview and fld in model_meta(model).preview_fields
+        cursor_value = use_keyset(params) and fld is not None and (fld not in fields or cut)
+    # Relations are loaded on entities only
+    expand = parse_expand(model, params.expand, params.strict) if fields is None else ()
+    shape = QueryShape(tuple(filters), search, len(terms), fld, direction, rank,
+                       fields, preview, expand, cursor_value)
+    return shape, binds
+
+
+def parse_expand(model, expand: Optional[str], strict: bool = False) -> tuple[str, ...]:
+    """ Whitelisted relation paths of expand with their parents, roles.permissions also loads roles """
+    if not expand:
+        return ()
+    allowed = expand_fields.get(model.__name__, {})
+    paths = set()
+    for path in (p.strip() for p in expand.split(',') if p.strip()):
+        parts = path.split('.')
+        parents = ['.'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+        if not all(parent in allowed for parent in parents):
+            if strict:
+                raise InvalidQuery(f"Unknown expand relation '{path}'")
+            continue
+        paths.update(parents)
+    return tuple(sorted(paths))
+
+
+def parse_fields(model, fields: Optional[str], strict: bool = False) -> tuple[str, ...]:
+    """ Valid columns of fields led by primary key, all response fields when fields is empty """
+    meta = model_meta(model)
+    if not fields:
+        return tuple(fld for fld in meta.fields if fld in meta.sort_fields)
+    selected = [meta.primary_key.key]
+    for fld in (f.strip() for f in fields.split(',') if f.strip()):
+        if fld not in meta.sort_fields:
+            if strict:
+                raise InvalidQuery(f"Unknown field '{fld}'")
+            continue
+        if fld not in selected:
+            selected.append(fld)
+    return tuple(selected)
+
+
+def project_columns(model, shape: QueryShape) -> list:
+    """ Columns of projected fields, text columns cut to the bound preview length """
+    meta = model_meta(model)
+    columns = []
+    for fld in shape.fields:
+        col = getattr(model, fld)
+        if shape.preview and fld in meta.preview_fields:
+            col = func.substr(col, 1, bindparam("preview", type_=Integer)).label(fld)
+        columns.append(col)
+    if shape.cursor_value:
+        columns.append(getattr(model, shape.order_field).label(CURSOR_VALUE))
+    return columns
 
 
 def build_query(
-        model, params: QueryParams, joins, external_query=None
+        model, shape: QueryShape, joins, external_query=None, dialect: str | None = None
 ) -> Select:
     """ Function combine all query select, filter, and sorting """
     stmt = select(model) if external_query is None else external_query
+    if shape.fields:
+        # Column rows skip ORM loading and identity map
+        stmt = stmt.with_only_columns(*project_columns(model, shape))
     stmt = apply_joins(stmt, model, joins)
-    stmt = apply_filter(stmt, model, params)
-    stmt = apply_search(stmt, model, params)
-    stmt = apply_sorting(stmt, model, params)
+    stmt = apply_expand(stmt, model, shape)
+    stmt = apply_filter(stmt, model, shape)
+    stmt = apply_search(stmt, model, shape, dialect)
+    stmt = apply_sorting(stmt, model, shape)
     return stmt
 
 
-def object_to_dict(obj_items, model, joins = None):
-    """ Convert object model iterable to List[dict] """
+def build_plan(base: Select) -> QueryPlan:
+    """ Page and count statements of a query, offset and limit are bound values """
+    page = base.offset(bindparam("offset", type_=Integer)).limit(bindparam("limit", type_=Integer))
+    return QueryPlan(
+        base=base,
+        page=page,
+        page_with_total=page.add_columns(func.count().over().label("total_count")),
+        count=select(func.count()).select_from(base.order_by(None).subquery()),
+    )
+
+
+class QueryPlanCache:
+    """ Statements of recent request shapes, reused so they skip construction and hit the compiled cache """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._plans: OrderedDict[tuple, QueryPlan] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+
+    def get(self, model, shape: QueryShape, joins, external_query=None, dialect: str | None = None) -> QueryPlan:
+        if external_query is not None:
+            # Statement of caller carries its own values, it cannot be shared
+            self.uncached += 1
+            return build_plan(build_query(model, shape, joins, external_query, dialect))
+        key = (model, dialect, shape, json.dumps(joins, sort_keys=True) if joins else None)
+        plan = self._plans.get(key)
+        if plan is not None:
+            self.hits += 1
+            self._plans.move_to_end(key)
+            return plan
+        self.misses += 1
+        plan = build_plan(build_query(model, shape, joins, None, dialect))
+        self._plans[key] = plan
+        if len(self._plans) > self.max_size:
+            self._plans.popitem(last=False)
+        return plan
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "plans": len(self._plans),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "uncached": self.uncached,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+query_plans = QueryPlanCache(QUERY_PLAN_CACHE_SIZE)
+
+
+def object_to_dict(obj_items, model, joins = None, expand: tuple[str, ...] = ()):
+    """ Convert object model iterable to List[dict] of its response fields and expanded relations """
+    serializer = serializer_of(model)
+    if not joins:
+        return serializer.many(obj_items, expand)
     data_list: List[Dict[str, Any]] = []
     for obj in obj_items:
         # Convert ORM to dict
-        data = {c.key: getattr(obj, c.key) for c in model.__table__.columns}
+        data = serializer.many([obj], expand)[0]
         # Add joins if requested
-        if joins:
-            for join_cfg in joins:
-                rel_name = join_cfg['model']
-                attr = rel_name[0].lower() + rel_name[1:]
-                response_fields = join_cfg.get('response')
-                rel_objs = getattr(obj, attr, []) or []
-                # single field string
-                if isinstance(response_fields, str):
-                    data[attr] = [getattr(o, response_fields) for o in rel_objs]
-                # list of fields
-                elif isinstance(response_fields, list):
-                    data[attr] = [
-                        {f: getattr(o, f) for f in response_fields} for o in rel_objs
-                    ]
+        for join_cfg in joins:
+            rel_name = join_cfg['model']
+            attr = rel_name[0].lower() + rel_name[1:]
+            response_fields = join_cfg.get('response')
+            rel_objs = getattr(obj, attr, []) or []
+            # single field string
+            if isinstance(response_fields, str):
+                data[attr] = [getattr(o, response_fields) for o in rel_objs]
+            # list of fields
+            elif isinstance(response_fields, list):
+                data[attr] = [
+                    {f: getattr(o, f) for f in response_fields} for o in rel_objs
+                ]
         data_list.append(data)
     return data_list
 
 
+def rows_to_dict(rows) -> List[Dict[str, Any]]:
+    """ Convert RowMapping of a projected query to List[dict] """
+    data_list = [dict(row) for row in rows]
+    for data in data_list:
+        data.pop("total_count", None)
+        data.pop(CURSOR_VALUE, None)
+    return data_list
+
+
 async def get_all(db: AsyncSession,
                   model,
                   params: QueryParams,
                   joins: Optional[List[Dict[str, Union[str, List[str]]]]] = None,
-                  external_query=None
+                  external_query=None,
+                  where: Optional[Dict[str, Any]] = None,
+                  projection: Optional[ProjectionParams] = None
                   ):
-    base_stmt = build_query(model, params, joins, external_query)
+    """
+    Page of model items, where holds equality filters of caller bound like filter values.
+    With projection items are dicts of the selected columns read as rows
+    """
+    dialect = db.bind.dialect.name
+    shape, binds = parse_query(model, params, where, dialect, projection)
+    mapped = shape.fields is not None
+    plan = query_plans.get(model, shape, joins, external_query, dialect)
+    strategy = count_strategy(model, params)
 
-    # count total
-    total = await count_total(db, base_stmt)
+    total = None
+    estimated = False
+    next_cursor = prev_cursor = None
+    if use_keyset(params):
+        # Keyset pagination, deep pages cost the same as the first one
+        obj_items, next_cursor, prev_cursor = await get_keyset_page(db, model, params, plan.base, binds, mapped)
+        has_more = next_cursor is not None
+        # Window count of a keyset page would only count rows after the cursor
+        total, estimated = await count_by_strategy(db, plan, binds, strategy)
+    else:
+        # apply pagination, one extra row tells if there is a next page
+        page_binds = {**binds, **pagination_binds(params), "limit": params.limit + 1}
 
-    # apply pagination
-    stmt = apply_pagination(base_stmt, params)
-
-    # execute
-    res = await db.execute(stmt)
-    obj_items = res.scalars().all()
+        # execute
+        if strategy == "exact":
+            # Total of the whole filtered set in the same round trip
+            res = await db.execute(plan.page_with_total, page_binds)
+            rows = res.mappings().all() if mapped else res.all()
+            obj_items = rows if mapped else [row[0] for row in rows]
+            if rows:
+                total = rows[0]["total_count"] if mapped else rows[0].total_count
+            elif params.page > 1:
+                # Page past the end carries no window count
+                total = await count_total(db, plan.count, binds)
+            else:
+                total = 0
+        else:
+            res = await db.execute(plan.page, page_binds)
+            obj_items = res.mappings().all() if mapped else res.scalars().all()
+            total, estimated = await count_by_strategy(db, plan, binds, strategy)
+        has_more = len(obj_items) > params.limit
+        obj_items = obj_items[:params.limit]
 
-    data_list = object_to_dict(obj_items, model, joins)
+    data_list = rows_to_dict(obj_items) if mapped else object_to_dict(obj_items, model, joins, shape.expand)
 
     return {
         "data": data_list,
         "total": total,
+        "total_estimated": estimated,
         "page": params.page,
-        "limit": params.limit
+        "limit": params.limit,
+        "has_more": has_more,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
     }
 
 
@@ -84,87 +358,271 @@ def build_base_query(model: Type[Any]) -> Select:
 
 
 def apply_joins(stmt: Select, model: Type[Any], joins: List[Dict]) -> Select:
-    """ Apply joins models and add foreign items """
+    """ Load foreign items of joins models, one query per relation so parent rows are not repeated """
     if joins:
         for join_cfg in joins:
             attr = join_cfg["model"][0].lower() + join_cfg["model"][1:]
-            stmt = stmt.join(getattr(model, attr))
+            stmt = stmt.options(selectinload(getattr(model, attr)))
     return stmt
 
 
-def apply_filter(stmt: Select, model: Type[Any], params: QueryParams) -> Select:
+def apply_expand(stmt: Select, model: Type[Any], shape: QueryShape) -> Select:
+    """ Load expanded relations with a selectinload chain per path, one extra query per level """
+    for path in shape.expand:
+        loader, owner = None, model
+        for rel in path.split('.'):
+            attr = getattr(owner, rel)
+            loader = selectinload(attr) if loader is None else loader.selectinload(attr)
+            owner = model_meta(owner).relationships[rel]
+        stmt = stmt.options(loader)
+    return stmt
+
+
+def filter_column(model: Type[Any], key: str):
+    """ Column of a filter key, a field of model or relation.field, None when unknown """
+    parts = key.split('.')
+    if len(parts) == 1:
+        return getattr(model, parts[0], None)
+    target = model_meta(model).relationships.get(parts[0])
+    return getattr(target, parts[1], None) if target is not None else None
+
+
+def apply_filter(stmt: Select, model: Type[Any], shape: QueryShape) -> Select:
     """ Filter items by key - value """
-    if not params.filter:
+    for i, (key, is_null) in enumerate(shape.filters):
+        col = filter_column(model, key)
+        cond = col.is_(None) if is_null else col == bindparam(f"filter_{i}")
+        if '.' in key:
+            # Related rows are matched by EXISTS, a join would repeat parent rows
+            rel = getattr(model, key.split('.')[0])
+            cond = rel.any(cond) if rel.property.uselist else rel.has(cond)
+        stmt = stmt.where(cond)
+    return stmt
+
+
+def apply_search(stmt: Select, model: Type[Any], shape: QueryShape, dialect: str | None = None) -> Select:
+    """ Query find items, by full-text index ranked by relevance when model has one """
+    if not shape.terms:
+        return stmt
+    terms = [bindparam(f"query_{i}") for i in range(shape.terms)]
+    if shape.search == "fulltext":
+        return apply_fulltext_search(stmt, model, terms, dialect, rank=shape.rank)
+    columns = model_meta(model).search_columns
+    if not columns:
         return stmt
-    flt = json.loads(params.filter)
-    for key, val in flt.items():
-        parts = key.split('.')
-        if len(parts) == 1:
-            col = getattr(model, parts[0], None)
+    and_conds = []
+    for term in terms:
+        if shape.search == "strict":
+            and_conds.append(or_(*(col == term for col in columns)))
         else:
-            rel_attr = getattr(model, parts[0], None)
-            col = getattr(rel_attr.property.mapper.class_, parts[1], None)
-        if col is not None:
-            stmt = stmt.where(col == val)
-    return stmt
+            and_conds.append(or_(*(col.ilike(term) for col in columns)))
+    return stmt.where(and_(*and_conds))
 
 
-def apply_search(stmt: Select, model: Type[Any], params: QueryParams) -> Select:
-    """ Query find items """
-    if params.query:
-        tokens = [t.strip() for t in params.query.split(',') if t.strip()]
-        and_conds = []
-        for token in tokens:
-            or_conds = []
-            for col in model.__table__.columns:
-                if isinstance(col.type, (String, Text)):
-                    if params.strict:
-                        or_conds.append(col == token)
-                    else:
-                        or_conds.append(col.ilike(f"%{token}%"))
-            if or_conds:
-                and_conds.append(or_(*or_conds))
-        if and_conds:
-            stmt = stmt.where(and_(*and_conds))
-    return stmt
+def parse_order_by(model: Type[Any], params: QueryParams) -> tuple[Optional[str], str]:
+    """ Get valid order_by field and its direction """
+    if not params.order_by:
+        return None, 'asc'
+    raw = params.order_by
+    direction = 'asc'
+    if raw.startswith('-'):
+        direction = 'desc'
+        fld = raw[1:]
+    elif raw.startswith('+'):
+        fld = raw[1:]
+    else:
+        fld = raw
+    # validate
+    if fld not in model_meta(model).sort_fields:
+        if params.strict:
+            raise InvalidQuery(f"Unknown order_by field '{fld}'")
+        else:
+            fld = None
+    return fld, direction
 
 
-def apply_sorting(stmt: Select, model: Type[Any], params: QueryParams) -> Select:
+def apply_sorting(stmt: Select, model: Type[Any], shape: QueryShape) -> Select:
     """ Sorting by order_by """
-    if params.order_by:
-        raw = params.order_by
-        direction = 'asc'
-        if raw.startswith('-'):
-            direction = 'desc'
-            fld = raw[1:]
-        elif raw.startswith('+'):
-            fld = raw[1:]
-        else:
-            fld = raw
-        # validate
-        try:
-            valid_cols = set(model.__table__.columns.keys())
-        except (AttributeError, NoInspectionAvailable):
-            valid_cols = set()
-        if fld not in valid_cols:
-            if params.strict:
-                raise ValueError(f"Unknown order_by field '{fld}'")
-            else:
-                fld = None
-        if fld:
-            col = getattr(model, fld)
-            stmt = stmt.order_by(col.desc() if direction == 'desc' else col.asc())
+    if shape.order_field:
+        col = getattr(model, shape.order_field)
+        stmt = stmt.order_by(col.desc() if shape.direction == 'desc' else col.asc())
     return stmt
 
 
-def apply_pagination(stmt: Select, params: QueryParams) -> Select:
-    """ Make pagination with offset and limit """
-    offset = (params.page - 1) * params.limit
-    return stmt.offset(offset).limit(params.limit)
+def pagination_binds(params: QueryParams) -> Dict[str, int]:
+    """ Offset and limit bound to a page statement of build_plan """
+    return {"offset": (params.page - 1) * params.limit, "limit": params.limit}
+
+
+def use_keyset(params: QueryParams) -> bool:
+    return params.cursor is not None or params.paginate == "keyset"
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def cursor_signature(payload: str) -> str:
+    return b64encode(hmac.new(JWT_SECRET_KEY.encode("utf-8"), payload.encode("ascii"), hashlib.sha256).digest()[:16])
+
+
+def encode_cursor(order_by: Optional[str], value: Any, key: Any, after: bool) -> str:
+    """ Signed token of sort value and primary key of a row, after or before it """
+    if isinstance(value, (datetime, date, time)):
+        value = value.isoformat()
+    elif isinstance(value, Decimal):
+        value = str(value)
+    raw = json.dumps({"o": order_by, "v": value, "k": key, "a": after}, separators=(",", ":"))
+    payload = b64encode(raw.encode("utf-8"))
+    return f"{payload}.{cursor_signature(payload)}"
+
+
+def decode_cursor(cursor: str, order_by: Optional[str], column) -> tuple[Any, Any, bool]:
+    """ Get sort value, primary key and direction of a cursor made by this app for the same order_by """
+    try:
+        payload, _, signature = cursor.partition(".")
+        # Cursors are not made by clients, their values go to the WHERE clause as they are
+        if not hmac.compare_digest(signature, cursor_signature(payload)):
+            raise ValueError("bad signature")
+        raw = json.loads(b64decode(payload))
+        value, key, after = raw["v"], raw["k"], bool(raw["a"])
+        if raw["o"] != order_by:
+            raise ValueError("cursor was made for another order_by")
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = None
+        if value is not None and python_type in (datetime, date, time):
+            value = python_type.fromisoformat(value)
+        elif value is not None and python_type is Decimal:
+            value = Decimal(value)
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidQuery(f"Invalid cursor: {e}")
+    return value, key, after
+
+
+def keyset_condition(col, nullable: bool, pk, value: Any, key: Any, desc: bool, after: bool):
+    """ Rows after or before (value, key) in order of col then pk, NULL values of col sort last """
+    op = operator.gt if after != desc else operator.lt
+    if col is pk:
+        return op(pk, key)
+    if value is None:
+        # Cursor row is among the NULL values at the end
+        if after:
+            return and_(col.is_(None), op(pk, key))
+        return or_(col.is_not(None), and_(col.is_(None), op(pk, key)))
+    if not nullable:
+        # Row value comparison can use a composite index
+        return op(tuple_(col, pk), tuple_(value, key))
+    cond = or_(op(col, value), and_(col == value, op(pk, key)))
+    return or_(cond, col.is_(None)) if after else cond
+
+
+async def get_keyset_page(db: AsyncSession, model, params: QueryParams, stmt: Select,
+                          binds: Optional[Dict[str, Any]] = None,
+                          mapped: bool = False) -> tuple[list, Optional[str], Optional[str]]:
+    """ Fetch page after or before params.cursor by keyset, return items with next and previous cursors """
+    fld, direction = parse_order_by(model, params)
+    pk = model_meta(model).primary_key
+    pk_attr = getattr(model, pk.key)
+    column = model.__table__.columns[fld] if fld else pk
+    col = getattr(model, fld) if fld else pk_attr
+    desc = direction == 'desc'
+    order_by = f"-{fld}" if fld and desc else fld
+
+    after = True
+    if params.cursor:
+        value, key, after = decode_cursor(params.cursor, order_by, column)
+        stmt = stmt.where(keyset_condition(col, column.nullable, pk_attr, value, key, desc, after))
+
+    # Pages before the cursor are read backwards then reversed
+    ascending = after != desc
+    col_order = col.asc() if ascending else col.desc()
+    if column.nullable and col is not pk_attr:
+        col_order = col_order.nulls_last() if after else col_order.nulls_first()
+    orders = [col_order] if col is pk_attr else [col_order, pk_attr.asc() if ascending else pk_attr.desc()]
+    stmt = stmt.order_by(None).order_by(*orders).limit(params.limit + 1)
+
+    res = await db.execute(stmt, binds)
+    items = res.mappings().all() if mapped else res.scalars().all()
+    has_more = len(items) > params.limit
+    items = items[:params.limit]
+    if not after:
+        items.reverse()
+    if not items:
+        return items, None, None
+
+    def cursor_of(obj, is_after: bool) -> str:
+        if mapped:
+            value = obj[CURSOR_VALUE] if CURSOR_VALUE in obj else obj[col.key]
+            return encode_cursor(order_by, value, obj[pk_attr.key], is_after)
+        return encode_cursor(order_by, getattr(obj, col.key), getattr(obj, pk_attr.key), is_after)
+
+    # Going forward there is a previous page only when we came from a cursor, and backwards the other way
+    next_cursor = cursor_of(items[-1], True) if (has_more if after else True) else None
+    prev_cursor = cursor_of(items[0], False) if (params.cursor and after) or (not after and has_more) else None
+    return items, next_cursor, prev_cursor
+
+
+async def count_total(db, stmt, binds: Optional[Dict[str, Any]] = None):
+    """ Counting query total items, stmt is the count statement of a plan """
+    total = (await db.execute(stmt, binds)).scalar_one()
+    return total
+
+
+def count_strategy(model: Type[Any], params: QueryParams) -> str:
+    """ Count strategy of request, or default of model table """
+    if params.count:
+        return params.count
+    return LIST_COUNT_STRATEGIES.get(model.__tablename__) or LIST_COUNT_STRATEGIES.get("default") or "exact"
+
+
+async def count_by_strategy(db: AsyncSession, plan: QueryPlan, binds: Dict[str, Any],
+                            strategy: str) -> tuple[Optional[int], bool]:
+    """
+    Total items of query by a separate query, None for strategy none.
+    The flag tells the total is a planner estimate, estimated falls back to an exact count without one
+    """
+    if strategy == "none":
+        return None, False
+    if strategy == "estimated":
+        total = await estimate_total(db, plan.base, binds)
+        if total is not None:
+            return total, True
+    elif strategy == "cached":
+        return await cached_total(db, plan.count, binds), False
+    return await count_total(db, plan.count, binds), False
+
+
+async def estimate_total(db: AsyncSession, stmt: Select, binds: Dict[str, Any]) -> Optional[int]:
+    """ Row estimate of the PostgreSQL planner, None when it is not available """
+    dialect = db.bind.dialect
+    if dialect.name != "postgresql":
+        return None
+    try:
+        sql = stmt.order_by(None).params(binds).compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+        conn = await db.connection()
+        plan = (await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}")).scalar_one()
+    except Exception as e:
+        debug_log(f"Error when estimating count: \n{e}")
+        return None
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
 
 
-async def count_total(db, stmt):
-    """ Counting query total items """
-    count_stmt = select(func.count()).select_from(stmt.subquery())
-    total = (await db.execute(count_stmt)).scalar_one()
+async def cached_total(db: AsyncSession, stmt: Select, binds: Dict[str, Any]) -> int:
+    """ Exact count memoized by normalized query for COUNT_CACHE_TTL seconds """
+    compiled = stmt.compile(dialect=db.bind.dialect)
+    normalized = json.dumps([str(compiled), {**compiled.params, **binds}], sort_keys=True, default=str)
+    key = f"{list_count}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+    cached = await redis_client.get(key)
+    if cached is not None:
+        return int(cached)
+    total = await count_total(db, stmt, binds)
+    await redis_client.set(key, total, ex=COUNT_CACHE_TTL)
     return total
@@ -0,0 +1,66 @@
+"""
+Exact-match cache of chat completions stored in Redis.
+Entries are keyed by a canonical hash of the normalized question of a request and bounded by TTL and entry count.
+"""
+import hashlib
+import json
+import time
+from typing import AsyncIterator
+
+from src.conf.settings import RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_CHUNK_SIZE
+from src.db.redisdb import redis_client, response_cache, response_cache_index
+
+
+def normalize_prompt(prompt: str | None) -> str:
+    """ Prompt without case and whitespace differences """
+    return " ".join((prompt or "").split()).casefold()
+
+
+def prompt_hash(prompt: str | None, system_prompt: str | None, model: str, temperature: float | None,
+                max_tokens: int | None) -> str:
+    """ Canonical hash of a question asked with the same system prompt and params, history is not part of it """
+    canonical = json.dumps(
+        {
+            "model": model,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "system_prompt": system_prompt or "",
+            "prompt": normalize_prompt(prompt),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+async def get_cached_response(key: str) -> str | None:
+    """ Get cached completion and mark it as recently used """
+    content = await redis_client.get(f"{response_cache}:{key}")
+    if content is not None:
+        await redis_client.zadd(response_cache_index, {key: time.time()})
+    return content
+
+
+async def set_cached_response(key: str, content: str) -> None:
+    """ Store completion with TTL, evict least recently used entries above max entries """
+    now = time.time()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.set(f"{response_cache}:{key}", content, ex=RESPONSE_CACHE_TTL)
+        pipe.zadd(response_cache_index, {key: now})
+        # Drop index entries whose value already expired
+        pipe.zremrangebyscore(response_cache_index, 0, now - RESPONSE_CACHE_TTL)
+        pipe.zcard(response_cache_index)
+        result = await pipe.execute()
+
+    overflow = result[-1] - RESPONSE_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted = await redis_client.zpopmin(response_cache_index, overflow)
+        if evicted:
+            await redis_client.delete(*[f"{response_cache}:{k}" for k, _ in evicted])
+
+
+async def replay_stream(content: str) -> AsyncIterator[str]:
+    """ Replay cached completion chunk by chunk like an upstream stream """
+    for i in range(0, len(content), RESPONSE_CACHE_CHUNK_SIZE):
+        yield content[i:i + RESPONSE_CACHE_CHUNK_SIZE]
@@ -0,0 +1,317 @@
+"""
+Semantic response cache of chat topics.
+The user prompt is embedded and searched in a vector index of the topic, a stored prompt close enough
+by cosine similarity serves its reply instead of an upstream call.
+Index of a topic is a float32 matrix file mapped in memory plus a JSON lines file of replies by slot,
+workers share it through the files and slots are reused like a ring once max entries are stored.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from src.client_api.gpt import gpt_pool, message_to_gpt, Priority
+from src.conf.settings import SEMANTIC_CACHE_EMBEDDER, SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_THRESHOLD, \
+    SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_TOPICS, SEMANTIC_CACHE_DIR, SEMANTIC_CACHE_SAMPLE_RATE, \
+    SEMANTIC_CACHE_FP_SIMILARITY
+from src.db.redisdb import redis_client, semantic_cache_lock
+from src.models import ChatTopic
+from src.utils.logs import debug_log
+
+# Seconds a worker holds the append lock of a topic index
+LOCK_TIMEOUT = 10
+
+word_pattern = re.compile(r"\w+")
+
+
+def normalize(vector: np.ndarray) -> np.ndarray:
+    """ Scale vector to unit length, so dot product is cosine similarity """
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+class Embedder(ABC):
+    """ Turn a text into a unit vector of dim float32 """
+    name: str = ""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    @abstractmethod
+    async def embed(self, text: str) -> np.ndarray:
+        ...
+
+
+class LocalEmbedder(Embedder):
+    """ Deterministic hashing of words and character trigrams, for tests and offline runs """
+    name = "local"
+
+    def embed_sync(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = word_pattern.findall(text.lower())
+        features = words + [w[i:i + 3] for w in words if len(w) > 3 for i in range(len(w) - 2)]
+        for feature in features:
+            value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            # Low bits pick the dimension, high bit the sign
+            vector[value % self.dim] += 1.0 if value >> 63 else -1.0
+        return normalize(vector)
+
+    async def embed(self, text: str) -> np.ndarray:
+        return self.embed_sync(text)
+
+
+class OpenAIEmbedder(Embedder):
+    """ Embedding model of the upstream endpoints """
+
+    def __init__(self, model: str, dim: int):
+        super().__init__(dim)
+        self.model = model
+        self.name = model
+
+    async def embed(self, text: str) -> np.ndarray:
+        embeddings = await gpt_pool.embed(model=self.model, input=[text], dimensions=self.dim)
+        return normalize(np.asarray(embeddings[0], dtype=np.float32))
+
+
+def get_embedder(name: str, dim: int) -> Embedder:
+    if name == "local":
+        return LocalEmbedder(dim)
+    return OpenAIEmbedder(name, dim)
+
+
+class TopicIndex:
+    """
+    Vectors and replies of one topic, refreshed from its files when any worker appended.
+    Methods run in worker threads, the lock keeps refreshes of one topic from interleaving.
+    """
+
+    def __init__(self, vectors_path: Path, replies_path: Path, dim: int):
+        self.vectors_path = vectors_path
+        self.replies_path = replies_path
+        self.dim = dim
+        self.vectors: np.memmap | None = None
+        self.replies: list[str | None] = []
+        self.last_seq = -1
+        self.lines = 0
+        self._offset = 0
+        # Identity of the replies file read so far, compaction replaces the file
+        self._file_id: tuple[int, int] | None = None
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes if self.vectors is not None else 0
+
+    def refresh(self) -> None:
+        """ Read reply lines appended since last refresh and map vectors of new slots """
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        try:
+            with open(self.replies_path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                file_id = (stat.st_dev, stat.st_ino)
+                if file_id != self._file_id or stat.st_size < self._offset:
+                    # Replies file was compacted by some worker, read it again from the start
+                    self.replies, self.last_seq, self.lines, self._offset = [], -1, 0, 0
+                    self._file_id = file_id
+                if stat.st_size == self._offset:
+                    return
+                f.seek(self._offset)
+                data = f.read(stat.st_size - self._offset)
+        except FileNotFoundError:
+            return
+        # Skip a line that is still being written
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            entry = json.loads(line)
+            slot = entry["slot"]
+            if slot >= len(self.replies):
+                self.replies.extend([None] * (slot + 1 - len(self.replies)))
+            self.replies[slot] = entry["reply"]
+            self.last_seq = entry["seq"]
+            self.lines += 1
+        self._offset += end
+        if self.vectors is None or len(self.vectors) < len(self.replies):
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                     shape=(len(self.replies), self.dim))
+
+    def search(self, vector: np.ndarray) -> tuple[str, float] | None:
+        """ Reply of the most similar stored prompt and its cosine similarity """
+        with self._lock:
+            self._refresh()
+            if self.vectors is None:
+                return None
+            scores = self.vectors @ vector
+            slot = int(np.argmax(scores))
+            return self.replies[slot], float(scores[slot])
+
+    def append(self, vector: np.ndarray, reply: str, max_entries: int) -> None:
+        """ Write vector and reply to the next slot, caller holds the append lock of topic """
+        with self._lock:
+            self._append(vector, reply, max_entries)
+
+    def _append(self, vector: np.ndarray, reply: str, max_entries: int) -> None:
+        self._refresh()
+        seq = self.last_seq + 1
+        slot = seq % max_entries
+        self.vectors_path.parent.mkdir(parents=True, exist_ok=True)
+        # Vector first, a reply line always points at a written row
+        with open(self.vectors_path, "r+b" if self.vectors_path.exists() else "wb") as f:
+            f.seek(slot * self.dim * 4)
+            f.write(vector.astype(np.float32).tobytes())
+        with open(self.replies_path, "ab") as f:
+            f.write(json.dumps({"seq": seq, "slot": slot, "reply": reply}, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._refresh()
+        if self.lines > 2 * max_entries:
+            self.compact()
+
+    def compact(self) -> None:
+        """ Rewrite replies file with one line per slot """
+        tmp_path = self.replies_path.with_suffix(".tmp")
+        first_slot = (self.last_seq + 1) % len(self.replies)
+        with open(tmp_path, "wb") as f:
+            # Oldest slot first, so sequence numbers keep increasing
+            for i in range(len(self.replies)):
+                slot = (first_slot + i) % len(self.replies)
+                seq = self.last_seq - len(self.replies) + 1 + i
+                f.write(json.dumps({"seq": seq, "slot": slot, "reply": self.replies[slot]},
+                                   ensure_ascii=False).encode("utf-8") + b"\n")
+        try:
+            tmp_path.replace(self.replies_path)
+        except OSError as e:
+            # Another process has the file open on platforms without shared delete, retry next time
+            debug_log(f"Error when compacting semantic cache replies {self.replies_path}: \n{e}")
+
+
+class SemanticMatch(NamedTuple):
+    vector: np.ndarray
+    reply: str | None
+    score: float
+
+
+class SemanticCache:
+    """ Vector indexes of recently used topics with hit and false positive counters of this worker """
+
+    def __init__(self, embedder: Embedder, directory: str, threshold: float, max_entries: int, max_topics: int,
+                 sample_rate: float, fp_similarity: float):
+        self.embedder = embedder
+        self.directory = Path(directory) / re.sub(r"[^\w.-]", "_", f"{embedder.name}-{embedder.dim}")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_topics = max_topics
+        self.sample_rate = sample_rate
+        self.fp_similarity = fp_similarity
+        self._indexes: OrderedDict[int, TopicIndex] = OrderedDict()
+        # Keep references of running checks, so they are not garbage collected
+        self._tasks: set[asyncio.Task] = set()
+        self.lookups = 0
+        self.hits = 0
+        self.added = 0
+        self.sampled = 0
+        self.false_positives = 0
+
+    def _index(self, topic_id: int) -> TopicIndex:
+        index = self._indexes.get(topic_id)
+        if index is None:
+            index = TopicIndex(self.directory / f"{topic_id}.f32", self.directory / f"{topic_id}.jsonl",
+                               self.embedder.dim)
+            self._indexes[topic_id] = index
+            # Least recently used topic is unmapped
+            if len(self._indexes) > self.max_topics:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(topic_id)
+        return index
+
+    async def lookup(self, topic_id: int, prompt: str) -> SemanticMatch:
+        """ Embed prompt and find a stored reply above the similarity threshold """
+        self.lookups += 1
+        vector = await self.embedder.embed(prompt)
+        # File reads and the matrix product stay off the event loop
+        found = await asyncio.to_thread(self._index(topic_id).search, vector)
+        if found is None:
+            return SemanticMatch(vector, None, 0.0)
+        reply, score = found
+        if score < self.threshold or reply is None:
+            return SemanticMatch(vector, None, score)
+        self.hits += 1
+        return SemanticMatch(vector, reply, score)
+
+    async def add(self, topic_id: int, vector: np.ndarray, reply: str) -> None:
+        """ Store reply of prompt vector, skipped while another worker appends to the topic """
+        lock_key = f"{semantic_cache_lock}:{topic_id}"
+        if not await redis_client.set(lock_key, 1, nx=True, ex=LOCK_TIMEOUT):
+            return
+        try:
+            await asyncio.to_thread(self._index(topic_id).append, vector, reply, self.max_entries)
+            self.added += 1
+        except Exception as e:
+            # A reply that could not be stored is still returned
+            debug_log(f"Error when adding to semantic cache of topic {topic_id}: \n{e}")
+        finally:
+            await redis_client.delete(lock_key)
+
+    def sample(self, topic: ChatTopic, messages: list[dict], reply: str) -> None:
+        """ Answer a share of hits upstream in background to measure false positives """
+        if random.random() >= self.sample_rate:
+            return
+        task = asyncio.create_task(self._check(topic, messages, reply))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _check(self, topic: ChatTopic, messages: list[dict], reply: str) -> None:
+        try:
+            fresh = await message_to_gpt(messages, topic.model, topic.temperature, topic.max_token,
+                                         Priority.background)
+            similarity = float(await self.embedder.embed(fresh) @ await self.embedder.embed(reply))
+        except Exception as e:
+            debug_log(f"Error when sampling semantic cache of topic {topic.id}: \n{e}")
+            return
+        self.sampled += 1
+        if similarity < self.fp_similarity:
+            self.false_positives += 1
+            debug_log(f"Semantic cache false positive on topic {topic.id}, reply similarity {similarity:.3f}")
+
+    def stats(self) -> dict:
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "added": self.added,
+            "sampled": self.sampled,
+            "false_positives": self.false_positives,
+            "false_positive_rate": self.false_positives / self.sampled if self.sampled else 0.0,
+            "topics": len(self._indexes),
+            "entries": sum(len(index.replies) for index in self._indexes.values()),
+            "index_bytes": sum(index.nbytes for index in self._indexes.values()),
+        }
+
+
+semantic_cache = SemanticCache(
+    get_embedder(SEMANTIC_CACHE_EMBEDDER, SEMANTIC_CACHE_DIM),
+    SEMANTIC_CACHE_DIR,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    max_topics=SEMANTIC_CACHE_TOPICS,
+    sample_rate=SEMANTIC_CACHE_SAMPLE_RATE,
+    fp_similarity=SEMANTIC_CACHE_FP_SIMILARITY,
+)
+
+
+def last_user_prompt(messages: list[dict]) -> str | None:
+    """ Content of the newest user message, the text matched by the semantic cache """
+    for message in reversed(messages):
+        if message["role"] == "user":
+            return message["content"]
+    return None
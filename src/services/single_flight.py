@@ -0,0 +1,94 @@
+"""
+Single-flight of identical completion requests across workers.
+The first caller holds a Redis lock and performs the call, its deltas are written to a Redis Stream
+that concurrent callers with the same prompt hash read instead of calling upstream themselves.
+"""
+import uuid
+from typing import AsyncIterator, Callable
+
+from src.conf.settings import SINGLE_FLIGHT_LOCK_TTL, SINGLE_FLIGHT_WAIT, SINGLE_FLIGHT_RESULT_TTL
+from src.db.redisdb import redis_client, single_flight_lock, single_flight_stream, single_flight_saved
+
+
+class SingleFlightStats:
+    """ Counters of single-flight calls of this worker """
+
+    def __init__(self):
+        self.leaders = 0
+        self.saved = 0
+        self.fallbacks = 0
+
+    async def snapshot(self) -> dict:
+        saved_total = await redis_client.get(single_flight_saved)
+        return {
+            "leaders": self.leaders,
+            "fallbacks": self.fallbacks,
+            "saved_calls": self.saved,
+            "saved_calls_all_workers": int(saved_total or 0),
+        }
+
+
+single_flight_stats = SingleFlightStats()
+
+
+async def single_flight(key: str, produce: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """ Yield deltas of produce(), shared by every concurrent caller with the same key """
+    lock_key = f"{single_flight_lock}:{key}"
+    token = uuid.uuid4().hex
+    if not await redis_client.set(lock_key, token, nx=True, ex=SINGLE_FLIGHT_LOCK_TTL):
+        leader_token = await redis_client.get(lock_key)
+        if leader_token is not None:
+            async for delta in follow(f"{single_flight_stream}:{key}:{leader_token}", produce):
+                yield delta
+            return
+        # Leader finished in between, try to lead this flight
+        if not await redis_client.set(lock_key, token, nx=True, ex=SINGLE_FLIGHT_LOCK_TTL):
+            async for delta in produce():
+                yield delta
+            return
+
+    single_flight_stats.leaders += 1
+    stream_key = f"{single_flight_stream}:{key}:{token}"
+    try:
+        async for delta in produce():
+            await redis_client.xadd(stream_key, {"d": delta})
+            yield delta
+        await redis_client.xadd(stream_key, {"done": 1})
+    except BaseException as e:
+        await redis_client.xadd(stream_key, {"error": str(e) or e.__class__.__name__})
+        raise
+    finally:
+        await redis_client.expire(stream_key, SINGLE_FLIGHT_RESULT_TTL)
+        # Release lock only if it is still ours
+        if await redis_client.get(lock_key) == token:
+            await redis_client.delete(lock_key)
+
+
+async def follow(stream_key: str, produce: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+    """ Read deltas of the leader, call upstream itself if the leader fails before sending anything """
+    last_id = "0"
+    received = False
+    failed = False
+    while not failed:
+        resp = await redis_client.xread({stream_key: last_id}, block=SINGLE_FLIGHT_WAIT * 1000, count=100)
+        if not resp:
+            break
+        for entry_id, fields in resp[0][1]:
+            last_id = entry_id
+            if "d" in fields:
+                received = True
+                yield fields["d"]
+            elif "done" in fields:
+                single_flight_stats.saved += 1
+                await redis_client.incr(single_flight_saved)
+                return
+            else:
+                failed = True
+                break
+
+    # Leader timed out or failed
+    if received:
+        raise RuntimeError("single-flight leader failed while streaming")
+    single_flight_stats.fallbacks += 1
+    async for delta in produce():
+        yield delta
@@ -0,0 +1,195 @@
+"""
+Fan-out of topic events to every connected socket on every worker.
+Events are published once to a Redis channel of the topic, each worker holds one subscription
+and dispatches received events to queues of its local sockets watching that topic.
+The same subscription carries invalidations of topics changed by any worker and ids of messages they add.
+"""
+import asyncio
+import json
+from typing import Awaitable, Callable
+
+from redis.asyncio.client import Pipeline, PubSub
+
+from src.conf.settings import TOPIC_FANOUT_ENABLED, TOPIC_FANOUT_QUEUE_SIZE
+from src.db.redisdb import redis_client, topic_channel, topic_invalidation, topic_last_message
+from src.models import ChatMessage
+from src.utils.logs import debug_log
+
+
+def channel_of(topic_id: int) -> str:
+    return f"{topic_channel}:{topic_id}"
+
+
+class TopicBroadcaster:
+    """ One pub/sub connection of this worker shared by every local socket """
+
+    def __init__(self, enabled: bool, queue_size: int):
+        self.enabled = enabled
+        self.queue_size = queue_size
+        self._subscribers: dict[int, set[asyncio.Queue]] = {}
+        self._pubsub: PubSub | None = None
+        self._task: asyncio.Task | None = None
+        # Callbacks run with the id of each invalidated topic
+        self._invalidation_handlers: list[Callable[[int], None]] = []
+        # Callbacks run with topic id and message id of each message added
+        self._message_handlers: list[Callable[[int, int], None]] = []
+        self.published = 0
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.invalidations = 0
+        self.announced = 0
+
+    async def publish(self, topic_id: int, event: dict) -> None:
+        """ Send event to watchers of topic on all workers """
+        if not self.enabled:
+            return
+        self.published += 1
+        await redis_client.publish(channel_of(topic_id), json.dumps(event, ensure_ascii=False))
+
+    def publish_pipe(self, pipe: Pipeline, topic_id: int, event: dict) -> None:
+        """ Queue publish of event on a pipeline, to share its round trip with other commands """
+        if not self.enabled:
+            return
+        self.published += 1
+        pipe.publish(channel_of(topic_id), json.dumps(event, ensure_ascii=False))
+
+    async def subscribe(self, topic_id: int) -> asyncio.Queue:
+        """ Get a queue receiving events of topic, the channel is subscribed by the first local watcher """
+        queue = asyncio.Queue(self.queue_size)
+        if not self.enabled:
+            return queue
+        subscribers = self._subscribers.get(topic_id)
+        if subscribers is None:
+            subscribers = self._subscribers[topic_id] = set()
+            await self._subscribe(channel_of(topic_id))
+        subscribers.add(queue)
+        self._start()
+        return queue
+
+    async def invalidate(self, topic_id: int) -> None:
+        """ Tell every worker that topic changed, independent of socket fan-out """
+        try:
+            await redis_client.publish(topic_invalidation, str(topic_id))
+        except Exception as e:
+            # Cached copies on other workers still expire after their ttl
+            debug_log(f"Error when publishing invalidation of topic {topic_id}: \n{e}")
+
+    async def announce_message(self, topic_id: int, message_id: int) -> None:
+        """ Tell every worker the id of a message added to topic """
+        try:
+            await redis_client.publish(topic_last_message, f"{topic_id}:{message_id}")
+        except Exception as e:
+            # Windows of other workers are reloaded after their ttl
+            debug_log(f"Error when announcing message {message_id} of topic {topic_id}: \n{e}")
+
+    async def watch_messages(self, handler: Callable[[int, int], None]) -> None:
+        """ Run handler with topic id and message id of each message added by any worker """
+        self._message_handlers.append(handler)
+        if len(self._message_handlers) == 1:
+            await self._subscribe(topic_last_message)
+        self._start()
+
+    async def watch_invalidations(self, handler: Callable[[int], None]) -> None:
+        """ Run handler with the id of each topic invalidated by any worker """
+        self._invalidation_handlers.append(handler)
+        if len(self._invalidation_handlers) == 1:
+            await self._subscribe(topic_invalidation)
+        self._start()
+
+    async def _subscribe(self, channel: str) -> None:
+        if self._pubsub is None:
+            self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(channel)
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def unsubscribe(self, topic_id: int, queue: asyncio.Queue) -> None:
+        """ Remove queue of a watcher, the channel is unsubscribed when the last local watcher leaves """
+        subscribers = self._subscribers.get(topic_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[topic_id]
+            await self._pubsub.unsubscribe(channel_of(topic_id))
+
+    async def _run(self) -> None:
+        """ Dispatch received events to local queues, a full queue of a slow watcher drops the event """
+        while self._subscribers or self._invalidation_handlers or self._message_handlers:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except Exception as e:
+                debug_log(f"Error when reading topic channels: \n{e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            if message["channel"] == topic_invalidation:
+                self.invalidations += 1
+                for handler in self._invalidation_handlers:
+                    handler(int(message["data"]))
+                continue
+            if message["channel"] == topic_last_message:
+                self.announced += 1
+                topic_id, message_id = map(int, message["data"].split(":"))
+                for handler in self._message_handlers:
+                    handler(topic_id, message_id)
+                continue
+            self.received += 1
+            topic_id = int(message["channel"].rsplit(":", 1)[1])
+            event = json.loads(message["data"])
+            for queue in self._subscribers.get(topic_id, ()):
+                try:
+                    queue.put_nowait(event)
+                    self.delivered += 1
+                except asyncio.QueueFull:
+                    self.dropped += 1
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        self._subscribers.clear()
+        self._invalidation_handlers.clear()
+        self._message_handlers.clear()
+
+    def stats(self) -> dict:
+        return {
+            "topics": len(self._subscribers),
+            "watchers": sum(len(s) for s in self._subscribers.values()),
+            "published": self.published,
+            "received": self.received,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "invalidations": self.invalidations,
+            "announced": self.announced,
+        }
+
+
+topic_broadcast = TopicBroadcaster(TOPIC_FANOUT_ENABLED, TOPIC_FANOUT_QUEUE_SIZE)
+
+
+def message_event(msg: ChatMessage, origin: str | None = None) -> dict:
+    """ Event of a stored chat message, origin lets the connection that sent it skip its own echo """
+    return {
+        "type": "message",
+        "message_id": msg.id,
+        "user_id": msg.user_id,
+        "role": msg.role,
+        "content": msg.content,
+        "origin": origin,
+    }
+
+
+async def forward_events(queue: asyncio.Queue, put: Callable[[str], Awaitable[None]], origin: str,
+                         own_generations: set[str]) -> None:
+    """ Send events of topic to a socket, skip echoes of messages and generations of that socket """
+    while True:
+        event = await queue.get()
+        if event.get("origin") == origin or event.get("generation_id") in own_generations:
+            continue
+        await put(json.dumps(event, ensure_ascii=False))
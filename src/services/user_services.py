@@ -7,6 +7,7 @@ from src.models import Role
 from src.models.users import Users
 from src.schema.queries_params_schema import QueryParams
 from src.schema.user_schema import UserCreate, UserSelfUpdate, ChangePassword
+from src.services.chat import window_cache
 from src.services.generic_services import get_all
 from src.services.perm_services import create_main_perms
 from src.utils.err_msg import err_msg
@@ -103,6 +104,8 @@ async def delete_user(db: AsyncSession, user_id: int) -> None | str:
     # Handle try to delete user
     await db.delete(user)
     await db.commit()
+    # Messages of user were deleted with cascade, drop cached windows
+    window_cache.clear()
 
     return None
 
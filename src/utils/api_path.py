@@ -14,12 +14,15 @@ class RoutePaths:
         list = "/topic"
         add = "/topic"
         list_by_user = "/topic/user/{user_id}"
+        export_by_user = "/topic/user/{user_id}/export"
     class ChatMessage:
         init = "/chat-gpt"
         list = "/messages"
         add = "/messages/topic-{topic_id}"
+        add_stream = "/messages/topic-{topic_id}/stream"
         list_by_topic = "/messages/topic-{topic_id}"
         list_by_topic_user = "/messages/topic-{topic_id}/user-{user_id}"
+        export_by_topic = "/messages/topic-{topic_id}/export"
         socket = "/ws/topic-{topic_id}"
     class Users:
         init = "/users"
@@ -39,6 +42,19 @@ class RoutePaths:
     class Permission:
         init = "/permissions"
         list = "/"
+    class Metrics:
+        init = "/metrics"
+        chat_window = "/chat-window"
+        chat_writer = "/chat-writer"
+        single_flight = "/single-flight"
+        llm_scheduler = "/llm-scheduler"
+        llm_endpoints = "/llm-endpoints"
+        llm_providers = "/llm-providers"
+        topic_fanout = "/topic-fanout"
+        semantic_cache = "/semantic-cache"
+        query_plans = "/query-plans"
+        db_routing = "/db-routing"
+        db_pool = "/db-pool"
 
 route_model_map = {
     "/chat-gpt/topic": "ChatTopic",
@@ -48,8 +64,12 @@ route_model_map = {
 
 route_model_pk_map = [
     (r"/chat-gpt/topic$", "ChatTopic", None),
+    # Export of topics of a user needs read on that user, the owner has it through its own role
+    (r"/chat-gpt/topic/user/(?P<user_id>\d+)/export$", "Users", "user_id"),
     (r"/chat-gpt/messages$", "ChatMessage", None),
     (r"/chat-gpt/messages/topic-(?P<topic_id>\d+)$", "ChatTopic", "topic_id"),
+    (r"/chat-gpt/messages/topic-(?P<topic_id>\d+)/stream$", "ChatTopic", "topic_id"),
+    (r"/chat-gpt/messages/topic-(?P<topic_id>\d+)/export$", "ChatTopic", "topic_id"),
     (r"/users$", "Users", None),
     (r"/users/(?P<user_id>\d+)$", "Users", "user_id"),
 ]
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Dict
 
 # List of available GPT models
 gpt_models: List[str] = [
@@ -30,3 +30,17 @@ gpt_dtemp: float = 0.7 # Creative of response, from 0.0 to 1.0; 0.0 is determini
 
 gpt_max_token: int = 728 # Token is a pieces of response; about 5 characters of a word is equal 1 token
 gpt_max_retrieve: int = 10 # Token is a pieces of response; about 5 characters of a word is equal 1 token
+
+
+# Context window (prompt + completion tokens) of each model
+gpt_context_window: Dict[str, int] = {
+    gpt.v41: 1047576,
+    gpt.v41_turbo: 1047576,
+    gpt.v41_mini: 1047576,
+    gpt.v41_nano: 1047576,
+    gpt.v4o: 128000,
+    gpt.o4mini: 128000,
+    gpt.o4nano: 128000,
+}
+gpt_default_context: int = 128000 # Used for models not listed above
+gpt_default_encoding: str = "o200k_base" # Tokenizer of gpt-4o and gpt-4.1 families
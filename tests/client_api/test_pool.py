@@ -0,0 +1,253 @@
+"""
+Tests of the endpoint pool against stub clients, no upstream is called.
+Run: python -m pytest tests
+"""
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from src.client_api.pool import CircuitBreaker, Endpoint, EndpointPool, NoEndpointAvailable
+
+request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+
+
+def connection_error() -> openai.APIConnectionError:
+    return openai.APIConnectionError(request=request)
+
+
+def bad_request() -> openai.BadRequestError:
+    return openai.BadRequestError("bad request", response=httpx.Response(400, request=request), body=None)
+
+
+def chunk(content: str | None):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class StubStream:
+    """ Stream of chunks, remembers if it was closed """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for item in self.chunks:
+            await asyncio.sleep(0)
+            yield item
+
+    async def close(self):
+        self.closed = True
+
+
+class StubClient:
+    """ Client answering chat completions after delay, or raising error """
+
+    def __init__(self, reply: str = "hello", delay: float = 0, error: Exception | None = None):
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+        self.streams: list[StubStream] = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.embeddings = SimpleNamespace(create=self.create_embeddings)
+
+    async def _wait(self):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+
+    async def create(self, stream: bool = False, **params):
+        await self._wait()
+        if stream:
+            self.streams.append(StubStream([chunk(None)] + [chunk(word) for word in self.reply.split()]))
+            return self.streams[-1]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.reply))])
+
+    async def create_embeddings(self, **params):
+        await self._wait()
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0]) for _ in params["input"]])
+
+    async def close(self):
+        pass
+
+
+def make_endpoint(name: str, client: StubClient, failure_threshold: int = 2, reset_timeout: float = 30) -> Endpoint:
+    endpoint = Endpoint(name, "http://upstream/v1", "key", 1, CircuitBreaker(failure_threshold, reset_timeout),
+                        timeout=5, max_connections=1)
+    endpoint.client = client
+    return endpoint
+
+
+def make_pool(*endpoints: Endpoint, hedge: bool = False) -> EndpointPool:
+    return EndpointPool(list(endpoints), hedge_enabled=hedge, hedge_percentile=50, hedge_min_samples=3)
+
+
+def open_breaker(breaker: CircuitBreaker) -> None:
+    for _ in range(breaker.failure_threshold):
+        breaker.on_failure()
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.closed
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.open
+    assert not breaker.available()
+
+
+def test_breaker_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    open_breaker(breaker)
+    assert breaker.available()
+    breaker.on_pick()
+    assert breaker.state == CircuitBreaker.half_open
+    assert not breaker.available()
+
+    breaker.on_success()
+    assert breaker.state == CircuitBreaker.closed
+    assert breaker.failures == 0
+    assert breaker.available()
+
+
+def test_breaker_failed_probe_opens_again():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0)
+    open_breaker(breaker)
+    breaker.on_pick()
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.open
+
+
+def test_breaker_cancelled_probe_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    open_breaker(breaker)
+    breaker.on_pick()
+    breaker.on_cancel()
+    assert breaker.available()
+
+
+def test_failover_to_next_endpoint():
+    broken = make_endpoint("broken", StubClient(error=connection_error()))
+    healthy = make_endpoint("healthy", StubClient("hi"))
+    pool = make_pool(broken, healthy)
+
+    assert asyncio.run(pool.complete(model="m", messages=[])) == "hi"
+    assert broken.errors == 1
+    assert broken.breaker.failures == 1
+    assert broken.outstanding == healthy.outstanding == 0
+
+
+def test_open_circuit_is_skipped():
+    broken = make_endpoint("broken", StubClient(error=connection_error()), failure_threshold=1)
+    healthy = make_endpoint("healthy", StubClient())
+    pool = make_pool(broken, healthy)
+
+    asyncio.run(pool.complete(model="m", messages=[]))
+    assert broken.breaker.state == CircuitBreaker.open
+    asyncio.run(pool.complete(model="m", messages=[]))
+    assert broken.client.calls == 1
+    assert healthy.client.calls == 2
+
+
+def test_all_endpoints_failing_raises_last_error():
+    pool = make_pool(make_endpoint("a", StubClient(error=connection_error()), failure_threshold=1),
+                     make_endpoint("b", StubClient(error=connection_error()), failure_threshold=1))
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(pool.complete(model="m", messages=[]))
+    with pytest.raises(NoEndpointAvailable):
+        asyncio.run(pool.complete(model="m", messages=[]))
+
+
+def test_client_error_does_not_open_circuit():
+    endpoint = make_endpoint("a", StubClient(error=bad_request()), failure_threshold=1)
+    pool = make_pool(endpoint, make_endpoint("b", StubClient()))
+
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(pool.complete(model="m", messages=[]))
+    assert endpoint.breaker.state == CircuitBreaker.closed
+    assert endpoint.errors == 1
+
+
+def test_hedge_wins_over_slow_endpoint():
+    slow = make_endpoint("slow", StubClient("slow", delay=1))
+    fast = make_endpoint("fast", StubClient("fast"))
+    # Equal load picks the first endpoint, the hedge goes to the second one
+    pool = make_pool(slow, fast, hedge=True)
+    for _ in range(3):
+        pool.latency.add(0.01)
+
+    assert asyncio.run(pool.complete(model="m", messages=[])) == "fast"
+    assert pool.hedges == pool.hedges_won == 1
+    assert slow.client.cancelled == 1
+    assert slow.outstanding == fast.outstanding == 0
+
+
+def test_no_hedge_without_enough_samples():
+    slow = make_endpoint("slow", StubClient("slow", delay=0.05))
+    fast = make_endpoint("fast", StubClient("fast"))
+    pool = make_pool(slow, fast, hedge=True)
+
+    assert asyncio.run(pool.complete(model="m", messages=[])) == "slow"
+    assert pool.hedges == 0
+    assert fast.client.calls == 0
+
+
+def test_stream_hedge_discards_losing_stream():
+    slow = make_endpoint("slow", StubClient("slow reply", delay=0.05))
+    fast = make_endpoint("fast", StubClient("fast reply"))
+    pool = make_pool(slow, fast, hedge=True)
+    for _ in range(3):
+        pool.ttft.add(0.01)
+
+    async def run():
+        return [delta async for delta in pool.stream(model="m", messages=[])]
+
+    assert asyncio.run(run()) == ["fast", "reply"]
+    assert pool.hedges_won == 1
+    assert slow.outstanding == fast.outstanding == 0
+    assert all(stream.closed for stream in fast.client.streams)
+
+
+def test_cancelled_probe_is_released():
+    endpoint = make_endpoint("a", StubClient(delay=1), failure_threshold=1, reset_timeout=0)
+    open_breaker(endpoint.breaker)
+    pool = make_pool(endpoint)
+
+    async def run():
+        task = asyncio.create_task(pool.complete(model="m", messages=[]))
+        await asyncio.sleep(0.01)
+        assert not endpoint.breaker.available()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert endpoint.breaker.available()
+    assert endpoint.outstanding == 0
+
+
+def test_closed_stream_releases_probe():
+    endpoint = make_endpoint("a", StubClient("one two three"), failure_threshold=1, reset_timeout=0)
+    open_breaker(endpoint.breaker)
+    pool = make_pool(endpoint)
+
+    async def run():
+        deltas = pool.stream(model="m", messages=[])
+        assert await deltas.__anext__() == "one"
+        # Client went away before the end of the stream
+        await deltas.aclose()
+
+    asyncio.run(run())
+    assert endpoint.breaker.available()
+    assert endpoint.breaker.state == CircuitBreaker.half_open
+    assert endpoint.outstanding == 0
+    assert endpoint.client.streams[0].closed
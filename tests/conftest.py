@@ -0,0 +1,40 @@
+"""
+Settings of the test run, set before app modules are imported.
+Tests use a SQLite database file of a temporary directory, Redis and upstream endpoints are not needed.
+"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+test_dir = tempfile.mkdtemp(prefix="chat-tests-")
+test_db = os.path.join(test_dir, "test.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{test_db}"
+os.environ["DATABASE_REPLICA_URLS"] = ""
+os.environ["DEBUG"] = ""
+os.environ["UVICORN_WORKERS"] = "1"
+os.environ["JWT_SECRET_KEY"] = "test-secret"
+os.environ["WRITE_BEHIND_SPILL_PATH"] = os.path.join(test_dir, "chat_messages.spill.jsonl")
+
+
+@pytest.fixture
+def run_db():
+    """ Run a coroutine function on a new event loop against empty tables """
+
+    def run(main):
+        from src.db.database import engine
+        from src.scripts.migrate_tables import create_tables
+
+        async def wrapped():
+            try:
+                await create_tables()
+                return await main()
+            finally:
+                await engine.dispose()
+
+        if os.path.exists(test_db):
+            os.remove(test_db)
+        return asyncio.run(wrapped())
+
+    return run
@@ -0,0 +1,104 @@
+"""
+Tests of routing request sessions between primary and read replicas, replicas and Redis are stubbed.
+"""
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+from starlette.requests import HTTPConnection
+
+from src.db import database
+from src.db.database import route_session
+
+
+def connection(method: str = "GET", token: str | None = "token") -> HTTPConnection:
+    headers = [(b"authorization", f"Bearer {token}".encode())] if token else []
+    return HTTPConnection({"type": "http", "method": method, "headers": headers, "query_string": b"", "path": "/"})
+
+
+class StubRedis:
+    def __init__(self, recent_writes: set[int] = frozenset()):
+        self.recent_writes = recent_writes
+        self.marked: list[str] = []
+
+    async def exists(self, key: str) -> int:
+        return int(int(key.rsplit(":", 1)[1]) in self.recent_writes)
+
+    async def set(self, key: str, value, ex: int):
+        self.marked.append(key)
+
+
+@pytest.fixture
+def decoded(monkeypatch):
+    """ Tokens decoded by routing, every token belongs to user 7 """
+    tokens = []
+
+    def decode(token):
+        tokens.append(token)
+        return SimpleNamespace(user_id=7)
+
+    monkeypatch.setattr(database, "decode_token", decode)
+    return tokens
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    replica = SimpleNamespace(name="replica")
+    monkeypatch.setattr(database, "replica_engines", [replica])
+    monkeypatch.setattr(database, "_next_replica", itertools.cycle([replica]))
+    return replica
+
+
+def route(conn: HTTPConnection) -> tuple[str, dict]:
+    db = SimpleNamespace(info={})
+    return asyncio.run(route_session(conn, db)), db.info
+
+
+def test_without_replicas_token_is_not_decoded(decoded, monkeypatch):
+    monkeypatch.setattr(database, "replica_engines", [])
+    assert route(connection())[0] == "primary"
+    assert route(connection("POST"))[0] == "primary"
+    assert decoded == []
+
+
+def test_read_goes_to_replica(decoded, replica, monkeypatch):
+    monkeypatch.setattr(database, "redis_client", StubRedis())
+    decision, info = route(connection())
+    assert decision == "replica"
+    assert info["replica"] is replica
+    assert decoded == ["token"]
+
+
+def test_read_after_own_write_sticks_to_primary(decoded, replica, monkeypatch):
+    monkeypatch.setattr(database, "redis_client", StubRedis({7}))
+    decision, info = route(connection())
+    assert decision == "sticky"
+    assert "replica" not in info
+
+
+def test_anonymous_read_goes_to_replica(decoded, replica, monkeypatch):
+    monkeypatch.setattr(database, "redis_client", StubRedis({7}))
+    assert route(connection(token=None))[0] == "replica"
+    assert decoded == []
+
+
+def test_write_decodes_token_only_on_commit(decoded, replica, monkeypatch):
+    redis = StubRedis()
+    monkeypatch.setattr(database, "redis_client", redis)
+    decision, info = route(connection("POST"))
+    assert decision == "primary"
+    assert decoded == []
+
+    async def commit():
+        database._committed(SimpleNamespace(info=info))
+        await asyncio.gather(*database._running_tasks)
+
+    # A commit without writes does not mark the user
+    asyncio.run(commit())
+    assert decoded == [] and redis.marked == []
+
+    info["wrote"] = True
+    asyncio.run(commit())
+    assert decoded == ["token"]
+    assert redis.marked == [f"{database.recent_write}:7"]
@@ -0,0 +1,58 @@
+"""
+Tests of token counting, tokenizers are stubbed so nothing is downloaded.
+"""
+import asyncio
+import threading
+
+import pytest
+
+from src.handlers import token_count
+from src.handlers.token_count import count_message_tokens, count_tokens, encoding_name, load_encodings
+from src.utils.gpt_model import gpt_default_encoding
+
+
+class StubEncoding:
+    """ One token per word """
+
+    def encode(self, text: str, disallowed_special=()) -> list[int]:
+        return [0] * len(text.split())
+
+
+@pytest.fixture(autouse=True)
+def no_encodings(monkeypatch):
+    monkeypatch.setattr(token_count, "encodings", {})
+
+
+def test_counts_are_estimated_without_tokenizer():
+    assert count_tokens("", "gpt-4o-mini") == 0
+    assert count_tokens("abcdefghi", "gpt-4o-mini") == 3
+    assert count_message_tokens("user", "abcdefgh", "gpt-4o-mini") == token_count.tokens_per_message + 1 + 2
+
+
+def test_failed_load_keeps_estimates(monkeypatch):
+    def offline(name):
+        raise ConnectionError("no network")
+
+    monkeypatch.setattr(token_count.tiktoken, "get_encoding", offline)
+    asyncio.run(load_encodings(["gpt-4o-mini"]))
+    assert token_count.encodings == {}
+    assert count_tokens("abcd", "gpt-4o-mini") == 1
+
+
+def test_encodings_load_off_the_event_loop(monkeypatch):
+    threads = []
+
+    def load(name):
+        threads.append(threading.current_thread())
+        return StubEncoding()
+
+    monkeypatch.setattr(token_count.tiktoken, "get_encoding", load)
+    asyncio.run(load_encodings(["gpt-4o-mini"]))
+    assert threads and threading.main_thread() not in threads
+    assert count_tokens("one two three", "gpt-4o-mini") == 3
+
+
+def test_unknown_model_uses_default_encoding(monkeypatch):
+    assert encoding_name("fake:gpt-4o-mini") == gpt_default_encoding
+    monkeypatch.setitem(token_count.encodings, gpt_default_encoding, StubEncoding())
+    assert count_tokens("one two", "fake:gpt-4o-mini") == 2
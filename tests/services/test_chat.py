@@ -0,0 +1,183 @@
+"""
+Tests of chat turns on SQLite, upstream calls and Redis are stubbed.
+"""
+import asyncio
+import json
+
+from sqlalchemy import event
+
+from src.handlers.token_count import count_message_tokens, count_tokens
+from src.models import ChatTopic
+from src.services import chat, single_flight
+from src.services.chat import (build_context, create_message_socket, create_message_stream, generate_reply_stream,
+                               reply_key, window_cache)
+
+
+class StatementCounter:
+    """ Count statements sent to the database """
+
+    def __init__(self, engine):
+        self.engine = engine.sync_engine
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self)
+
+
+class FakeRedis:
+    """ Keys and streams of Redis used by single-flight, kept in memory """
+
+    def __init__(self):
+        self.values = {}
+        self.streams: dict[str, list] = {}
+        self.changed = asyncio.Event()
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    async def expire(self, key, seconds):
+        return True
+
+    async def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+
+    async def xadd(self, key, fields):
+        entries = self.streams.setdefault(key, [])
+        entries.append((f"{len(entries) + 1}-0", {k: str(v) for k, v in fields.items()}))
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def xread(self, streams, block, count):
+        key, last_id = next(iter(streams.items()))
+        while True:
+            entries = [e for e in self.streams.get(key, []) if int(e[0].split("-")[0]) > int(last_id.split("-")[0])]
+            if entries:
+                return [[key, entries[:count]]]
+            try:
+                await asyncio.wait_for(self.changed.wait(), block / 1000)
+            except asyncio.TimeoutError:
+                return []
+
+
+async def no_announce(topic_id: int, message_id: int) -> None:
+    pass
+
+
+async def new_topic(db, **fields) -> ChatTopic:
+    topic = ChatTopic(name="topic", system_prompt="Be brief.", **fields)
+    db.add(topic)
+    await db.commit()
+    db.expunge(topic)
+    return topic
+
+
+def test_cached_window_needs_no_query(run_db, monkeypatch):
+    monkeypatch.setattr(chat.topic_broadcast, "announce_message", no_announce)
+    window_cache.clear()
+
+    async def main():
+        from src.db.database import AsyncSessionLocal, engine
+        async with AsyncSessionLocal() as db:
+            topic = await new_topic(db)
+            await create_message_socket(db, topic.id, None, "hello", "user", topic.model)
+            await build_context(db, topic)
+
+            with StatementCounter(engine) as counter:
+                await create_message_socket(db, topic.id, None, "reply", "assistant", topic.model)
+                inserts = counter.count
+                messages, _ = await build_context(db, topic)
+            assert counter.count == inserts
+            assert [m["content"] for m in messages] == ["Be brief.", "hello", "reply"]
+
+            # Another worker added message 10 of topic
+            window_cache.note_message(topic.id, 10)
+            with StatementCounter(engine) as counter:
+                await build_context(db, topic)
+            assert counter.count > 0
+
+    run_db(main)
+
+
+def test_stream_usage_counts_reply_content(run_db, monkeypatch):
+    monkeypatch.setattr(chat.topic_broadcast, "announce_message", no_announce)
+    monkeypatch.setattr(chat.topic_broadcast, "enabled", False)
+    window_cache.clear()
+
+    async def reply(topic, messages):
+        for delta in ("The answer ", "is forty two."):
+            yield delta
+
+    monkeypatch.setattr(chat, "generate_reply_stream", reply)
+
+    async def main():
+        from src.db.database import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            topic = await new_topic(db)
+        return [event async for event in create_message_stream(topic, None, "question")]
+
+    events = run_db(main)
+    done = json.loads(events[-1].split("data: ", 1)[1])
+    usage = done["usage"]
+    assert usage["completion_tokens"] == count_tokens("The answer is forty two.", "gpt-4o-mini")
+    assert usage["completion_tokens"] < count_message_tokens("assistant", "The answer is forty two.", "gpt-4o-mini")
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
+
+
+def test_reply_key_ignores_history_and_spacing():
+    topic = ChatTopic(name="topic", system_prompt="Be brief.", model="gpt-4o-mini", temperature=0.7, max_token=100)
+    first = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "What is  a cursor?"}]
+    second = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "hi"},
+              {"role": "assistant", "content": "hello"}, {"role": "user", "content": "what is a cursor? "}]
+    assert reply_key(topic, first) == reply_key(topic, second)
+    other = ChatTopic(name="other", system_prompt="Be verbose.", model="gpt-4o-mini", temperature=0.7, max_token=100)
+    assert reply_key(other, first) != reply_key(topic, first)
+
+
+def test_concurrent_identical_questions_share_one_call(monkeypatch):
+    monkeypatch.setattr(single_flight, "redis_client", FakeRedis())
+    upstream_calls, lookups = [], []
+
+    async def upstream(messages, model, temperature, max_tokens):
+        upstream_calls.append(messages)
+        for delta in ("A cursor ", "marks a row."):
+            await asyncio.sleep(0.01)
+            yield delta
+
+    async def lookup(topic, messages):
+        lookups.append(topic.id)
+        return None
+
+    monkeypatch.setattr(chat, "message_to_gpt_stream", upstream)
+    monkeypatch.setattr(chat, "semantic_lookup", lookup)
+    topic = ChatTopic(id=1, name="topic", system_prompt="Be brief.", model="gpt-4o-mini", temperature=0.7,
+                      max_token=100, single_flight_enabled=True, cache_enabled=False)
+
+    async def ask(history):
+        messages = [{"role": "system", "content": "Be brief."}, *history,
+                    {"role": "user", "content": "What is a cursor?"}]
+        return "".join([delta async for delta in generate_reply_stream(topic, messages)])
+
+    async def main():
+        # Callers differ by their earlier turns, e.g. two users of one topic
+        return await asyncio.gather(ask([]), ask([{"role": "user", "content": "hi"}]))
+
+    assert asyncio.run(main()) == ["A cursor marks a row.", "A cursor marks a row."]
+    assert len(upstream_calls) == 1
+    assert len(lookups) == 1
@@ -0,0 +1,45 @@
+"""
+Tests of topic compaction on SQLite, the summarizing model is stubbed.
+"""
+from types import SimpleNamespace
+
+from src.conf.settings import COMPACTION_KEEP_TOKENS
+from src.models import ChatMessage, ChatTopic
+from src.services import chat_compaction
+from src.services.chat_compaction import compact_step, keep_tokens
+
+
+def test_keep_budget_is_at_most_half_the_threshold():
+    assert keep_tokens(SimpleNamespace(compaction_threshold=100)) == 50
+    assert keep_tokens(SimpleNamespace(compaction_threshold=10 ** 6)) == COMPACTION_KEEP_TOKENS
+
+
+def test_small_threshold_compacts_older_messages(run_db, monkeypatch):
+    prompts = []
+
+    async def summarize(messages, model, temperature, max_tokens, priority):
+        prompts.append(messages)
+        return "short summary"
+
+    monkeypatch.setattr(chat_compaction, "message_to_gpt", summarize)
+
+    async def main():
+        from src.db.database import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            topic = ChatTopic(name="topic", compaction_enabled=True, compaction_threshold=100)
+            db.add(topic)
+            await db.flush()
+            db.add_all([ChatMessage(topic_id=topic.id, role="user", content=f"message {i}", token_count=10)
+                        for i in range(20)])
+            await db.commit()
+
+            # 200 tokens are over the threshold, the 50 newest tokens stay verbatim
+            assert await compact_step(db, topic.id)
+            assert not await compact_step(db, topic.id)
+            await db.refresh(topic)
+            return topic.summary, topic.summary_until_id
+
+    summary, until_id = run_db(main)
+    assert summary == "short summary"
+    assert until_id == 15
+    assert len(prompts) == 1
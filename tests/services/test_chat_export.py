@@ -0,0 +1,79 @@
+"""
+Tests of chat history export encoders, and of a gzip export streamed from SQLite.
+"""
+import csv
+import gzip
+import io
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+from src.models import ChatMessage, ChatTopic
+from src.services.chat_export import (CsvEncoder, FinetuneEncoder, NdjsonEncoder, export_fields, export_messages,
+                                      export_query)
+
+created_at = datetime(2026, 1, 2, 3, 4, 5)
+
+
+def row(id: int, topic_id: int, role: str, content: str, system_prompt: str | None = None):
+    return SimpleNamespace(id=id, topic_id=topic_id, user_id=None, role=role, content=content, token_count=3,
+                           created_at=created_at, system_prompt=system_prompt)
+
+
+def test_ndjson_has_one_message_per_line():
+    text = NdjsonEncoder.encode([row(1, 1, "user", "hi"), row(2, 1, "assistant", 'say "hello"\n')])
+    lines = [json.loads(line) for line in text.splitlines()]
+    assert [line["content"] for line in lines] == ["hi", 'say "hello"\n']
+    assert lines[0]["created_at"] == created_at.isoformat()
+    assert list(lines[0]) == export_fields
+    assert NdjsonEncoder.finish() == ""
+
+
+def test_csv_writes_header_once():
+    encoder = CsvEncoder()
+    text = encoder.encode([row(1, 1, "user", "a, b")]) + encoder.encode([row(2, 1, "assistant", "line\nbreak")])
+    text += encoder.finish()
+    rows = list(csv.reader(io.StringIO(text)))
+    assert rows[0] == export_fields
+    assert [r[export_fields.index("content")] for r in rows[1:]] == ["a, b", "line\nbreak"]
+
+
+def test_csv_of_empty_export_has_header():
+    assert next(csv.reader(io.StringIO(CsvEncoder().finish()))) == export_fields
+
+
+def test_finetune_examples_end_with_assistant_message():
+    encoder = FinetuneEncoder(max_messages=4)
+    rows = [
+        row(1, 1, "user", "q1", "Be brief."), row(2, 1, "assistant", "a1", "Be brief."),
+        row(3, 1, "user", "q2", "Be brief."), row(4, 1, "assistant", "a2", "Be brief."),
+        # Unanswered question at the end of a topic is dropped
+        row(5, 1, "user", "q3", "Be brief."),
+        row(6, 2, "system", "summary"), row(7, 2, "user", "q4"), row(8, 2, "assistant", "a4"),
+    ]
+    text = encoder.encode(rows[:3]) + encoder.encode(rows[3:]) + encoder.finish()
+    examples = [json.loads(line)["messages"] for line in text.splitlines()]
+    assert examples == [
+        [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "q1"},
+         {"role": "assistant", "content": "a1"}, {"role": "user", "content": "q2"},
+         {"role": "assistant", "content": "a2"}],
+        [{"role": "user", "content": "q4"}, {"role": "assistant", "content": "a4"}],
+    ]
+
+
+def test_gzip_export_streams_topic_messages(run_db):
+    async def main():
+        from src.db.database import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            topic, other = ChatTopic(name="topic"), ChatTopic(name="other")
+            db.add_all([topic, other])
+            await db.flush()
+            db.add_all([ChatMessage(topic_id=topic.id, role="user", content=f"m{i}") for i in range(3)])
+            db.add(ChatMessage(topic_id=other.id, role="user", content="other"))
+            await db.commit()
+            topic_id = topic.id
+        return b"".join([chunk async for chunk in export_messages(export_query("ndjson", topic_id=topic_id),
+                                                                  "ndjson", compress=True)])
+
+    lines = gzip.decompress(run_db(main)).decode("utf-8").splitlines()
+    assert [json.loads(line)["content"] for line in lines] == ["m0", "m1", "m2"]
@@ -0,0 +1,81 @@
+"""
+Tests of the window cache of chat topics and the message announcements that keep it current across workers.
+"""
+import asyncio
+
+from src.db.redisdb import topic_last_message
+from src.services.chat_window_cache import ConversationWindowCache, WindowMessage
+from src.services.topic_broadcast import TopicBroadcaster
+
+
+def filled_cache(*ids: int) -> ConversationWindowCache:
+    cache = ConversationWindowCache(max_topics=4, max_messages=8, ttl=60)
+    cache.fill(1, [WindowMessage(i, "user", f"m{i}", 1) for i in reversed(ids)], 0)
+    return cache
+
+
+def test_own_messages_keep_window():
+    cache = filled_cache(1, 2)
+    cache.append(1, WindowMessage(3, "assistant", "m3", 1))
+    cache.note_message(1, 3)
+    cache.check(1)
+    assert [m.id for m in cache.recent(1, 0, 100)] == [3, 2, 1]
+    assert cache.stale == 0
+
+
+def test_announced_newer_message_drops_window():
+    cache = filled_cache(1, 2)
+    # Message 5 was added by another worker
+    cache.note_message(1, 5)
+    assert cache.newest_id(1) == 5
+    cache.check(1)
+    assert cache.recent(1, 0, 100) is None
+    assert cache.stale == 1
+
+
+def test_announced_older_message_keeps_window():
+    cache = filled_cache(4, 6)
+    cache.note_message(1, 5)
+    cache.check(1)
+    assert [m.id for m in cache.recent(1, 0, 100)] == [6, 4]
+
+
+def test_announcement_of_unknown_topic_is_ignored():
+    cache = filled_cache(1)
+    cache.note_message(2, 9)
+    assert cache.newest_id(2) == 0
+
+
+class StubPubSub:
+    """ Pub/sub connection returning queued messages """
+
+    def __init__(self, messages: list[dict]):
+        self.messages = messages
+        self.channels: list[str] = []
+
+    async def subscribe(self, channel: str):
+        self.channels.append(channel)
+
+    async def get_message(self, timeout: float):
+        await asyncio.sleep(0)
+        return self.messages.pop(0) if self.messages else None
+
+    async def aclose(self):
+        pass
+
+
+def test_broadcaster_dispatches_announcements():
+    received = []
+    broadcaster = TopicBroadcaster(enabled=True, queue_size=10)
+    broadcaster._pubsub = StubPubSub([{"type": "message", "channel": topic_last_message, "data": "7:42"}])
+
+    async def main():
+        await broadcaster.watch_messages(lambda topic_id, message_id: received.append((topic_id, message_id)))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await broadcaster.close()
+
+    asyncio.run(main())
+    assert broadcaster._pubsub.channels == [topic_last_message]
+    assert received == [(7, 42)]
+    assert broadcaster.announced == 1
@@ -0,0 +1,151 @@
+"""
+Tests of write-behind persistence of chat messages on SQLite, PostgreSQL id blocks use a stub engine.
+"""
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+from sqlalchemy import select
+
+from src.models import ChatMessage, ChatTopic
+from src.services import chat_writer as writer_module
+from src.services.chat_window_cache import WindowMessage
+from src.services.chat_writer import ChatMessageWriter, MessageIdAllocator
+
+
+def make_writer(tmp_path, batch_size: int = 10) -> ChatMessageWriter:
+    return ChatMessageWriter(batch_size, 0.01, 100, str(tmp_path / "spill.jsonl"), id_block=3)
+
+
+async def add_topic() -> int:
+    from src.db.database import AsyncSessionLocal
+    async with AsyncSessionLocal() as db:
+        topic = ChatTopic(name="topic")
+        db.add(topic)
+        await db.commit()
+        return topic.id
+
+
+async def stored_ids() -> list[int]:
+    from src.db.database import AsyncSessionLocal
+    async with AsyncSessionLocal() as db:
+        return list((await db.scalars(select(ChatMessage.id).order_by(ChatMessage.id))).all())
+
+
+class StubConnection:
+    """ Connection of a PostgreSQL engine answering nextval of a block from a counter """
+
+    def __init__(self, sequence: list[int], calls: list[int]):
+        self.sequence = sequence
+        self.calls = calls
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt, params):
+        self.calls.append(params["n"])
+        ids = list(range(self.sequence[0] + 1, self.sequence[0] + params["n"] + 1))
+        self.sequence[0] += params["n"]
+        return SimpleNamespace(scalars=lambda: SimpleNamespace(all=lambda: ids))
+
+
+def test_postgresql_ids_are_reserved_in_blocks(monkeypatch):
+    sequence, calls = [100], []
+    stub = SimpleNamespace(dialect=SimpleNamespace(name="postgresql"),
+                           connect=lambda: StubConnection(sequence, calls))
+    monkeypatch.setattr(writer_module, "engine", stub)
+    allocator = MessageIdAllocator(block_size=3)
+
+    async def main():
+        return [await allocator.next_id() for _ in range(5)]
+
+    assert asyncio.run(main()) == [101, 102, 103, 104, 105]
+    assert calls == [3, 3]
+    assert allocator.blocks == 2
+
+
+def test_ids_skip_past_newest_id_of_topic(run_db):
+    allocator = MessageIdAllocator(block_size=5)
+
+    async def main():
+        first = await allocator.next_id()
+        # Topic got a newer message from a block of another worker
+        second = await allocator.next_id(after=first + 3)
+        third = await allocator.next_id(after=40)
+        return first, second, third
+
+    assert run_db(main) == (1, 5, 41)
+    assert allocator.blocks == 2
+
+
+def test_queued_messages_are_pending_until_flushed(run_db, tmp_path):
+    writer = make_writer(tmp_path)
+
+    async def main():
+        topic_id = await add_topic()
+        await writer.start()
+        rows = [await writer.add(None, topic_id, "user", f"message {i}", 5) for i in range(4)]
+        assert [m.id for m in writer.pending(topic_id)] == [row["id"] for row in rows]
+        await writer.stop()
+        return topic_id, [row["id"] for row in rows], await stored_ids()
+
+    topic_id, ids, stored = run_db(main)
+    assert stored == ids == [1, 2, 3, 4]
+    assert writer.pending(topic_id) == []
+    assert writer.stats()["flushed"] == 4
+
+
+def test_failed_flush_spills_and_replays(run_db, tmp_path, monkeypatch):
+    writer = make_writer(tmp_path)
+
+    async def unavailable(rows):
+        raise ConnectionError("database is down")
+
+    async def main():
+        topic_id = await add_topic()
+        insert = writer._insert
+        monkeypatch.setattr(writer, "_insert", unavailable)
+        rows = [{"id": i, "user_id": None, "topic_id": topic_id, "role": "user", "content": f"m{i}",
+                 "token_count": 1, "created_at": writer_module.now_vn()} for i in (1, 2)]
+        for row in rows:
+            writer._pending.setdefault(topic_id, {})[row["id"]] = WindowMessage(row["id"], "user", row["content"], 1)
+        await writer._flush(rows)
+
+        with open(writer.spill_path, encoding="utf-8") as f:
+            spilled = [json.loads(line)["id"] for line in f]
+        assert spilled == [1, 2]
+        # Spilled rows stay in context until they are written
+        assert len(writer.pending(topic_id)) == 2
+        assert await stored_ids() == []
+
+        monkeypatch.setattr(writer, "_insert", insert)
+        await writer.replay_spill()
+        return topic_id, await stored_ids()
+
+    topic_id, stored = run_db(main)
+    assert stored == [1, 2]
+    assert writer.pending(topic_id) == []
+    assert writer.spilled == 2
+    assert not os.path.exists(writer.spill_path)
+    assert not os.path.exists(f"{writer.spill_path}.replay")
+
+
+def test_partial_replay_skips_written_rows(run_db, tmp_path):
+    writer = make_writer(tmp_path)
+
+    async def main():
+        topic_id = await add_topic()
+        rows = [{"id": i, "user_id": None, "topic_id": topic_id, "role": "user", "content": f"m{i}",
+                 "token_count": 1, "created_at": writer_module.now_vn()} for i in (1, 2, 3)]
+        # First row was written before the worker stopped, the whole batch is still in the replay file
+        await writer._insert(rows[:1])
+        writer._spill(rows)
+        os.replace(writer.spill_path, f"{writer.spill_path}.replay")
+        await writer.replay_spill()
+        return await stored_ids()
+
+    assert run_db(main) == [1, 2, 3]
@@ -0,0 +1,140 @@
+"""
+Tests of list queries of generic services on SQLite: allowed fields, keyset cursors and their errors.
+"""
+import base64
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src.models.chat import ChatMessage, ChatTopic
+from src.models.users import Users
+from src.schema.queries_params_schema import ProjectionParams, QueryParams
+from src.services.generic_services import (InvalidQuery, b64decode, decode_cursor, encode_cursor, get_all,
+                                           model_meta, parse_query)
+
+
+def test_hidden_columns_cannot_be_sorted_searched_or_projected():
+    meta = model_meta(Users)
+    assert "password" not in meta.sort_fields
+    assert "password" not in {c.key for c in meta.search_columns}
+    with pytest.raises(InvalidQuery):
+        parse_query(Users, QueryParams(order_by="password", strict=True))
+    shape, _ = parse_query(Users, QueryParams(order_by="-password"))
+    assert shape.order_field is None
+    shape, _ = parse_query(Users, QueryParams(), projection=ProjectionParams(fields="id,password"))
+    assert shape.fields == ("id",)
+
+
+def test_invalid_filter_is_rejected():
+    with pytest.raises(InvalidQuery):
+        parse_query(Users, QueryParams(filter="{not json"))
+    with pytest.raises(InvalidQuery):
+        parse_query(Users, QueryParams(filter="[1, 2]"))
+
+
+def test_cursor_round_trip():
+    column = Users.__table__.columns["username"]
+    cursor = encode_cursor("-username", "alice", 7, True)
+    assert decode_cursor(cursor, "-username", column) == ("alice", 7, True)
+
+
+@pytest.mark.parametrize("cursor", [
+    "garbage",
+    "",
+    "e30.AAAA",
+    # Payload changed after signing
+    "x" + encode_cursor("username", "alice", 7, True),
+])
+def test_bad_cursor_is_rejected(cursor):
+    with pytest.raises(InvalidQuery):
+        decode_cursor(cursor, "username", Users.__table__.columns["username"])
+
+
+def test_forged_cursor_is_rejected():
+    payload, _, signature = encode_cursor("username", "alice", 7, True).partition(".")
+    raw = json.loads(b64decode(payload))
+    raw["v"] = "' OR 1=1"
+    forged = json.dumps(raw).encode("utf-8")
+    with pytest.raises(InvalidQuery):
+        decode_cursor(f"{base64.urlsafe_b64encode(forged).decode('ascii')}.{signature}", "username",
+                      Users.__table__.columns["username"])
+
+
+def test_cursor_of_other_order_by_is_rejected():
+    cursor = encode_cursor("username", "alice", 7, True)
+    with pytest.raises(InvalidQuery):
+        decode_cursor(cursor, "-username", Users.__table__.columns["username"])
+
+
+def test_keyset_pages_cover_all_rows(run_db):
+    async def main():
+        from src.db.database import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            db.add_all([Users(f"user{i:02d}", f"user{i}@example.com", f"hash-{i}") for i in range(7)])
+            await db.commit()
+
+            names, cursor, cursors = [], None, []
+            while True:
+                page = await get_all(db, Users, QueryParams(order_by="-username", limit=3, cursor=cursor,
+                                                            paginate="keyset"))
+                names += [item["username"] for item in page["data"]]
+                assert all("password" not in item for item in page["data"])
+                cursor = page["next_cursor"]
+                if cursor is None:
+                    break
+                cursors.append(cursor)
+            return names, cursors
+
+    names, cursors = run_db(main)
+    assert names == [f"user{i:02d}" for i in reversed(range(7))]
+    assert all("hash" not in b64decode(c.partition(".")[0]).decode("utf-8") for c in cursors)
+
+
+def test_bad_cursor_is_bad_request():
+    from src.main import app
+    from src.utils.api_path import RoutePaths
+
+    client = TestClient(app)
+    url = f"{RoutePaths.API_PREFIX}/chat-gpt/messages"
+    resp = client.get(url, params={"cursor": "garbage"})
+    assert resp.status_code == 400
+    assert resp.json()["detail"].startswith("Invalid cursor")
+
+    resp = client.get(url, params={"order_by": "nope", "strict": True})
+    assert resp.status_code == 400
+
+
+async def keyset_pages(db, model, params: dict, projection: ProjectionParams) -> list[list[dict]]:
+    pages, cursor = [], None
+    while True:
+        page = await get_all(db, model, QueryParams(paginate="keyset", cursor=cursor, **params), projection=projection)
+        pages.append(page["data"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_keyset_sort_column_stays_out_of_projection(run_db):
+    async def main():
+        from src.db.database import AsyncSessionLocal
+        async with AsyncSessionLocal() as db:
+            topic = ChatTopic(name="topic")
+            db.add(topic)
+            await db.flush()
+            # Equal prefixes, a cursor made of the cut value would repeat rows
+            db.add_all([ChatMessage(topic_id=topic.id, role="user", content=f"same prefix {i}") for i in range(5)])
+            await db.commit()
+            projected = await keyset_pages(db, ChatMessage, {"order_by": "-content", "limit": 2},
+                                           ProjectionParams(fields="role"))
+            previewed = await keyset_pages(db, ChatMessage, {"order_by": "content", "limit": 2},
+                                           ProjectionParams(fields="content", preview=4))
+            return projected, previewed
+
+    projected, previewed = run_db(main)
+    rows = [row for page in projected for row in page]
+    assert all(set(row) == {"id", "role"} for row in rows)
+    assert [row["id"] for row in rows] == [5, 4, 3, 2, 1]
+    rows = [row for page in previewed for row in page]
+    assert [row["id"] for row in rows] == [1, 2, 3, 4, 5]
+    assert all(row == {"id": row["id"], "content": "same"} for row in rows)